@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks the hot paths of neurosegment on synthetic cases (see
+synthetic.py), so it runs offline without FSL or patient data:
+    - gbs: label_2d, generate_properties and sieve_image (with a model
+      trained on a separate synthetic case)
+    - preprocessing: edge_map and score_midsagittal
+    - UGLI: whole-volume morphology and lasso polygon filling
+
+Each benchmark is timed n_repeats times and run once more under tracemalloc
+to record its peak memory. Results are appended as JSON lines to
+results_file (by default in the per-user cache folder, outside the
+repository), and each result is compared with the best previous result for
+the same benchmark, case and machine. The script exits with status 1 if any
+benchmark is more than regression_tolerance slower than that
+
+Pass benchmark names as arguments to only run those, e.g.
+    python benchmark_hot_paths.py label_2d sieve_image
+"""
+
+import os
+import sys
+import io
+import json
+import platform
+import tempfile
+import tracemalloc
+import subprocess
+import contextlib
+from time import perf_counter, strftime
+
+import numpy as np
+from scipy import ndimage
+
+script_folder = os.path.dirname(os.path.realpath(__file__))
+repo_folder = os.path.dirname(script_folder)
+sys.path.append(os.path.join(repo_folder, 'neurosegment'))
+
+import gbs
+import preprocessing as pp
+import ugli_helpers as ugh
+import synthetic
+
+
+cases = [
+    {'case': 'small', 'shape': (96, 112, 40), 'n_lesions': 12},
+    {'case': 'large', 'shape': (256, 256, 64), 'n_lesions': 80},
+    ]
+midsag_shape = (24, 24, 2) # score_midsagittal checks every pixel with sympy, so it gets a tiny case of its own
+lasso_vertices = 400 # vertices in the benchmarked lasso polygon
+
+seed = 0
+n_repeats = 5
+
+results_file = None # None uses the NEUROSEGMENT_BENCHMARK_RESULTS environment variable, or benchmark_results.jsonl in the per-user cache folder (see ugli_helpers.user_cache_folder)
+regression_tolerance = 0.25 # fractional slowdown of the median time that counts as a regression
+
+#####
+
+if results_file is None:
+    results_file = os.environ.get('NEUROSEGMENT_BENCHMARK_RESULTS')
+if results_file is None:
+    results_file = os.path.join(ugh.user_cache_folder(), 'benchmark_results.jsonl')
+
+
+def git_commit():
+    try:
+        result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=repo_folder,
+                                capture_output=True, text=True)
+    except OSError:
+        return None
+    return result.stdout.strip() or None
+
+
+def star_polygon(center, radius, n_vertices, rng):
+    # an irregular, non-convex closed polygon like a hand-drawn lasso
+    angles = np.linspace(0, 2*np.pi, n_vertices, endpoint=False)
+    radii = radius * rng.uniform(0.5, 1, n_vertices)
+    return np.column_stack([center[1] + radii*np.cos(angles), center[0] + radii*np.sin(angles)])
+
+
+def train_model(shape, n_lesions, folder):
+    training = synthetic.synthetic_case(shape, n_lesions, seed=seed+1)['lesions'].astype(int)
+    return gbs.train_and_save(gbs.generate_properties(training), os.path.join(folder, 'gbs_benchmark.pkl'))
+
+
+def benchmarks_for_case(case, folder):
+    """
+    Returns (name, function) pairs that each run one hot path on a case
+    """
+    data = synthetic.synthetic_case(case['shape'], case['n_lesions'], seed=seed)
+    lesions = data['lesions'].astype(int)
+    rng = np.random.default_rng(seed)
+    polygon = star_polygon(np.array(case['shape'][:2]) / 2, min(case['shape'][:2]) * 0.4, lasso_vertices, rng)
+    model = {}
+
+    def sieve():
+        # the model is trained on the first call, which is not timed separately from the warm-up
+        if 'model' not in model:
+            model['model'] = train_model(case['shape'], case['n_lesions'], folder)
+        gbs.sieve_image(lesions, model['model'])
+
+    return [
+        ('label_2d', lambda: gbs.label_2d(lesions)),
+        ('generate_properties', lambda: gbs.generate_properties(lesions)),
+        ('sieve_image', sieve),
+        ('edge_map', lambda: pp.edge_map(data['flair'], data['brain'], threshold=95, axes=(0,1))),
+        ('morphology_volume', lambda: ugh.binary_operation_volume(ndimage.binary_dilation, data['lesions'])),
+        ('lasso_fill', lambda: ugh.rasterize_polygon(polygon, case['shape'][:2])),
+        ]
+
+
+def midsagittal_benchmark():
+    import sympy as sp
+
+    data = synthetic.synthetic_case(midsag_shape, 1, seed=seed)
+    edges, _ = pp.edge_map(data['flair'], data['brain'], threshold=95, axes=(0,1))
+    cx = (midsag_shape[0] - 1) / 2
+    plane = sp.Plane((cx, 0, 0), (cx, 1, 0), (cx, 0, 1))
+
+    def score():
+        with contextlib.redirect_stdout(io.StringIO()): # score_midsagittal prints every slice
+            pp.score_midsagittal(edges, plane)
+
+    return [('score_midsagittal', score)]
+
+
+def run_benchmark(func):
+    """
+    Times a benchmark and measures its peak traced memory
+
+    Returns
+    -------
+    A tuple of the list of run times in seconds and the peak memory in bytes
+
+    """
+    func() # warm up caches and lazy imports
+    times = []
+    for i in range(n_repeats):
+        start = perf_counter()
+        func()
+        times.append(perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return times, peak
+
+
+def load_previous_results():
+    if not os.path.exists(results_file):
+        return []
+    with open(results_file) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def best_previous(previous, record):
+    matches = [r['median_s'] for r in previous
+               if r.get('error') is None
+               and r['benchmark'] == record['benchmark']
+               and r['case'] == record['case']
+               and r['shape'] == record['shape']
+               and r['machine'] == record['machine']]
+    return min(matches) if matches else None
+
+
+only = set(sys.argv[1:])
+
+run_info = {'run': strftime('%Y-%m-%dT%H:%M:%S'),
+            'commit': git_commit(),
+            'machine': platform.node(),
+            'python': platform.python_version(),
+            'numpy': np.__version__}
+
+previous = load_previous_results()
+records = []
+regressions = []
+
+with tempfile.TemporaryDirectory(prefix='neurosegment_benchmark_') as folder:
+    suites = [(case, lambda case=case: benchmarks_for_case(case, folder)) for case in cases]
+    suites.append(({'case': 'midsagittal', 'shape': midsag_shape, 'n_lesions': 1}, midsagittal_benchmark))
+
+    for case, make_benchmarks in suites:
+        print(f'Case {case["case"]}: shape {case["shape"]}, {case["n_lesions"]} lesions')
+        for name, func in make_benchmarks():
+            if only and name not in only:
+                continue
+
+            record = dict(run_info, benchmark=name, case=case['case'], shape=list(case['shape']),
+                          n_lesions=case['n_lesions'], n_repeats=n_repeats, error=None)
+            try:
+                times, peak = run_benchmark(func)
+            except Exception as e:
+                record['error'] = repr(e)
+                print(f'\t{name}: FAILED ({record["error"]})')
+                records.append(record)
+                continue
+
+            record.update(min_s=min(times), median_s=float(np.median(times)), peak_mb=peak / 1024**2)
+            records.append(record)
+
+            best = best_previous(previous, record)
+            note = ''
+            if best is not None:
+                change = record['median_s'] / best - 1
+                note = f' ({change:+.0%} vs best {best:.4f} s)'
+                if change > regression_tolerance:
+                    regressions.append(record)
+                    note += ' REGRESSION'
+            print(f'\t{name}: median {record["median_s"]:.4f} s, min {record["min_s"]:.4f} s, '
+                  f'peak {record["peak_mb"]:.1f} MB{note}')
+
+with open(results_file, 'a') as f:
+    for record in records:
+        f.write(json.dumps(record) + '\n')
+
+print(f'\nResults appended to {results_file}')
+
+if regressions:
+    print(f'{len(regressions)} benchmark(s) regressed by more than {regression_tolerance:.0%}:')
+    for r in regressions:
+        print(f'\t{r["benchmark"]} ({r["case"]})')
+    sys.exit(1)
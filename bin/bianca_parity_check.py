@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Checks that the in-process classifier in bianca_classifier.py reproduces the
+probability map written by the bianca executable.
+
+By default a synthetic case is generated (see synthetic.py): an ellipsoidal
+"brain" with bright FLAIR / dark T1 spherical lesions, plus an identity FLIRT
+matrix. Set flair, t1 and trans to run the comparison on a real case instead.
+
+When FSL is installed, the map bianca writes for the synthetic case can be
+stored in reference_folder (set save_reference). The synthetic case is
+regenerated identically from its seed, so on machines without FSL the check
+runs offline against the stored map, as long as it was made with the same
+model. Until a reference has been stored and this check passes, the
+in-process classifier is unvalidated
+"""
+
+import os
+import sys
+import json
+import shutil
+import hashlib
+import tempfile
+
+import numpy as np
+import nibabel as nib
+
+script_folder = os.path.dirname(os.path.realpath(__file__))
+repo_folder = os.path.dirname(script_folder)
+sys.path.append(os.path.join(repo_folder, 'neurosegment'))
+
+import ugli_helpers as ugh
+import bianca_classifier as bc
+import synthetic
+
+
+model = os.path.join(repo_folder, 'bin', 'ugli_bianca_models', 'default_bianca_classifer')
+
+# leave as None to generate a synthetic case
+flair = None
+t1 = None
+trans = None
+
+shape = (96, 112, 40)
+n_lesions = 12
+seed = 0
+
+max_mean_abs_diff = 0.02 # tolerances for a pass
+min_dice = 0.95
+
+reference_folder = os.path.join(repo_folder, 'bin', 'bianca_parity_reference') # bianca's maps for synthetic cases
+save_reference = False # if True and bianca is installed, store its map for the synthetic case in reference_folder
+
+#####
+
+def model_digest(model):
+    # hash of the classifier data files, so a reference is only used with the model it was made with
+    h = hashlib.sha256()
+    for name in sorted(f for f in os.listdir(os.path.dirname(model)) if f.startswith(os.path.basename(model))):
+        with open(os.path.join(os.path.dirname(model), name), 'rb') as f:
+            h.update(name.encode())
+            h.update(f.read())
+    return h.hexdigest()
+
+
+synthetic_run = flair is None
+reference_name = os.path.join(reference_folder, f'probability_map_{shape[0]}x{shape[1]}x{shape[2]}_{n_lesions}_{seed}.nii.gz')
+reference_info_name = reference_name.replace('.nii.gz', '.json')
+have_bianca = shutil.which('bianca') is not None
+
+if not have_bianca and not (synthetic_run and os.path.exists(reference_name)):
+    print('bianca is not on the PATH and there is no stored reference map for this case, so there is nothing to compare against')
+    print('The in-process classifier is unvalidated')
+    sys.exit(1)
+
+work_folder = tempfile.mkdtemp(prefix='bianca_parity_')
+
+if synthetic_run:
+    flair, t1, _, trans = synthetic.write_synthetic_case(work_folder, shape, n_lesions, seed)
+
+if have_bianca:
+    master = ugh.generate_bianca_master(work_folder, flair, t1, trans)
+    external_name = os.path.join(work_folder, 'probability_map.nii.gz')
+    ugh.execute_bianca(master=master, model=model, outname=external_name)
+    if synthetic_run and save_reference:
+        os.makedirs(reference_folder, exist_ok=True)
+        shutil.copyfile(external_name, reference_name)
+        with open(reference_info_name, 'w') as f:
+            json.dump({'model': os.path.basename(model), 'model_sha256': model_digest(model),
+                       'shape': list(shape), 'n_lesions': n_lesions, 'seed': seed}, f, indent=4)
+        print(f'Stored the reference map in {reference_name}')
+else:
+    with open(reference_info_name) as f:
+        reference_info = json.load(f)
+    if reference_info['model_sha256'] != model_digest(model):
+        print(f'The reference map {reference_name} was made with a different model, so it cannot be compared')
+        sys.exit(1)
+    print(f'bianca is not on the PATH. Comparing against the stored reference map {reference_name}')
+    external_name = reference_name
+external = nib.load(external_name).get_fdata()
+
+internal = bc.get_classifier(model).predict(flair, t1, trans)
+
+abs_diff = np.abs(external - internal)
+mask = nib.load(flair).get_fdata() > 0
+r = np.corrcoef(external[mask], internal[mask])[0,1]
+ext_bin = external >= 0.5
+int_bin = internal >= 0.5
+denom = ext_bin.sum() + int_bin.sum()
+dice = 2 * (ext_bin & int_bin).sum() / denom if denom else 1.0
+
+print(f'Mean absolute difference: {abs_diff[mask].mean():.4f}')
+print(f'Max absolute difference: {abs_diff.max():.4f}')
+print(f'Correlation within brain: {r:.4f}')
+print(f'Dice at 0.5: {dice:.4f}')
+
+shutil.rmtree(work_folder)
+
+if abs_diff[mask].mean() > max_mean_abs_diff or dice < min_dice:
+    print('FAILED: in-process probability map does not match bianca')
+    sys.exit(1)
+print('PASSED')
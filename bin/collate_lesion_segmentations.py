@@ -5,36 +5,63 @@ One off for preparing lesion segmentations for validation by a neuroradiologist
 """
 
 import os
-import shutil
+import sys
 
 import pandas as pd
 
+script_folder = os.path.dirname(os.path.realpath(__file__))
+repo_folder = os.path.dirname(script_folder)
+sys.path.append(os.path.join(repo_folder, 'neurosegment'))
+
+import catalog
+import collation
+
 
 master_folder = '/Users/manusdonahue/Documents/Sky/segmentations_sci/pt_data/'
 to_folder = '/Users/manusdonahue/Documents/Sky/lesion_training_data/'
 
 training_csv = '/Users/manusdonahue/Documents/Sky/segmentations_sci/pt_data/move_and_prepare_tabular_24-07-20-09_53.csv'
 
+catalog_file = None # if set, patients and their files come from this cohort catalog (see catalog.py) instead of training_csv and master_folder
 
-#####
+# files are cloned (copy-on-write) if the filesystem supports it and copied (and checksummed) otherwise. the
+# masks are edited by the reviewer, so they are never hard linked: a hard link is the same file as the master
+# mask, and saving over it would change the master. hard links left by earlier runs are replaced
+collation_methods = ('reflink', 'copy')
+collation_workers = 8 # number of files collated at once
 
+# the masks are corrected by the reviewer after they are collated, so a target that was changed after it was
+# collated (or that collation did not write) is kept, not replaced with the master. each target's size and
+# modification time is recorded in collation_record when it is collated. set overwrite_edited to True to replace
+# edited targets with the master anyway
+overwrite_edited = False
+collation_record = os.path.join(to_folder, '.collation_record.json')
 
-table = pd.read_csv(training_csv)
 
-is_one = table['training'] == 1
-is_nought = table['training'] == 0
-trutru = [any([i,j]) for i,j in zip(is_one, is_nought)]
+#####
+
 
-table = table[trutru]
+if catalog_file:
+    with catalog.Catalog(catalog_file) as cat:
+        pt_ids = cat.patients(training=[0, 1])
+        pt_artifacts = {pt_id: cat.artifacts(pt_id) for pt_id in pt_ids}
+else:
+    table = pd.read_csv(training_csv)
+    
+    is_one = table['training'] == 1
+    is_nought = table['training'] == 0
+    trutru = [any([i,j]) for i,j in zip(is_one, is_nought)]
+    
+    pt_ids = list(table[trutru]['id'])
 
 
-for i, row in table.iterrows():
-    pt_id = row['id']
+to_collate = [] # (source, target) for every file
+for i, pt_id in enumerate(pt_ids):
     
-    print(f'{i+1} of {len(table)}: {pt_id}')
+    print(f'{i+1} of {len(pt_ids)}: {pt_id}')
     
     target_folder = os.path.join(to_folder, pt_id)
-    os.mkdir(target_folder)
+    os.makedirs(target_folder, exist_ok=True) # unchanged files are skipped when rerunning
     
     pt_bin_folder = os.path.join(master_folder, pt_id, 'bin')
     pt_proc_folder = os.path.join(master_folder, pt_id, 'processed')
@@ -44,13 +71,33 @@ for i, row in table.iterrows():
     source_t1 = os.path.join(pt_bin_folder, 'axT1_raw.nii.gz')
     source_mask = os.path.join(pt_proc_folder, 'axFLAIR_mask.nii.gz')
     
-    target_flair = os.path.join(target_folder, 'axFLAIR.nii.gz')
-    target_flair_cor = os.path.join(target_folder, 'corFLAIR.nii.gz')
-    target_t1 = os.path.join(target_folder, 'axT1.nii.gz')
-    target_mask = os.path.join(target_folder, 'axFLAIR_mask.nii.gz')
+    if catalog_file:
+        found = pt_artifacts[pt_id]
+        missing = [kind for kind in ('flair_raw', 'cor_flair_raw', 't1_raw', 'mask') if kind not in found]
+        if missing:
+            raise Exception(f'{pt_id} has no {missing} in {catalog_file}')
+        source_flair = found['flair_raw']['path']
+        source_flair_cor = found['cor_flair_raw']['path']
+        source_t1 = found['t1_raw']['path']
+        source_mask = found['mask']['path']
+    
+    target_flair = os.path.join(target_folder, 'axFLAIR')
+    target_flair_cor = os.path.join(target_folder, 'corFLAIR')
+    target_t1 = os.path.join(target_folder, 'axT1')
+    target_mask = os.path.join(target_folder, 'axFLAIR_mask')
     
     sources = [source_flair, source_flair_cor, source_t1, source_mask]
     targets = [target_flair, target_flair_cor, target_t1, target_mask]
     
-    for s,t in zip(sources,targets):
-        shutil.copy(s,t)
+    # targets get the extension of their source, as raw scans may be uncompressed
+    to_collate.extend((s, t + collation.nifti_extension(s)) for s,t in zip(sources,targets))
+
+
+print(f'Collating {len(to_collate)} files')
+methods_used = collation.collate(to_collate, n_workers=collation_workers, methods=collation_methods,
+                                overwrite=overwrite_edited, record_file=collation_record)
+for method, n in methods_used.items():
+    print(f'\t{method}: {n}')
+if methods_used['kept']:
+    print(f'{methods_used["kept"]} targets were edited after they were collated, so they were kept rather than '
+          'replaced with the master (set overwrite_edited to replace them)')
@@ -5,12 +5,19 @@ Takes a list of pt names and preps their files to go into the lesion training fo
 """
 
 import os
-import shutil
+import sys
 from glob import glob
 
 import pandas as pd
 import numpy as np
 
+script_folder = os.path.dirname(os.path.realpath(__file__))
+repo_folder = os.path.dirname(script_folder)
+sys.path.append(os.path.join(repo_folder, 'neurosegment'))
+
+import catalog
+import collation
+
 
 master_folder = '/Users/manusdonahue/Documents/Sky/segmentations_sci/pt_data/'
 to_folder = '/Users/manusdonahue/Documents/Sky/lesion_training_data/'
@@ -19,6 +26,15 @@ mr_ids = [
           'SCD_TRANSP_P002_02'
           ]
 
+catalog_file = None # if set, source files are looked up in this cohort catalog (see catalog.py) instead of master_folder
+
+# files are cloned (copy-on-write) if the filesystem supports it, hard linked if not and both folders are on the
+# same filesystem, and copied (and checksummed) otherwise. hard links are the same file as the original, so
+# remove 'hardlink' if the collated files will be edited in place
+collation_methods = ('reflink', 'hardlink', 'copy')
+collation_workers = 8 # number of files collated at once
+collation_record = os.path.join(to_folder, '.collation_record.json') # shared with collate_lesion_segmentations.py
+
 
 #####
 
@@ -30,13 +46,14 @@ if dups:
     raise Exception(f'{dups} are already present in target folder')
 
 
+to_collate = [] # (source, target) for every file
 for i, pt_id in enumerate(mr_ids):
     
     
     print(f'{i+1} of {len(mr_ids)}: {pt_id}')
     
     target_folder = os.path.join(to_folder, pt_id)
-    os.mkdir(target_folder)
+    os.makedirs(target_folder, exist_ok=True) # unchanged files are skipped when rerunning
     
     pt_bin_folder = os.path.join(master_folder, pt_id, 'bin')
     pt_proc_folder = os.path.join(master_folder, pt_id, 'processed')
@@ -46,13 +63,30 @@ for i, pt_id in enumerate(mr_ids):
     source_t1 = os.path.join(pt_bin_folder, 'axT1_raw.nii.gz')
     #source_mask = os.path.join(pt_proc_folder, 'axFLAIR_mask.nii.gz')
     
-    target_flair = os.path.join(target_folder, 'axFLAIR.nii.gz')
-    target_flair_cor = os.path.join(target_folder, 'corFLAIR.nii.gz')
-    target_t1 = os.path.join(target_folder, 'axT1.nii.gz')
-    #target_mask = os.path.join(target_folder, 'axFLAIR_mask.nii.gz')
+    if catalog_file:
+        with catalog.Catalog(catalog_file) as cat:
+            found = cat.artifacts(pt_id)
+        missing = [kind for kind in ('flair_raw', 'cor_flair_raw', 't1_raw') if kind not in found]
+        if missing:
+            raise Exception(f'{pt_id} has no {missing} in {catalog_file}')
+        source_flair = found['flair_raw']['path']
+        source_flair_cor = found['cor_flair_raw']['path']
+        source_t1 = found['t1_raw']['path']
+    
+    target_flair = os.path.join(target_folder, 'axFLAIR')
+    target_flair_cor = os.path.join(target_folder, 'corFLAIR')
+    target_t1 = os.path.join(target_folder, 'axT1')
+    #target_mask = os.path.join(target_folder, 'axFLAIR_mask')
     
     sources = [source_flair, source_flair_cor, source_t1]
     targets = [target_flair, target_flair_cor, target_t1]
     
-    for s,t in zip(sources,targets):
-        shutil.copy(s,t)
+    # targets get the extension of their source, as raw scans may be uncompressed
+    to_collate.extend((s, t + collation.nifti_extension(s)) for s,t in zip(sources,targets))
+
+
+print(f'Collating {len(to_collate)} files')
+methods_used = collation.collate(to_collate, n_workers=collation_workers, methods=collation_methods,
+                                record_file=collation_record)
+for method, n in methods_used.items():
+    print(f'\t{method}: {n}')
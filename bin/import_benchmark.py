@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Times how long it takes to import each neurosegment module in a fresh
+interpreter, and lists the slowest imports each one pulls in (from
+python -X importtime). Use it to check that heavy dependencies such as
+TensorFlow, sympy, scikit-learn and scikit-image are only loaded when needed
+"""
+
+import os
+import sys
+import subprocess
+from time import time
+
+
+modules = ['preprocessing', 'bianca_helpers', 'ugli_helpers', 'gbs', 'ugli',
+           'bianca_classifier', 'segmentation_service']
+
+n_repeats = 3 # each module is imported this many times and the fastest run is reported
+n_slowest = 5 # number of slowest nested imports to list per module
+
+#####
+
+script_folder = os.path.dirname(os.path.realpath(__file__))
+repo_folder = os.path.dirname(script_folder)
+module_folder = os.path.join(repo_folder, 'neurosegment')
+
+env = os.environ.copy()
+env['PYTHONPATH'] = os.pathsep.join([module_folder, env.get('PYTHONPATH', '')])
+env['MPLBACKEND'] = 'Agg'
+
+
+def time_import(module):
+    """
+    Imports a module in a new interpreter and returns the wall time in seconds
+    and the -X importtime report (or None and the error if the import failed)
+    """
+    start = time()
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            env=env, capture_output=True, text=True)
+    elapsed = time() - start
+    if result.returncode != 0:
+        return None, result.stderr.strip().splitlines()[-1]
+    return elapsed, result.stderr
+
+
+def slowest_imports(report, n):
+    """
+    Parses a -X importtime report and returns the n imports with the largest
+    cumulative time as (microseconds, name) tuples
+    """
+    entries = []
+    for line in report.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        entries.append((int(cumulative_us), name.strip()))
+    return sorted(entries, reverse=True)[:n]
+
+
+baseline, _ = min((time_import('os') for i in range(n_repeats)), key=lambda x: x[0])
+print(f'Interpreter startup: {baseline:.3f} s (subtracted below)\n')
+
+for module in modules:
+    runs = [time_import(module) for i in range(n_repeats)]
+    failed = [r for r in runs if r[0] is None]
+    if failed:
+        print(f'{module}: import failed ({failed[0][1]})\n')
+        continue
+    elapsed, report = min(runs, key=lambda x: x[0])
+    print(f'{module}: {elapsed - baseline:.3f} s')
+    for cumulative_us, name in slowest_imports(report, n_slowest):
+        print(f'\t{cumulative_us/1e6:.3f} s\t{name}')
+    print()
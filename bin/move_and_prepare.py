@@ -33,11 +33,20 @@ from time import time
 import numpy as np
 import pandas as pd
 
+script_folder = os.path.dirname(os.path.realpath(__file__))
+repo_folder = os.path.dirname(script_folder)
+sys.path.append(os.path.join(repo_folder, 'neurosegment'))
+
+import tracing
+import prepare_helpers as ph
+
 
 # I am a liar this script is now accessed directly rather than as a bash command
 
 overwrite = 0
 
+trace_stages = False # if True, write per-stage timings for each patient to a JSON-lines trace (and a summary csv) in the target folder (or set NEUROSEGMENT_TRACE to the path of a trace file)
+
 infile = '/Users/manusdonahue/Documents/Sky/brain_lesion_masks/newest_additions/newest.csv'
 
 targetfolder = '/Users/manusdonahue/Documents/Sky/brain_lesion_masks/newest_additions/'
@@ -53,6 +62,8 @@ pt_id_cols = ['mr1_mr_id_real']
 
 # dcm2nii is an executable packaged with MRIcron that ca be ued to turn par-recs into NiFTIs
 path_to_dcm2nii = '/Users/manusdonahue/Documents/Sky/mricron/dcm2nii64'
+native_conversion = False # if True, convert PAR/RECs in-process with nibabel instead of calling dcm2nii. Check it against dcm2nii with bin/parrec_parity_check.py first
+conversion_workers = 4 # number of PAR/RECs converted at once per patient with native_conversion
 
 mni_standard = '/usr/local/fsl/data/standard/MNI152_T1_1mm_brain.nii.gz'
 
@@ -107,27 +118,16 @@ run_siena = False
 
 skullstrip_f_val = 0.15 # variable for the BET skullstripping algorithm
 
-#####
-
-def any_in_str(s, l):
-    """
-    Returns whether any of a list of substrings is in a string
-    
-
-    Parameters
-    ----------
-    s : str
-        string to look for substrings in.
-    l : list of str
-        substrings to check for in s.
+# PAR/RECs of upcoming patients are copied from filefolder while the current patient is processed
+prefetch_patients = 2 # how many patients ahead to copy
+max_in_flight_copies = 2 # how many files to copy at once
+max_staged_bytes = 8*1024**3 # how much copied but unprocessed data to allow
 
-    Returns
-    -------
-    bool
+# intermediates (_raw, _stripped, _mni, _registered) are written uncompressed and only the final images are gzipped
+scratch_folder = None # local folder to write intermediates to (one subfolder per patient, deleted once the patient is done). None writes them to each patient's bin folder
+finalize_workers = 4 # number of final images compressed at once
 
-    """
-    
-    return any([substr in s for substr in l])
+#####
 
 start = time()
 
@@ -161,6 +161,11 @@ def get_terminal(path):
 
 successful = 0
 
+# FSL commands whose outputs are intermediates write them uncompressed. this is set per command so
+# that the final outputs of FAST and SIENAX keep FSL's default, compressed, output type
+fsl_intermediate = 'FSLOUTPUTTYPE=NIFTI '
+
+
 
 """
 bash_input = sys.argv[1:]
@@ -198,6 +203,11 @@ now = datetime.now()
 dt_string = now.strftime("%d-%m-%y-%H+%M")
 message_file_name = os.path.join(targetfolder, f'move_and_prepare_messages_{dt_string}.txt')
 df_file_name = os.path.join(targetfolder, f'move_and_prepare_tabular_{dt_string}.csv')
+ledger_file_name = os.path.join(targetfolder, f'move_and_prepare_ledger_{dt_string}.jsonl') # one line per patient as they finish
+trace_file_name = os.path.join(targetfolder, f'move_and_prepare_trace_{dt_string}.jsonl')
+trace_summary_name = os.path.join(targetfolder, f'move_and_prepare_trace_summary_{dt_string}.csv')
+if trace_stages and not tracing.is_enabled():
+    tracing.enable(trace_file_name)
 message_file = open(message_file_name, 'w')
 message_file.write('Status messages for move_and_prepare\n\nSignatures')
 for key, val in signature_relationships.items():
@@ -214,6 +224,10 @@ for col in pt_id_cols:
     pt_ids.extend(of_interest)
 
 pt_ids = [x for x in pt_ids if str(x) != 'nan']
+n_listed = len(pt_ids)
+pt_ids = list(dict.fromkeys(pt_ids)) # an ID listed more than once is processed once
+if len(pt_ids) < n_listed:
+    print(f'{n_listed - len(pt_ids)} repeated patient IDs will only be processed once')
 
 # create a nested dict giving the the status of each pt id (found their file, found specific scans)
 inner_dict = {'found_pt':0}
@@ -222,11 +236,14 @@ for key in signature_relationships:
 inner_dict['successful'] = 0
 pt_status = {pt:inner_dict.copy() for pt in pt_ids}
 
-# start processing
-all_subdirectories = [x[0] for x in os.walk(filefolder)] # list of all possible subdirectories
+# find every patient's source files first, so that they can be staged ahead of processing
+with tracing.stage('walk_filefolder'):
+    all_subdirectories = [x[0] for x in os.walk(filefolder)] # list of all possible subdirectories
 
+matcher = ph.SignatureMatcher(signature_relationships)
+to_process = [] # (pt, sig_tracker) for each patient with all the files we need
 for i, pt in enumerate(pt_ids):
-        print(f'On patient {pt} ({i+1} of {len(pt_ids)})')
+        tracing.set_patient(pt)
         candidate_folders = [sub for sub in all_subdirectories if get_terminal(sub) == pt] # check if last subfolder is pt name
         n_cands = len(candidate_folders)
         pt_status[pt]['found_pt'] = n_cands
@@ -237,49 +254,29 @@ for i, pt in enumerate(pt_ids):
             continue
             
         master_output_folder = os.path.join(targetfolder, pt)
-        if os.path.exists(master_output_folder):
-            if overwrite:
-                shutil.rmtree(master_output_folder)
-            else:
-                print(f'--- pt {pt} exists in target folder and overwrite is disabled. skipping ---')
-                continue
+        if os.path.exists(master_output_folder) and not overwrite:
+            print(f'--- pt {pt} exists in target folder and overwrite is disabled. skipping ---')
+            continue
             
         
         has_required_files = True
         
-        bin_folder = os.path.join(master_output_folder, 'bin') # bin for working with data
-        processed_folder = os.path.join(master_output_folder, 'processed') # where we'll write the final data to
         acquired_folder = os.path.join(data_folder, 'Acquired') # where we're looking to pull data from
         
+        with tracing.stage('match_signatures'):
+            matches = matcher.match(acquired_folder) # lists the folder once for every signature
+        
         sig_tracker = {} # to store filepaths to files
         for signature, subdict in signature_relationships.items():
             
-            candidate_pars = []
-            candidate_recs = []
-            # note that the signature matching includes the full path. probably not a great idea
-            for subsig in signature:
-                
-                potential_pars = glob.glob(os.path.join(acquired_folder, f'*{subsig}*.PAR'))
-                potential_recs = glob.glob(os.path.join(acquired_folder, f'*{subsig}*.REC'))
-                
-                potential_pars = [f for f in potential_pars if not any_in_str(f, subdict['excl'])]
-                potential_recs = [f for f in potential_recs if not any_in_str(f, subdict['excl'])]
-                
-                candidate_pars.extend(potential_pars)
-                candidate_recs.extend(potential_recs)
-            
-            n_cand_files = (len(candidate_pars), len(candidate_recs))
+            # note that the exclusions are matched against the full path. probably not a great idea
+            found = matches[signature]
+            n_cand_files = (len(found['pars']), len(found['recs']))
             pt_status[pt][signature] = n_cand_files
-            if all([i >= 1 for i in n_cand_files]):
+            if found['pairs']: # a PAR and REC with the same name
                 
-                sig_tracker[signature] = {'original_par': candidate_pars[0]}
-                sig_tracker[signature]['original_rec'] = candidate_recs[0]
-                
-                moved_par = os.path.join(bin_folder, get_terminal(candidate_pars[0]))
-                moved_rec = os.path.join(bin_folder, get_terminal(candidate_recs[0]))
-                
-                sig_tracker[signature]['moved_par'] = moved_par
-                sig_tracker[signature]['moved_rec'] = moved_rec
+                sig_tracker[signature] = {'original_par': found['pairs'][0][0]}
+                sig_tracker[signature]['original_rec'] = found['pairs'][0][1]
                 
                 if any(i != 1 for i in n_cand_files):
                     print(f'warning: pt {pt} returned {n_cand_files} for {signature}. using first option')
@@ -290,36 +287,81 @@ for i, pt in enumerate(pt_ids):
         if not has_required_files: # if we don't have all the files specified, just move on
             continue    
         
+        to_process.append((pt, sig_tracker))
+
+# patients that will not be processed are done already
+ledger = ph.RunLedger(ledger_file_name)
+queued = {job[0] for job in to_process}
+for pt in pt_status:
+    if pt not in queued:
+        ledger.write(pt, pt_status[pt])
+
+# start copying the PAR/RECs of the first patients in the background
+stager = ph.SourceStager(os.path.join(targetfolder, '.staging'), max_in_flight=max_in_flight_copies,
+                         max_bytes=max_staged_bytes, lookahead=prefetch_patients)
+for pt, sig_tracker in to_process:
+    stager.submit(pt, [f for sig in sig_tracker.values() for f in (sig['original_par'], sig['original_rec'])])
+
+# start processing
+for i, (pt, sig_tracker) in enumerate(to_process):
+    try:
+        print(f'On patient {pt} ({i+1} of {len(to_process)})')
+        tracing.set_patient(pt)
+        
+        master_output_folder = os.path.join(targetfolder, pt)
+        if os.path.exists(master_output_folder):
+            shutil.rmtree(master_output_folder) # only patients allowed to be overwritten are still here
+        
+        bin_folder = os.path.join(master_output_folder, 'bin') # bin for working with data
+        processed_folder = os.path.join(master_output_folder, 'processed') # where we'll write the final data to
+        
         os.mkdir(master_output_folder)
         os.mkdir(bin_folder)
         os.mkdir(processed_folder)
+        work_folder = os.path.join(scratch_folder, pt) if scratch_folder else bin_folder # where intermediates are written
+        os.makedirs(work_folder, exist_ok=True)
         
         try:
+            # staged copies are moved into bin. sources on the same filesystem are converted where they are
+            staged = stager.claim(pt, bin_folder)
+            
             for signature, subdict in signature_relationships.items():
-                # move the file, convert to NiFTI and rename
-                shutil.copyfile(sig_tracker[signature]['original_par'], sig_tracker[signature]['moved_par'])
-                shutil.copyfile(sig_tracker[signature]['original_rec'], sig_tracker[signature]['moved_rec'])
+                # convert to NiFTI and rename
+                sig_tracker[signature]['moved_par'] = staged[sig_tracker[signature]['original_par']]
+                sig_tracker[signature]['moved_rec'] = staged[sig_tracker[signature]['original_rec']]
+                
+                sig_tracker[signature]['raw_nifti'] = os.path.join(work_folder, f'{subdict["basename"]}_raw.nii')
+                if native_conversion:
+                    continue # converted together below
+                
+                moved_par_without_ext = os.path.join(work_folder, get_terminal(sig_tracker[signature]['moved_par'])[:-4])
+                conversion_command = f'{path_to_dcm2nii} -a n -i n -d n -p n -e n -f y -v n -g n -o {work_folder} {sig_tracker[signature]["moved_par"]}'
                 
-                moved_par_without_ext = sig_tracker[signature]['moved_par'][:-4]
-                conversion_command = f'{path_to_dcm2nii} -a n -i n -d n -p n -e n -f y -v n -o {bin_folder} {sig_tracker[signature]["moved_par"]}'
+                with tracing.stage('dcm2nii', scan=subdict['basename']):
+                    with suppress_stdout():
+                        os.system(conversion_command)
                 
-                with suppress_stdout():
-                    os.system(conversion_command)
+                os.rename(f'{moved_par_without_ext}.nii', sig_tracker[signature]['raw_nifti'])
                 
-                sig_tracker[signature]['raw_nifti'] = os.path.join(bin_folder, f'{subdict["basename"]}_raw.nii.gz')
-                os.rename(f'{moved_par_without_ext}.nii.gz', sig_tracker[signature]['raw_nifti'])
+            if native_conversion:
+                to_convert = [(sig['moved_par'], sig['raw_nifti']) for sig in sig_tracker.values()]
+                with tracing.stage('parrec_to_nifti', n_scans=len(to_convert)):
+                    ph.convert_parrecs(to_convert, n_workers=conversion_workers)
         except:
             print(f'\n!!!!!!!!!! warning: encountered unexpected error while copying and converting images for pt {pt}. folder will be deleted !!!!!!!!!!\n')
             shutil.rmtree(master_output_folder)
+            if scratch_folder:
+                shutil.rmtree(work_folder, ignore_errors=True)
             continue
         
         # skullstripping
         for signature, subdict in signature_relationships.items():
             if subdict['skullstrip'] == 'yes':
-                sig_tracker[signature]['skullstripped_nifti'] = os.path.join(bin_folder, f'{subdict["basename"]}_stripped.nii.gz')
+                sig_tracker[signature]['skullstripped_nifti'] = os.path.join(work_folder, f'{subdict["basename"]}_stripped.nii')
                 
-                stripping_command = f"bet {sig_tracker[signature]['raw_nifti']} {sig_tracker[signature]['skullstripped_nifti']} -f {skullstrip_f_val}"
-                os.system(stripping_command)
+                stripping_command = f"{fsl_intermediate}bet {sig_tracker[signature]['raw_nifti']} {sig_tracker[signature]['skullstripped_nifti']} -f {skullstrip_f_val}"
+                with tracing.stage('bet', scan=subdict['basename']):
+                    os.system(stripping_command)
                 
             else:
                 sig_tracker[signature]['skullstripped_nifti'] = sig_tracker[signature]['raw_nifti']
@@ -330,27 +372,20 @@ for i, pt in enumerate(pt_ids):
                 master_ref = sig_tracker[signature]['skullstripped_nifti']
                 
                 omat_path = os.path.join(processed_folder, 'master2mni.mat')
-                mni_path = os.path.join(bin_folder, f'{subdict["basename"]}_mni.nii.gz')
-                omat_cmd = f'flirt -in {master_ref} -ref {mni_standard} -out {mni_path} -omat omat_path'
-                os.system(omat_cmd)
+                mni_path = os.path.join(work_folder, f'{subdict["basename"]}_mni.nii')
+                omat_cmd = f'{fsl_intermediate}flirt -in {master_ref} -ref {mni_standard} -out {mni_path} -omat {omat_path}'
+                with tracing.stage('flirt_mni', scan=subdict['basename']):
+                    os.system(omat_cmd)
                 
         for signature, subdict in signature_relationships.items():
             if subdict['register'] not in ('master', 'no'):
-                sig_tracker[signature]['registered_nifti'] = os.path.join(bin_folder, f'{subdict["basename"]}_registered.nii.gz')
-                register_command = f"flirt -in {sig_tracker[signature]['skullstripped_nifti']} -ref {master_ref} -out {sig_tracker[signature]['registered_nifti']}"
-                os.system(register_command)
+                sig_tracker[signature]['registered_nifti'] = os.path.join(work_folder, f'{subdict["basename"]}_registered.nii')
+                register_command = f"{fsl_intermediate}flirt -in {sig_tracker[signature]['skullstripped_nifti']} -ref {master_ref} -out {sig_tracker[signature]['registered_nifti']}"
+                with tracing.stage('flirt_register', scan=subdict['basename']):
+                    os.system(register_command)
             else:
                 sig_tracker[signature]['registered_nifti'] = sig_tracker[signature]['skullstripped_nifti']
                 
-        # move files to their final home :)
-        for signature, subdict in signature_relationships.items():
-            sig_tracker[signature]['final_nifti'] = os.path.join(processed_folder, f'{subdict["basename"]}.nii.gz')
-            shutil.copyfile(sig_tracker[signature]['registered_nifti'], sig_tracker[signature]['final_nifti'])
-                
-        pt_status[pt]['successful'] = 1
-        successful += 1
-        
-        
         # run FAST
         fast_folder = os.path.join(master_output_folder, 'fast')
         
@@ -362,18 +397,33 @@ for i, pt in enumerate(pt_ids):
             if len(param_dict['inputs']) > 1:
                 construction += f' -S {len(param_dict["inputs"])}'
             for sig in param_dict['inputs']:
-                construction += f' {sig_tracker[sig]["final_nifti"]}'
+                construction += f' {sig_tracker[sig]["registered_nifti"]}' # the uncompressed copy of the final image
                 
             print(f'Construction:\n{construction}')
-            os.system(construction)
+            with tracing.stage('fast', outputs=param_dict['baseout']):
+                os.system(construction)
             
         # run SIENA
         if run_siena:
             construction = f'sienax {sig_tracker[signature]["raw_nifti"]} -B "-f {skullstrip_f_val}"'
                 
             print(f'Construction:\n{construction}')
-            os.system(construction)
-            
+            with tracing.stage('sienax'):
+                os.system(construction)
+
+        # move files to their final home :)
+        # this comes last as the intermediates FAST and SIENA read are moved (and compressed) into processed
+        for signature, subdict in signature_relationships.items():
+            sig_tracker[signature]['final_nifti'] = os.path.join(processed_folder, f'{subdict["basename"]}.nii.gz')
+        to_finalize = [(sig['registered_nifti'], sig['final_nifti']) for sig in sig_tracker.values()]
+        with tracing.stage('finalize', n_scans=len(to_finalize)):
+            ph.finalize_niftis(to_finalize, n_workers=finalize_workers)
+        if scratch_folder:
+            shutil.rmtree(work_folder, ignore_errors=True)
+
+        pt_status[pt]['successful'] = 1
+        successful += 1
+
         """  
         # clean up
         # move files to their final home :)
@@ -388,7 +438,12 @@ for i, pt in enumerate(pt_ids):
         for f in folder_glob:
             shutil.rmtree(f)
         """
+    finally:
+        ledger.write(pt, pt_status[pt]) # logged as soon as the patient is done, whatever happened
+
 
+stager.close()
+ledger.close()
 
 # write status log
             
@@ -398,12 +453,15 @@ runtime = end-start
 runtime_minutes_pretty = round(runtime/60, 2)
         
 message_file.write(f'Successfully preprocessed {successful} of {len(pt_ids)} scans from {n_unique_pts} unique patients. Running time: {runtime_minutes_pretty} minutes\n\n\n')
-df = pd.DataFrame()
 for key, val in pt_status.items():
     message_file.write(f'Patient {key}\n\t{str(val)}\n\n')
-    appender = pd.Series(val, name=key)
-    df = df.append(appender)
     
+df = ph.read_ledger(ledger_file_name).drop(columns='logged')
 
 message_file.close()
-df.to_csv(df_file_name)
\ No newline at end of file
+df.to_csv(df_file_name)
+
+
+if trace_stages and os.path.exists(trace_file_name): # not written if NEUROSEGMENT_TRACE already chose a trace file
+    tracing.disable()
+    tracing.summarize(trace_file_name, trace_summary_name)
\ No newline at end of file
@@ -7,28 +7,43 @@ One off for adding transformation matrices to a move_and_prepare output folder
 """
 
 import os
+import sys
 import time
 
+script_folder = os.path.dirname(os.path.realpath(__file__))
+repo_folder = os.path.dirname(script_folder)
+sys.path.append(os.path.join(repo_folder, 'neurosegment'))
+
+import tracing
+
 master_folder = '/Users/manusdonahue/Documents/Sky/segmentations_sci/pt_data'
 processed_folder = 'processed'
 bin_folder = 'bin'
 master_scan = 'axFLAIR'
 mni_standard = '/usr/local/fsl/data/standard/MNI152_T1_1mm_brain.nii.gz'
 
+trace_stages = False # if True, write per-patient timings to a JSON-lines trace (and a summary csv) in master_folder (or set NEUROSEGMENT_TRACE to the path of a trace file)
+
 
 all_subs = [f.path for f in os.scandir(master_folder) if f.is_dir()]
 n = len(all_subs)
 
+trace_file_name = os.path.join(master_folder, f'omat_generation_trace_{time.strftime("%d-%m-%y-%H+%M")}.jsonl')
+if trace_stages and not tracing.is_enabled():
+    tracing.enable(trace_file_name)
+
 start = time.time()
 
 for i, sub in enumerate(all_subs):
     print(f'\n{sub}: {i+1} of {n}')
+    tracing.set_patient(os.path.basename(sub))
     the_scan = os.path.join(master_folder, sub, processed_folder, f'{master_scan}.nii.gz')
     omat_path = os.path.join(master_folder, sub, processed_folder, 'master2mni.mat')
     mni_path = os.path.join(master_folder, sub, bin_folder, f'{master_scan}_mni.nii.gz')
     omat_cmd = f'flirt -in {the_scan} -ref {mni_standard} -out {mni_path} -omat {omat_path}'
     #print(omat_cmd)
-    os.system(omat_cmd)
+    with tracing.stage('flirt_mni'):
+        os.system(omat_cmd)
     
     mid = time.time()
     elap = mid - start
@@ -41,4 +56,9 @@ for i, sub in enumerate(all_subs):
     pretty_time_remaining = round(time_remaining/60,1)
     
     print(f'{pretty_elap} minutes elapsed')
-    print(f'{pretty_time_remaining} minutes remaining (estimated)')
\ No newline at end of file
+    print(f'{pretty_time_remaining} minutes remaining (estimated)')
+
+
+if trace_stages and os.path.exists(trace_file_name): # not written if NEUROSEGMENT_TRACE already chose a trace file
+    tracing.disable()
+    tracing.summarize(trace_file_name, trace_file_name.replace('.jsonl', '_summary.csv'))
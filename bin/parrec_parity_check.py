@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Checks that prepare_helpers.convert_parrec (used by the move_and_prepare
+scripts when native_conversion is True) writes the same NIfTI as dcm2nii:
+the same shape, voxel order and orientation (affine), data type and, after
+scaling, the same voxel values.
+
+Set par_files to PAR files from the scanner (each with its REC next to it)
+and path_to_dcm2nii to the dcm2nii the move_and_prepare scripts use. Only
+turn native_conversion on once this passes on scans from every protocol
+"""
+
+import os
+import sys
+import glob
+import shutil
+import tempfile
+import subprocess
+
+import numpy as np
+import nibabel as nib
+
+script_folder = os.path.dirname(os.path.realpath(__file__))
+repo_folder = os.path.dirname(script_folder)
+sys.path.append(os.path.join(repo_folder, 'neurosegment'))
+
+import prepare_helpers as ph
+
+
+par_files = [] # PAR files to convert both ways
+path_to_dcm2nii = '/Users/manusdonahue/Documents/Sky/mricron/dcm2nii64'
+
+affine_tolerance = 1e-3 # mm
+max_rel_diff = 1e-3 # largest voxel difference allowed, as a fraction of the largest dcm2nii value
+
+#####
+
+if not par_files:
+    print('Set par_files to the PAR/RECs to compare')
+    sys.exit(1)
+if shutil.which(path_to_dcm2nii) is None:
+    print(f'dcm2nii was not found at {path_to_dcm2nii}, so there is nothing to compare against')
+    sys.exit(1)
+
+failed = []
+for par in par_files:
+    name = os.path.basename(par)
+    with tempfile.TemporaryDirectory(prefix='parrec_parity_') as work_folder:
+        staged = os.path.join(work_folder, name)
+        shutil.copyfile(par, staged)
+        shutil.copyfile(f'{par[:-4]}.REC', f'{staged[:-4]}.REC')
+
+        subprocess.run([path_to_dcm2nii, '-a', 'n', '-i', 'n', '-d', 'n', '-p', 'n', '-e', 'n', '-f', 'y',
+                        '-v', 'n', '-g', 'n', '-o', work_folder, staged], capture_output=True)
+        external_name = f'{staged[:-4]}.nii'
+        if not os.path.exists(external_name):
+            candidates = glob.glob(os.path.join(work_folder, '*.nii'))
+            if len(candidates) != 1:
+                print(f'{name}: could not find the dcm2nii output')
+                failed.append(name)
+                continue
+            external_name = candidates[0]
+
+        native_name = ph.convert_parrec(staged, os.path.join(work_folder, 'native.nii.gz'))
+
+        external = nib.load(external_name)
+        native = nib.load(native_name)
+
+        problems = []
+        if external.shape != native.shape:
+            problems.append(f'shape {native.shape} vs {external.shape}')
+        else:
+            ext_data = external.get_fdata()
+            nat_data = native.get_fdata()
+            rel_diff = np.abs(ext_data - nat_data).max() / max(np.abs(ext_data).max(), 1e-12)
+            if rel_diff > max_rel_diff:
+                problems.append(f'voxel values differ by up to {rel_diff:.2e} of the maximum')
+        if not np.allclose(external.affine, native.affine, atol=affine_tolerance):
+            problems.append(f'affine\n{native.affine}\nvs\n{external.affine}')
+        if external.get_data_dtype() != native.get_data_dtype():
+            problems.append(f'dtype {native.get_data_dtype()} vs {external.get_data_dtype()}')
+
+        if problems:
+            print(f'{name}: ' + '; '.join(problems))
+            failed.append(name)
+        else:
+            print(f'{name}: matches')
+
+if failed:
+    print(f'FAILED: {len(failed)} of {len(par_files)} conversions differ from dcm2nii')
+    sys.exit(1)
+print('PASSED')
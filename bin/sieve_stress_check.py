@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Checks that GBS sieving gives the same results when many masks are sieved
+concurrently from a thread pool as when they are sieved one at a time, and
+that sieving leaves gbs.PROPERTIES and its inputs untouched.
+
+Synthetic lesion masks are used (see synthetic.py). By default the model is
+trained on a separate synthetic case, so the check runs offline; set
+model_file to check a pickled model (e.g., gbs.default_model_path()) instead
+"""
+
+import os
+import sys
+import random
+import tempfile
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+script_folder = os.path.dirname(os.path.realpath(__file__))
+repo_folder = os.path.dirname(script_folder)
+sys.path.append(os.path.join(repo_folder, 'neurosegment'))
+
+import gbs
+import synthetic
+
+
+model_file = None # leave as None to train a model on a synthetic case
+
+shape = (128, 128, 40)
+n_masks = 12 # distinct masks
+n_lesions = 40 # lesions per mask
+repeats = 4 # times each mask is sieved concurrently
+n_workers = 8
+seed = 0
+
+#####
+
+properties_before = list(gbs.PROPERTIES)
+
+if model_file is None:
+    training = synthetic.synthetic_case(shape, 60, seed=seed+1000)['lesions'].astype(int)
+    with tempfile.TemporaryDirectory(prefix='gbs_stress_') as folder:
+        model, params = gbs.train_and_save(gbs.generate_properties(training), os.path.join(folder, 'gbs_stress.pkl'))
+    sieve = gbs.Sieve(model, params)
+else:
+    sieve = gbs.Sieve.from_file(model_file)
+
+masks = [synthetic.synthetic_case(shape, n_lesions, seed=seed+i)['lesions'].astype(int) for i in range(n_masks)]
+originals = [m.copy() for m in masks]
+
+start = perf_counter()
+serial = [sieve(m) for m in masks]
+serial_time = perf_counter() - start
+
+# the same masks in a shuffled order, each several times, half of them through sieve_image
+jobs = [i for i in range(n_masks) for r in range(repeats)]
+random.Random(seed).shuffle(jobs)
+
+def run(job):
+    n, i = job
+    if n % 2:
+        return i, gbs.sieve_image(masks[i], (sieve.model, sieve.params))
+    return i, sieve(masks[i])
+
+start = perf_counter()
+with ThreadPoolExecutor(max_workers=n_workers) as pool:
+    parallel = list(pool.map(run, enumerate(jobs)))
+parallel_time = perf_counter() - start
+
+mismatches = [i for i, result in parallel if not np.array_equal(result, serial[i])]
+modified = [i for i in range(n_masks) if not np.array_equal(masks[i], originals[i])]
+removed = sum(int(m.sum() - s.sum()) for m, s in zip(masks, serial))
+
+print(f'Serial: {n_masks} masks in {serial_time:.2f} s')
+print(f'Parallel: {len(jobs)} sieves on {n_workers} threads in {parallel_time:.2f} s')
+print(f'Voxels removed by sieving: {removed}')
+
+failed = False
+if mismatches:
+    print(f'FAILED: {len(mismatches)} parallel results differ from the serial ones (masks {sorted(set(mismatches))})')
+    failed = True
+if modified:
+    print(f'FAILED: masks {modified} were modified by sieving')
+    failed = True
+if gbs.PROPERTIES != properties_before:
+    print(f'FAILED: gbs.PROPERTIES changed from {properties_before} to {gbs.PROPERTIES}')
+    failed = True
+
+if failed:
+    sys.exit(1)
+print('PASSED')
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Checks that prepare_helpers.SignatureMatcher finds the same PAR/RECs as the
+glob('*sig*.PAR') searches it replaced in the move_and_prepare scripts.
+
+A folder of empty PAR/RECs is written with scans that match each signature,
+scans that an exclusion rules out, an unpaired PAR and the AppleDouble
+._<scan>.PAR/.REC files macOS writes on external drives (which glob skips,
+and which sort first, so they would be picked over the scan)
+"""
+
+import os
+import sys
+import glob
+import tempfile
+
+script_folder = os.path.dirname(os.path.realpath(__file__))
+repo_folder = os.path.dirname(script_folder)
+sys.path.append(os.path.join(repo_folder, 'neurosegment'))
+
+import prepare_helpers as ph
+
+
+signature_relationships = {('FLAIR_cor','FLAIR_COR'):
+                              {'basename': 'corFLAIR', 'register': 'no', 'skullstrip': 'no', 'excl':['AX','ax','axial','AXIAL']},
+                          ('FLAIR_AX', 'T2W_FLAIR'):
+                              {'basename': 'axFLAIR', 'register': 'master', 'skullstrip': 'no', 'excl':['cor','COR','coronal','CORONAL']},
+                          ('3DT1', 'T1W_3D'):
+                              {'basename': 'axT1', 'register': 'no', 'skullstrip': 'no', 'excl':['FLAIR']},
+                          ('MIP*MRA_COW',):
+                              {'basename': 'mip', 'register': 'no', 'skullstrip': 'no', 'excl':[]},
+                          }
+
+stems = ['Pt_01.WIP_FLAIR_AX_3MM', 'Pt_02.WIP_T2W_FLAIR', 'Pt_03.WIP_FLAIR_COR', 'Pt_04.WIP_FLAIR_cor_ax',
+         'Pt_05.WIP_3DT1', 'Pt_06.WIP_T1W_3D_FLAIR', 'Pt_07.MIP_head_MRA_COW', 'Pt_08.survey']
+unpaired_pars = ['Pt_09.WIP_3DT1_repeat']
+hidden = ['._Pt_01.WIP_FLAIR_AX_3MM', '._Pt_00.WIP_3DT1', '.Pt_00.WIP_T2W_FLAIR']
+
+#####
+
+
+def glob_search(folder, signature, excl):
+    # the searches SignatureMatcher replaced
+    pars, recs = [], []
+    for subsig in signature:
+        pars.extend(glob.glob(os.path.join(folder, f'*{subsig}*.PAR')))
+        recs.extend(glob.glob(os.path.join(folder, f'*{subsig}*.REC')))
+    pars = sorted(p for p in set(pars) if not any(e in p for e in excl))
+    recs = sorted(r for r in set(recs) if not any(e in r for e in excl))
+    return pars, recs
+
+
+failed = False
+with tempfile.TemporaryDirectory(prefix='signature_match_') as folder:
+    for stem in stems + hidden:
+        for ext in ('PAR', 'REC'):
+            open(os.path.join(folder, f'{stem}.{ext}'), 'w').close()
+    for stem in unpaired_pars:
+        open(os.path.join(folder, f'{stem}.PAR'), 'w').close()
+
+    found = ph.SignatureMatcher(signature_relationships).match(folder)
+
+    for signature, subdict in signature_relationships.items():
+        expected_pars, expected_recs = glob_search(folder, signature, subdict['excl'])
+        got = found[signature]
+        if got['pars'] != expected_pars or got['recs'] != expected_recs:
+            print(f'FAILED: {signature} found {got["pars"]} and {got["recs"]}, glob found {expected_pars} and {expected_recs}')
+            failed = True
+        if any(os.path.basename(f).startswith('.') for pair in got['pairs'] for f in pair):
+            print(f'FAILED: {signature} paired a hidden file: {got["pairs"]}')
+            failed = True
+        print(f'{signature}: {[os.path.basename(par) for par, rec in got["pairs"]]}')
+
+if failed:
+    sys.exit(1)
+print('PASSED')
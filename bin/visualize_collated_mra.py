@@ -2,58 +2,51 @@
 
 import os
 import sys
-import getopt
 import glob
-import shutil
-from datetime import datetime
-from contextlib import contextmanager
-from time import time
 
-import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib
-import nibabel as nib
+
+script_folder = os.path.dirname(os.path.realpath(__file__))
+repo_folder = os.path.dirname(script_folder)
+sys.path.append(os.path.join(repo_folder, 'neurosegment'))
+
+import qc_render
 
 
 data_master = '/Users/manusdonahue/Documents/Sky/nigeria_mra/data/'
 target = '/Users/manusdonahue/Documents/Sky/nigeria_mra/vis/'
 
+n_workers = None # number of patients rendered at once. None uses every CPU
+contact_sheet = 'index.html' # HTML page in target that shows every image. None skips it
+
+
+
+#####
+
 
+if __name__ == '__main__': # patients are rendered in worker processes that import this script
+    folder_glob = np.array(glob.glob(os.path.join(data_master, '*/'))) # list of all possible subdirectories
 
-##### 
-
-
-folder_glob = np.array(glob.glob(os.path.join(data_master, '*/'))) # list of all possible subdirectories
-
-for f in folder_glob:
-    mr_id = os.path.basename(os.path.normpath(f))
-    print(f'On {mr_id}')
-    fig_name = os.path.join(target,f'{mr_id}.png')
-
-    head_mra_name = os.path.join(f,'headMRA.nii.gz')
-    head_mra_mip_name = os.path.join(f,'headMRA_mip.nii.gz')
-    
-    names = [head_mra_name, head_mra_mip_name]
-    titles = ['Head MRA', 'Head MRA MIP']
-    
-    fig, ax = plt.subplots(1,2)
-    
-    for n,t,a in zip(names,titles,ax):
-        a.set_title(t)
-        a.axis('off')
-        try:
-            data = nib.load(n)
-            mat = data.get_fdata()
-            dims = mat.shape
-            z = dims[2]
-            half = int(z/2)
-            
-            sli = np.rot90(mat[:,:,half].T,2)
-            a.imshow(sli, cmap=matplotlib.cm.gray)
-        except FileNotFoundError:
+    jobs = []
+    for f in sorted(folder_glob):
+        mr_id = os.path.basename(os.path.normpath(f))
+        fig_name = os.path.join(target,f'{mr_id}.png')
+
+        head_mra_name = os.path.join(f,'headMRA.nii.gz')
+        head_mra_mip_name = os.path.join(f,'headMRA_mip.nii.gz')
+
+        names = [head_mra_name, head_mra_mip_name]
+        titles = ['Head MRA', 'Head MRA MIP']
+
+        jobs.append((mr_id, list(zip(names, titles)), fig_name))
+
+    print(f'Rendering {len(jobs)} patients')
+    results = qc_render.render_cohort(jobs, n_workers=n_workers)
+
+    for r in results:
+        for n in r['missing']:
             print(f'File {n} does not exist')
-    plt.tight_layout()
-    fig.savefig(fig_name)
-        
-    
\ No newline at end of file
+
+    if contact_sheet:
+        sheet = qc_render.write_contact_sheet(results, os.path.join(target, contact_sheet), title='Collated MRA')
+        print(f'Contact sheet: {sheet}')
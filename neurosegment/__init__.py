@@ -4,6 +4,15 @@
 tells Python that this is a package
 """
 
+import os
+import sys
+
+# the modules import each other by name, so their folder must be on the path
+# (e.g., for python -m neurosegment)
+_folder = os.path.dirname(os.path.realpath(__file__))
+if _folder not in sys.path:
+    sys.path.append(_folder)
+
 from preprocessing import *
 from bianca_helpers import *
 from ugli_helpers import *
\ No newline at end of file
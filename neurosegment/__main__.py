@@ -3,62 +3,102 @@
 """
 Main entry point for neurosegment
 
+    python -m neurosegment sieve 'masks/*.nii.gz' -o sieved/
+    python -m neurosegment catalog query cohort.db --having flair t1
+    python -m neurosegment midsagittal scan.nii --slice 23
+
 """
 
+import os
+import sys
+import argparse
+
+script_folder = os.path.dirname(os.path.realpath(__file__))
+if script_folder not in sys.path:
+    sys.path.append(script_folder)
+
+
+def midsagittal_demo(img_path, slice_num=23, px=238, py=242):
+    """
+    Plots the preprocessing steps for midsagittal plane scoring on one slice,
+    the intersection of an arbitrary plane with it and the reflection of a
+    point across that line, then scores the plane
+    """
+    import sympy as sp
+    import matplotlib.pyplot as plt
+
+    from preprocessing import read_nifti, skull_strip, gradient_magnitude, threshold_by_percentile
+    from preprocessing import calculate_projected_plane_coords, is_partnered, intersection_of_plane_with_slice
+    from preprocessing import score_midsagittal
+
+    arbitrary_plane = sp.Plane((0,0,10),(300,300,20),(300,300,10))
 
-import sympy as sp
-import matplotlib.pyplot as plt
+    img = read_nifti(img_path)
+    stripped_img, mask = skull_strip(img)
+    sobel_img = gradient_magnitude(stripped_img, axes=(0,1))
+    edge_img, abs_thresh = threshold_by_percentile(sobel_img, 3, invert=True, mask=mask)
 
-from preprocessing import read_nifti, skull_strip, sobelize, binary_by_percentile_threshold
-from preprocessing import calculate_projected_plane_coords, is_partnered, intersection_of_plane_with_slice
-from preprocessing import score_midsagittal
 
+    # note that when plotting with imshow, imaging conventions for coordinates are used
+    # essentially x and y are swapped and the origin is at the upper left corner
 
-px, py = (238, 242)
+    raw_data = img[:,:,slice_num]
+    fig, ax = plt.subplots(2,2)
+    ax[0][0].imshow(raw_data, interpolation='nearest', cmap='gray')
 
-arbitrary_plane = sp.Plane((0,0,10),(300,300,20),(300,300,10))
-slice_num = 23
-img_path = r'/Users/manusdonahue/Documents/Sky/Infarcts/Donahue_114402.XMLPARREC.dcm2niix/NIFTI/Donahue_114402.04.01.14-42-52.WIP_MJD_FLAIR_AX_3MM_SENSE.01.nii'
+    stripped_data = stripped_img[:,:,slice_num]
+    ax[1][0].imshow(stripped_data, interpolation='nearest', cmap='gray')
 
+    sobel_data = sobel_img[:,:,slice_num]
+    ax[0][1].imshow(sobel_data, interpolation='nearest', cmap='gray')
 
-img = read_nifti(img_path)
-stripped_img, mask = skull_strip(img)
-sobel_img = sobelize(stripped_img)
-edge_img, abs_thresh = binary_by_percentile_threshold(sobel_img, 3, invert=True)
+    edge_data = edge_img[:,:,slice_num]
+    ax[1][1].imshow(edge_data, interpolation='nearest', cmap='gray')
 
+    exes, whys = calculate_projected_plane_coords(slice_num, arbitrary_plane)
+    plt.plot(whys,exes)
 
-# note that when plotting with imshow, imaging conventions for coordinates are used
-# essentially x and y are swapped and the origin is at the upper left corner
 
-raw_data = img[:,:,slice_num]
-fig, ax = plt.subplots(2,2)
-ax[0][0].imshow(raw_data, interpolation='nearest', cmap='gray')
+    the_line = intersection_of_plane_with_slice(slice_num, arbitrary_plane)
+    reflected = sp.Point(px,py).reflect(the_line)
+    rx, ry = reflected[0], reflected[1]
 
-stripped_data = stripped_img[:,:,slice_num]
-ax[1][0].imshow(stripped_data, interpolation='nearest', cmap='gray')
 
-sobel_data = sobel_img[:,:,slice_num]
-ax[0][1].imshow(sobel_data, interpolation='nearest', cmap='gray')
+    plt.scatter(py, px, color='red')
+    plt.scatter(ry, rx, color='blue')
 
-edge_data = edge_img[:,:,slice_num]
-ax[1][1].imshow(edge_data, interpolation='nearest', cmap='gray')
+    plt.show()
 
-exes, whys = calculate_projected_plane_coords(slice_num, arbitrary_plane)
-plt.plot(whys,exes)
+    isp = is_partnered((px,py), edge_data, the_line)
+    print(isp)
 
+    return score_midsagittal(edge_img, arbitrary_plane, None)
 
-the_line = intersection_of_plane_with_slice(slice_num, arbitrary_plane)
-reflected = sp.Point(px,py).reflect(the_line)
-rx, ry = reflected[0], reflected[1]
 
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
 
-plt.scatter(py, px, color='red')
-plt.scatter(ry, rx, color='blue')
+    parser = argparse.ArgumentParser(prog='neurosegment')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('sieve', add_help=False, help='sieve binary lesion masks with GBS')
+    commands.add_parser('catalog', add_help=False, help='sync or query a cohort catalog')
+    demo_parser = commands.add_parser('midsagittal', help='plot the midsagittal scoring steps on one slice')
+    demo_parser.add_argument('img_path')
+    demo_parser.add_argument('--slice', type=int, default=23)
+    demo_parser.add_argument('--point', type=int, nargs=2, default=(238, 242))
 
-plt.show()
+    # subcommands with their own parsers get the rest of the arguments
+    if argv and argv[0] == 'sieve':
+        import batch_sieve
+        return batch_sieve.main(argv[1:])
+    if argv and argv[0] == 'catalog':
+        import catalog
+        return catalog.main(argv[1:])
 
-isp = is_partnered((px,py), edge_data, the_line)
-print(isp)
+    args = parser.parse_args(argv)
+    print(midsagittal_demo(args.img_path, args.slice, *args.point))
+    return 0
 
-sc = score_midsagittal(edge_img, arbitrary_plane, None)
 
+if __name__ == '__main__': # the sieve's worker processes re-import this module
+    sys.exit(main())
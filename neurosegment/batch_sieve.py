@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Sieves many binary lesion masks with GBS, headless
+
+The model is loaded once, up front, so a missing or unreadable model fails
+before any work starts. Masks are then sieved in a process pool: each worker
+receives the model once, when it starts, and then sieves one mask after another. For each mask, the sieved
+mask (<name>_sieved.nii.gz) and a table of its lesions with whether each was
+accepted or rejected (<name>_lesions.csv) are written to the output folder,
+along with a summary of every mask (sieve_summary.csv). Run it with
+
+    python -m neurosegment sieve 'masks/*/bianca_mask.nii.gz' -o sieved/
+
+or call sieve_files from under an if __name__ == '__main__' guard
+"""
+
+import os
+import sys
+import glob
+import argparse
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+import pandas as pd
+import nibabel as nib
+
+import gbs
+import tracing
+
+
+SUMMARY_NAME = 'sieve_summary.csv'
+
+_sieve = None # the worker's gbs.Sieve, set by _init_worker
+
+
+def mask_stem(path):
+    """
+    Returns the name of a mask without its folder or extension
+    """
+    name = os.path.basename(path)
+    for ext in ('.nii.gz', '.nii'):
+        if name.endswith(ext):
+            return name[:-len(ext)]
+    return os.path.splitext(name)[0]
+
+
+def output_names(mask_path, out_folder, name=None):
+    """
+    Returns the paths of the sieved mask and the lesion table for a mask
+    """
+    name = name or mask_stem(mask_path)
+    return (os.path.join(out_folder, f'{name}_sieved.nii.gz'),
+            os.path.join(out_folder, f'{name}_lesions.csv'))
+
+
+def expand_masks(patterns, list_file=None):
+    """
+    Lists the masks to sieve
+
+
+    Parameters
+    ----------
+    patterns : list of str
+        paths or glob patterns (recursive ** is allowed).
+    list_file : pathlike or None, optional
+        a text file with one path or pattern per line. The default is None.
+
+    Returns
+    -------
+    list of paths, in the order given, without duplicates
+
+    """
+    patterns = list(patterns)
+    if list_file:
+        with open(list_file) as f:
+            patterns.extend(line.strip() for line in f if line.strip() and not line.startswith('#'))
+
+    masks = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern, recursive=True))
+        if not matches and not glob.has_magic(pattern):
+            matches = [pattern] # reported as missing when it is sieved
+        masks.extend(matches)
+    return list(dict.fromkeys(masks))
+
+
+def unique_names(masks):
+    """
+    Names each mask's outputs after its file, adding as many of its folders as
+    it takes to tell apart masks that share a file name (e.g., <pt>_bianca_mask
+    for pt_data/<pt>/bianca_mask.nii.gz), and an index as a last resort
+    """
+    stems = [mask_stem(m) for m in masks]
+    folders = [os.path.dirname(os.path.abspath(m)).strip(os.sep).split(os.sep) for m in masks]
+    depths = [0] * len(masks)
+
+    def name(i):
+        parts = folders[i][len(folders[i]) - depths[i]:] if depths[i] else []
+        return '_'.join(parts + [stems[i]])
+
+    names = [name(i) for i in range(len(masks))]
+    while True:
+        counts = pd.Series(names).value_counts()
+        colliding = [i for i, n in enumerate(names) if counts[n] > 1 and depths[i] < len(folders[i])]
+        if not colliding:
+            break
+        for i in colliding:
+            depths[i] += 1
+            names[i] = name(i)
+
+    counts = pd.Series(names).value_counts()
+    seen = {}
+    for i, n in enumerate(names):
+        if counts[n] > 1:
+            seen[n] = seen.get(n, 0) + 1
+            names[i] = f'{n}_{seen[n]}'
+    return names
+
+
+def load_sieve(model_file=None):
+    """
+    Loads the sieve for a run, raising an Exception that names the model if
+    it is missing or cannot be unpickled (e.g., it was pickled by an
+    incompatible scikit-learn)
+    """
+    if model_file is None:
+        model_file = gbs.default_model_path()
+    try:
+        return gbs.Sieve.from_file(model_file)
+    except Exception as e:
+        raise Exception(f'Could not load the GBS model {model_file} ({type(e).__name__}: {e}). '
+                        'Retrain it with gbs_main.py or pass another with --model') from e
+
+
+def _init_worker(sieve):
+    global _sieve
+    _sieve = sieve
+
+
+def sieve_file(mask_path, sieved_name, table_name, sieve=None):
+    """
+    Sieves one mask and writes the sieved mask and its lesion table
+
+
+    Parameters
+    ----------
+    mask_path : pathlike
+        the binary mask. Any nonzero voxel is lesion.
+    sieved_name : pathlike
+        where to write the sieved mask, as uint8 with the mask's header.
+    table_name : pathlike
+        where to write the lesion table: one row per lesion with its label,
+        slice, features, the model's prediction and whether it was accepted.
+    sieve : gbs.Sieve or None, optional
+        the sieve. The default is None, which uses the worker's.
+
+    Returns
+    -------
+    A dict summarizing the mask
+
+    """
+    sieve = sieve or _sieve
+    start = perf_counter()
+    with tracing.stage('sieve_file', mask=os.path.basename(mask_path)):
+        img = nib.load(mask_path)
+        im = np.asarray(img.dataobj) > 0
+        sieved, lesions = sieve.sieve(im, return_lesions=True)
+
+        lesions['accepted'] = lesions['prediction'] == 1
+        lesions.to_csv(table_name, index=False)
+
+        header = img.header.copy()
+        header.set_data_dtype(np.uint8)
+        out = nib.Nifti1Image(sieved.astype(np.uint8), img.affine, header)
+        part = f'{sieved_name}.part.nii.gz' # written whole before it takes the final name
+        nib.save(out, part)
+        os.replace(part, sieved_name)
+
+    return {'mask': mask_path,
+            'sieved': sieved_name,
+            'lesions': len(lesions),
+            'rejected': int((~lesions['accepted']).sum()),
+            'voxels_before': int(im.sum()),
+            'voxels_after': int(sieved.sum()),
+            'n_voxels': im.size,
+            'seconds': perf_counter() - start,
+            'error': None}
+
+
+def _sieve_job(job):
+    mask_path, sieved_name, table_name = job
+    try:
+        return sieve_file(mask_path, sieved_name, table_name)
+    except Exception as e: # one bad mask shouldn't stop the archive
+        return {'mask': mask_path, 'sieved': None, 'error': f'{type(e).__name__}: {e}'}
+
+
+def sieve_files(masks, out_folder, model_file=None, n_workers=None, skip_existing=False, verbose=True, sieve=None):
+    """
+    Sieves many masks in a process pool with sieve_file
+
+
+    Parameters
+    ----------
+    masks : list of pathlike
+        the binary masks.
+    out_folder : pathlike
+        where the outputs go. It is created if needed.
+    model_file : pathlike or None, optional
+        a pickled model and params from gbs.train_and_save. The default is
+        None, which uses the default model.
+    n_workers : int or None, optional
+        number of masks sieved at once. The default is None, which uses the
+        number of CPUs.
+    skip_existing : bool, optional
+        if True, masks whose sieved mask already exists are not sieved again.
+        The default is False, as a retrained model should re-sieve everything.
+    verbose : bool, optional
+        print progress and throughput. The default is True.
+    sieve : gbs.Sieve or None, optional
+        an already loaded sieve, used instead of model_file. The default is
+        None, which loads model_file with load_sieve.
+
+    Returns
+    -------
+    A DataFrame with one row per mask (see sieve_file, skipped masks are
+    flagged), also written to SUMMARY_NAME in out_folder
+
+    """
+    if sieve is None:
+        sieve = load_sieve(model_file)
+
+    os.makedirs(out_folder, exist_ok=True)
+    jobs = [(m, *output_names(m, out_folder, name)) for m, name in zip(masks, unique_names(masks))]
+    skipped = []
+    if skip_existing:
+        skipped = [{'mask': m, 'sieved': sieved_name, 'skipped': True} for m, sieved_name, _ in jobs
+                   if os.path.exists(sieved_name)]
+        jobs = [j for j in jobs if not os.path.exists(j[1])]
+
+    n_workers = max(1, min(n_workers or os.cpu_count() or 1, len(jobs) or 1))
+    if verbose:
+        print(f'Sieving {len(jobs)} masks ({len(masks) - len(jobs)} skipped) on {n_workers} workers')
+
+    results = []
+    start = perf_counter()
+    if jobs:
+        try:
+            with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=(sieve,)) as pool:
+                for i, result in enumerate(pool.map(_sieve_job, jobs, chunksize=max(1, len(jobs) // (8*n_workers)))):
+                    results.append(result)
+                    if verbose and result['error']:
+                        print(f'{result["mask"]}: {result["error"]}')
+                    if verbose and (i + 1) % 100 == 0:
+                        print(f'{i + 1}/{len(jobs)} masks ({(i + 1) / (perf_counter() - start):.1f} masks/s)')
+        except BrokenProcessPool as e: # e.g., a worker was killed for running out of memory
+            print(f'A worker process died ({e}). The {len(jobs) - len(results)} unfinished masks are marked as failed')
+            results.extend({'mask': m, 'sieved': None, 'error': f'BrokenProcessPool: {e}'} for m, _, _ in jobs[len(results):])
+    elapsed = perf_counter() - start
+
+    summary = pd.DataFrame(results + skipped, columns=['mask', 'sieved', 'lesions', 'rejected', 'voxels_before',
+                                                       'voxels_after', 'n_voxels', 'seconds', 'error', 'skipped'])
+    summary['skipped'] = summary['skipped'].eq(True)
+    summary.to_csv(os.path.join(out_folder, SUMMARY_NAME), index=False)
+
+    if verbose:
+        done = summary[summary['error'].isna() & ~summary['skipped']]
+        print(f'Sieved {len(done)} masks in {elapsed:.1f} s ({len(done) / max(elapsed, 1e-9):.2f} masks/s, '
+              f'{done["n_voxels"].sum() / max(elapsed, 1e-9) / 1e6:.1f} Mvoxels/s)')
+        print(f'Rejected {int(done["rejected"].sum())} of {int(done["lesions"].sum())} lesions')
+        n_failed = int(summary['error'].notna().sum())
+        if n_failed:
+            print(f'{n_failed} masks failed (see {SUMMARY_NAME})')
+
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Sieve binary lesion masks with GBS')
+    parser.add_argument('masks', nargs='*', help='masks or glob patterns (quote them to use ** patterns)')
+    parser.add_argument('-o', '--out', required=True, help='folder for the sieved masks and lesion tables')
+    parser.add_argument('--list', help='text file with one mask or pattern per line')
+    parser.add_argument('--model', help='pickled model from gbs.train_and_save (default: the default model)')
+    parser.add_argument('--workers', type=int, help='number of masks sieved at once (default: number of CPUs)')
+    parser.add_argument('--skip-existing', action='store_true', help='do not re-sieve masks with outputs')
+
+    args = parser.parse_args(argv)
+
+    masks = expand_masks(args.masks, args.list)
+    if not masks:
+        parser.error('no masks given')
+
+    try:
+        sieve = load_sieve(args.model)
+    except Exception as e:
+        print(e)
+        return 2
+
+    summary = sieve_files(masks, args.out, n_workers=args.workers, skip_existing=args.skip_existing, sieve=sieve)
+    return 1 if summary['error'].notna().any() else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+In-process k-nearest neighbour classifier that generates BIANCA-style lesion
+probability maps from saved BIANCA classifier data (the files written by
+bianca --saveclassifierdata), without writing a master file, calling the
+bianca executable or round-tripping the probability map through disk
+
+The features mirror those BIANCA builds for a subject:
+    - one intensity feature per image, z-scored within the brain mask
+    - optionally the MNI coordinates of the voxel, variance-normalised with the
+      mean and standard deviation of the training points' coordinates (the
+      classifier data stores them in mm) and multiplied by the spatial
+      weight, as BIANCA does by default. These are used if the classifier
+      data has 3 more columns than there are images
+The probability of a voxel is the fraction of its k nearest training points
+that are labelled as lesion. bin/bianca_parity_check.py compares the output
+to the bianca executable, or offline to a map bianca stored for a synthetic
+case. No such comparison has passed yet, so the classifier is unvalidated
+and UGLI labels it as such
+"""
+
+import os
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import nibabel as nib
+from scipy import spatial
+
+import tracing
+
+
+# affine of FSL's MNI152 1mm templates, which the FLIRT matrices register to
+MNI_AFFINE = np.array([[-1, 0, 0, 90],
+                       [0, 1, 0, -126],
+                       [0, 0, 1, -72],
+                       [0, 0, 0, 1]], dtype=float)
+
+_classifiers = {} # (model path, settings) -> (modification time, classifier)
+
+
+def load_classifier_data(model):
+    """
+    Reads BIANCA classifier data
+
+
+    Parameters
+    ----------
+    model : pathlike
+        path to the classifier data. The labels are expected at {model}_labels
+
+    Returns
+    -------
+    A tuple of the training features as a 2d float32 array (one row per
+    training point) and the labels as a 1d bool array
+
+    """
+    with open(model, 'rb') as f:
+        features = pickle.load(f, encoding='latin1')
+    with open(f'{model}_labels', 'rb') as f:
+        labels = pickle.load(f, encoding='latin1')
+
+    features = np.ascontiguousarray(features, dtype=np.float32)
+    labels = np.asarray(labels).ravel() > 0
+
+    return features, labels
+
+
+def read_flirt_matrix(trans):
+    """
+    Reads a 4x4 FLIRT transformation matrix
+    """
+    return np.loadtxt(trans)
+
+
+def fsl_scaled_voxel_matrix(img):
+    """
+    Returns the matrix that maps voxel indices to FSL's scaled mm coordinates,
+    which are the coordinates FLIRT matrices operate on: the voxel index
+    times the voxel size, with the x axis flipped if the image is stored in
+    neurological orientation
+    """
+    nx = img.shape[0]
+    zooms = img.header.get_zooms()[:3]
+    vox2fsl = np.diag([zooms[0], zooms[1], zooms[2], 1.0])
+    if np.linalg.det(img.affine[:3,:3]) > 0:
+        vox2fsl[0,0] = -zooms[0]
+        vox2fsl[0,3] = (nx - 1) * zooms[0]
+    return vox2fsl
+
+
+def spatial_features(img, mask, trans, mni_affine=MNI_AFFINE):
+    """
+    Computes the MNI coordinates (in mm) of every voxel in the mask
+
+
+    Parameters
+    ----------
+    img : nibabel image
+        the scan the mask was defined on.
+    mask : 3d bool np array
+        which voxels to compute coordinates for.
+    trans : 4x4 np array
+        FLIRT matrix that maps img to MNI space.
+    mni_affine : 4x4 np array, optional
+        the voxel to world affine of the MNI template. The default is MNI_AFFINE.
+
+    Returns
+    -------
+    A 2d float32 array with one row of (x,y,z) for each voxel in the mask
+
+    """
+    vox = np.nonzero(mask)
+    vox = np.vstack(vox + (np.ones(len(vox[0])),))
+
+    # the MNI templates are stored radiologically, so their scaled mm coordinates are voxel indices times 1mm
+    mni_vox2fsl = np.diag(list(np.abs(np.diag(mni_affine)[:3])) + [1.0])
+    to_mni = mni_affine @ np.linalg.inv(mni_vox2fsl) @ trans @ fsl_scaled_voxel_matrix(img)
+
+    coords = (to_mni @ vox)[:3].T
+
+    return coords.astype(np.float32)
+
+
+def intensity_features(images, mask):
+    """
+    Extracts one feature column per image: the intensities of the voxels in
+    the mask, z-scored using the mean and standard deviation within the mask
+    """
+    n = int(mask.sum())
+    features = np.empty((n, len(images)), dtype=np.float32)
+    for i, im in enumerate(images):
+        vals = np.asarray(im[mask], dtype=np.float32)
+        std = vals.std()
+        features[:,i] = (vals - vals.mean()) / (std if std > 0 else 1)
+    return features
+
+
+@tracing.traced()
+def load_subject(flair, t1, trans=None):
+    """
+    Reads the inputs for one subject
+
+
+    Parameters
+    ----------
+    flair : pathlike
+        skull-stripped FLAIR. Its nonzero voxels form the brain mask.
+    t1 : pathlike
+        T1 registered to the FLAIR.
+    trans : pathlike or None, optional
+        FLIRT matrix mapping the FLAIR to MNI space. The default is None.
+
+    Returns
+    -------
+    A tuple of the list of images ([flair, t1] as float32 arrays), the brain
+    mask, the FLAIR nibabel image and the FLIRT matrix (or None)
+
+    """
+    flair_img = nib.load(flair)
+    flair_data = flair_img.get_fdata(dtype=np.float32)
+    t1_data = nib.load(t1).get_fdata(dtype=np.float32)
+    mask = flair_data > 0
+
+    mat = read_flirt_matrix(trans) if trans else None
+
+    return [flair_data, t1_data], mask, flair_img, mat
+
+
+class BiancaClassifier:
+    """
+    k-NN lesion classifier built from saved BIANCA classifier data. The data
+    is read and indexed in a KD-tree once, so any number of subjects can then
+    be classified without reloading it
+
+
+    Parameters
+    ----------
+    model : pathlike
+        path to the BIANCA classifier data.
+    n_images : int, optional
+        number of images the classifier was trained on (e.g., 2 for FLAIR and
+        T1). Any 3 further columns are MNI coordinates. The default is 2.
+    n_neighbours : int, optional
+        number of neighbours voting on each voxel. The default is 40.
+    spatial_weight : float, optional
+        multiplier for the variance-normalised MNI coordinate features, in
+        the training data and for each subject. The default is 1.
+    n_threads : int or None, optional
+        number of threads used to query the tree. The default is None, which
+        uses the number of CPUs.
+    batch_size : int, optional
+        number of voxels per tree query. The default is 100000.
+
+    """
+
+    def __init__(self, model, n_images=2, n_neighbours=40, spatial_weight=1, n_threads=None, batch_size=100000):
+        self.model = model
+        self.n_images = n_images
+        self.n_neighbours = n_neighbours
+        self.spatial_weight = spatial_weight
+        self.n_threads = n_threads or os.cpu_count() or 1
+        self.batch_size = batch_size
+
+        features, labels = load_classifier_data(model)
+        self.n_features = features.shape[1]
+        self.labels = labels.astype(np.float32)
+
+        # any columns after the images' are MNI coordinates in mm. they are variance-normalised
+        # with the training statistics (here and in build_features) so that millimetres don't
+        # swamp the z-scored intensities in the neighbour distances
+        if self.n_features not in (n_images, n_images + 3):
+            raise Exception(f'Classifier {model} has {self.n_features} features, which does not match {n_images} images')
+        self.spatial_mean = None
+        self.spatial_std = None
+        if self.n_features == n_images + 3:
+            coords = features[:, -3:]
+            self.spatial_mean = coords.mean(axis=0)
+            std = coords.std(axis=0)
+            self.spatial_std = np.where(std > 0, std, 1).astype(np.float32)
+            features = features.copy()
+            features[:, -3:] = self.normalise_spatial(coords)
+
+        self.tree = spatial.cKDTree(features)
+
+
+    def normalise_spatial(self, coords):
+        """
+        Variance-normalises MNI coordinates with the training statistics and
+        applies the spatial weight
+        """
+        return (coords - self.spatial_mean) / self.spatial_std * self.spatial_weight
+
+
+    @tracing.traced()
+    def predict_features(self, features):
+        """
+        Returns the lesion probability of each row of a 2d feature array
+        """
+        k = min(self.n_neighbours, len(self.labels))
+        batches = [features[i:i+self.batch_size] for i in range(0, len(features), self.batch_size)]
+
+        def classify(batch):
+            dist, idx = self.tree.query(batch, k=k)
+            idx = idx.reshape(len(batch), k)
+            return self.labels[idx].mean(axis=1)
+
+        with ThreadPoolExecutor(max_workers=self.n_threads) as pool:
+            probs = list(pool.map(classify, batches))
+
+        if not probs:
+            return np.zeros(0, np.float32)
+        return np.concatenate(probs)
+
+
+    def build_features(self, images, mask, img=None, trans=None):
+        """
+        Builds the feature array for every voxel in the mask. See predict_arrays
+        for the parameters
+        """
+
+        shape = images[0].shape
+        if any(im.shape != shape for im in images):
+            raise Exception(f'Images must share a voxel grid, got shapes {[im.shape for im in images]}')
+
+        features = intensity_features(images, mask)
+
+        if len(images) != self.n_images:
+            raise Exception(f'Classifier {self.model} was trained on {self.n_images} images, got {len(images)}')
+
+        if self.spatial_mean is not None:
+            if img is None or trans is None:
+                raise Exception('This classifier uses spatial features, so an image and transformation matrix are required')
+            coords = self.normalise_spatial(spatial_features(img, mask, trans))
+            features = np.hstack([features, coords])
+
+        return features
+
+
+    def predict_arrays(self, images, mask, img=None, trans=None):
+        """
+        Generates a probability map from images that are already loaded
+
+
+        Parameters
+        ----------
+        images : list of 3d np arrays
+            the scans, in the same order as the features used to train the
+            classifier (e.g., [flair, t1]) and on the same voxel grid.
+        mask : 3d bool np array
+            the brain mask. Voxels outside it get a probability of 0.
+        img : nibabel image or None, optional
+            the scan that defines the voxel grid. Needed for spatial features. The default is None.
+        trans : 4x4 np array or None, optional
+            FLIRT matrix to MNI space. Needed for spatial features. The default is None.
+
+        Returns
+        -------
+        3d float32 np array
+
+        """
+
+        features = self.build_features(images, mask, img, trans)
+
+        prob = np.zeros(mask.shape, np.float32)
+        prob[mask] = self.predict_features(features)
+
+        return prob
+
+
+    def predict(self, flair, t1, trans=None):
+        """
+        Generates a probability map in the orientation nibabel reads the FLAIR
+        in, matching what bianca would write for the same inputs
+
+
+        Parameters
+        ----------
+        flair : pathlike
+            skull-stripped FLAIR. Its nonzero voxels form the brain mask.
+        t1 : pathlike
+            T1 registered to the FLAIR.
+        trans : pathlike or None, optional
+            FLIRT matrix mapping the FLAIR to MNI space. The default is None.
+
+        Returns
+        -------
+        3d float32 np array
+
+        """
+
+        images, mask, flair_img, mat = load_subject(flair, t1, trans)
+
+        return self.predict_arrays(images, mask, img=flair_img, trans=mat)
+
+
+def get_classifier(model, **kwargs):
+    """
+    Returns a BiancaClassifier for the model, building it only the first time
+    it is requested in this process (or when the classifier data has changed
+    on disk). kwargs are passed to BiancaClassifier
+    """
+    key = (os.path.realpath(model), tuple(sorted(kwargs.items())))
+    mtime = (os.path.getmtime(model), os.path.getmtime(f'{model}_labels'))
+
+    cached = _classifiers.get(key)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, BiancaClassifier(model, **kwargs))
+        _classifiers[key] = cached
+
+    return cached[1]
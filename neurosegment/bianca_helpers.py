@@ -9,7 +9,10 @@ import os
 
 import pandas as pd
 
+import tracing
 
+
+@tracing.traced()
 def generate_master(top_folder, master_name, training_subfolder,
                     training_names, in_csv, incl_col, pt_id_col):
     """
@@ -63,6 +66,43 @@ def generate_master(top_folder, master_name, training_subfolder,
     message_file.close()
 
 
+@tracing.traced()
+def generate_master_from_catalog(catalog_file, master_name, training_kinds, training=1):
+    """
+    Generates the master .txt file for input to BIANCA from a cohort catalog
+    (see catalog.py), without probing the training folders
+    
+
+    Parameters
+    ----------
+    catalog_file : str
+        path to the catalog database.
+    master_name : str
+        out .txt file
+    training_kinds : list of str
+        catalog artifact types for the training files (e.g., ['flair', 't1', 'mask', 'omat']). rows will be built in order of the types specified
+    training : int, optional
+        training flag of the patients to include. The default is 1.
+
+    Returns
+    -------
+    None
+
+    """
+    import catalog
+    
+    with catalog.Catalog(catalog_file) as cat:
+        pts = cat.patients(training=training, having=training_kinds)
+        columns = [cat.paths(kind, pts) for kind in training_kinds]
+    
+    assert len(pts) != 0
+    
+    with open(master_name, 'w') as message_file:
+        rows = [''.join(f'{col[pt]} ' for col in columns) for pt in pts]
+        message_file.write('\n'.join(rows))
+
+
+@tracing.traced()
 def construct_bianca_cmd(master_name, subject_index, skullstrip_col, mask_col, transformation_col, out_name, run_cmd=True):
     """
     Constructs a string that can be passed to the OS to execute BIANCA
@@ -94,6 +134,7 @@ def construct_bianca_cmd(master_name, subject_index, skullstrip_col, mask_col, t
         os.system(bianca)
     return bianca
     
+@tracing.traced()
 def evaluate_bianca_performance(bianca_mask, thresh, manual_mask, run_cmd=True):
     """
     Evaluates the quality of a BIANCA lesion segmentation
@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SQLite catalog of a cohort: the patients in a pt_data folder (as written by
+the move_and_prepare scripts), whether they are training cases and the
+artifacts each one has, with their sizes, modification times and SHA-256
+hashes
+
+Sync it with the filesystem once, then query it instead of probing the
+(network) share from every script:
+
+    import catalog
+
+    with catalog.Catalog('cohort.db') as cat:
+        cat.sync(master_folder, training_csv=tabular_csv)
+        pts = cat.patients(training=1, having=['mask', 'omat'])
+        masks = cat.paths('mask', pts)
+
+Or from the shell
+    python catalog.py sync cohort.db /path/to/pt_data [--training-csv tabular.csv]
+    python catalog.py query cohort.db [--training 1] [--having mask omat] [--kind mask]
+"""
+
+import os
+import re
+import sys
+import time
+import fnmatch
+import hashlib
+import sqlite3
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import tracing
+
+
+# artifact type -> patterns relative to a patient's folder. The first pattern
+# with a match is used, and the last file (by name, with numbers compared as
+# numbers, so v10 comes after v9) if a pattern matches several. UGLI writes its
+# outputs to a ugli/ folder next to the T1
+ARTIFACTS = {
+    'flair': ['processed/axFLAIR.nii.gz', 'axFLAIR.nii.gz'],
+    'cor_flair': ['processed/corFLAIR.nii.gz', 'corFLAIR.nii.gz'],
+    't1': ['processed/axT1.nii.gz', 'axT1.nii.gz'],
+    'flair_raw': ['bin/axFLAIR_raw.nii.gz', 'bin/axFLAIR_raw.nii'],
+    'cor_flair_raw': ['bin/corFLAIR_raw.nii.gz', 'bin/corFLAIR_raw.nii'],
+    't1_raw': ['bin/axT1_raw.nii.gz', 'bin/axT1_raw.nii'],
+    'mask': ['processed/axFLAIR_mask.nii.gz', 'axFLAIR_mask.nii.gz'],
+    'omat': ['processed/master2mni.mat', 'master2mni.mat'],
+    'bianca_map': ['processed/ugli/probability_map.nii.gz', 'ugli/probability_map.nii.gz',
+                   'processed/probability_map.nii.gz', 'probability_map.nii.gz'],
+    'features': ['processed/ugli/binarized_map_v*_stats.csv', 'ugli/binarized_map_v*_stats.csv',
+                 'processed/binarized_map_v*_stats.csv', 'binarized_map_v*_stats.csv'],
+    }
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS patients (
+    pt_id TEXT PRIMARY KEY,
+    folder TEXT NOT NULL,
+    training INTEGER,
+    synced REAL
+);
+CREATE TABLE IF NOT EXISTS artifacts (
+    pt_id TEXT NOT NULL REFERENCES patients(pt_id) ON DELETE CASCADE,
+    kind TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    sha256 TEXT,
+    PRIMARY KEY (pt_id, kind)
+);
+CREATE INDEX IF NOT EXISTS artifacts_kind ON artifacts(kind, pt_id);
+CREATE INDEX IF NOT EXISTS patients_training ON patients(training);
+"""
+
+
+def file_hash(path, chunk_size=1024**2):
+    """
+    Returns the SHA-256 hex digest of a file, read in chunks
+    """
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def list_folder(folder):
+    """
+    Returns {filename: os.DirEntry} for the files in a folder, or an empty
+    dict if the folder does not exist
+    """
+    try:
+        with os.scandir(folder) as entries:
+            return {e.name: e for e in entries if e.is_file()}
+    except (FileNotFoundError, NotADirectoryError):
+        return {}
+
+
+def natural_key(name):
+    """
+    Sort key that compares the runs of digits in a name as numbers
+    """
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', name)]
+
+
+def find_artifacts(pt_folder, artifacts=ARTIFACTS):
+    """
+    Finds the artifacts of one patient, listing each subfolder named in the
+    patterns once
+
+
+    Parameters
+    ----------
+    pt_folder : pathlike
+        the patient's folder.
+    artifacts : dict, optional
+        artifact type -> list of patterns. The default is ARTIFACTS.
+
+    Returns
+    -------
+    A dict mapping each artifact type found to its os.DirEntry
+
+    """
+    listings = {}
+    found = {}
+    for kind, patterns in artifacts.items():
+        for pattern in patterns:
+            sub, name_pattern = os.path.split(pattern)
+            if sub not in listings:
+                listings[sub] = list_folder(os.path.join(pt_folder, sub))
+            names = sorted(fnmatch.filter(listings[sub], name_pattern), key=natural_key)
+            if names:
+                found[kind] = listings[sub][names[-1]]
+                break
+    return found
+
+
+class Catalog:
+    """
+    A cohort catalog stored in an SQLite file
+
+
+    Parameters
+    ----------
+    path : pathlike
+        the database file. It is created if it does not exist.
+
+    """
+
+    def __init__(self, path):
+        self.db_file = path
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA foreign_keys = ON')
+        self.db.execute('PRAGMA journal_mode = WAL') # so other processes can read during a sync
+        self.db.executescript(SCHEMA)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+    def close(self):
+        self.db.close()
+
+
+    @tracing.traced()
+    def sync(self, master_folder, training_csv=None, pt_id_col='id', training_col='training',
+             hash_files=True, n_workers=8, artifacts=ARTIFACTS):
+        """
+        Brings the catalog up to date with a pt_data folder. Files whose size
+        and modification time have not changed keep their stored hash, so
+        only new or changed files are read
+
+
+        Parameters
+        ----------
+        master_folder : pathlike
+            folder with one subfolder per patient.
+        training_csv : pathlike or None, optional
+            a csv (e.g., a move_and_prepare tabular csv) with patient IDs and
+            a training column. If given, the training flags are updated from
+            it. The default is None.
+        pt_id_col : str, optional
+            the patient ID column of training_csv. The default is 'id'.
+        training_col : str, optional
+            the training column of training_csv. The default is 'training'.
+        hash_files : bool, optional
+            if False, hashes are not computed (and are NULL for new or changed
+            files). The default is True.
+        n_workers : int, optional
+            number of files hashed at once. The default is 8.
+        artifacts : dict, optional
+            artifact type -> list of patterns. The default is ARTIFACTS.
+
+        Returns
+        -------
+        A dict with the number of patients seen and removed and artifacts
+        added or changed, unchanged and removed
+
+        """
+        master_folder = os.path.abspath(master_folder)
+        counts = {'patients': 0, 'patients_removed': 0, 'artifacts_changed': 0,
+                  'artifacts_unchanged': 0, 'artifacts_removed': 0}
+
+        with os.scandir(master_folder) as entries:
+            pt_folders = {e.name: e.path for e in entries if e.is_dir() and not e.name.startswith('.')}
+
+        known = {}
+        for row in self.db.execute('SELECT * FROM artifacts'):
+            if row['pt_id'] in pt_folders:
+                known[(row['pt_id'], row['kind'])] = row
+
+        upserts = [] # (pt_id, kind, path, size, mtime_ns, sha256 or None)
+        to_hash = [] # indices into upserts
+        for pt_id, pt_folder in sorted(pt_folders.items()):
+            counts['patients'] += 1
+            found = find_artifacts(pt_folder, artifacts)
+            for kind, entry in found.items():
+                stat = entry.stat()
+                old = known.pop((pt_id, kind), None)
+                if (old is not None and old['path'] == entry.path and old['size'] == stat.st_size
+                        and old['mtime_ns'] == stat.st_mtime_ns and (old['sha256'] or not hash_files)):
+                    counts['artifacts_unchanged'] += 1
+                    continue
+                upserts.append([pt_id, kind, entry.path, stat.st_size, stat.st_mtime_ns, None])
+                if hash_files:
+                    to_hash.append(len(upserts) - 1)
+
+        if to_hash:
+            with tracing.stage('catalog_hash', n_files=len(to_hash)):
+                with ThreadPoolExecutor(max_workers=n_workers) as pool:
+                    digests = pool.map(file_hash, [upserts[i][2] for i in to_hash])
+                    for i, digest in zip(to_hash, digests):
+                        upserts[i][5] = digest
+
+        now = time.time()
+        with self.db:
+            self.db.executemany('INSERT INTO patients (pt_id, folder, synced) VALUES (?, ?, ?) '
+                                'ON CONFLICT(pt_id) DO UPDATE SET folder=excluded.folder, synced=excluded.synced',
+                                [(pt_id, folder, now) for pt_id, folder in pt_folders.items()])
+            self.db.executemany('INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?, ?, ?)', upserts)
+            # whatever is left in known was not found again
+            self.db.executemany('DELETE FROM artifacts WHERE pt_id = ? AND kind = ?', list(known))
+            gone = [row['pt_id'] for row in self.db.execute('SELECT pt_id, folder FROM patients')
+                    if os.path.dirname(row['folder']) == master_folder and row['pt_id'] not in pt_folders]
+            self.db.executemany('DELETE FROM patients WHERE pt_id = ?', [(pt_id,) for pt_id in gone])
+        counts['artifacts_changed'] = len(upserts)
+        counts['artifacts_removed'] = len(known)
+        counts['patients_removed'] = len(gone)
+
+        if training_csv is not None:
+            import pandas as pd
+
+            df = pd.read_csv(training_csv)
+            self.set_training({pt_id: (None if pd.isna(flag) else int(flag))
+                               for pt_id, flag in zip(df[pt_id_col], df[training_col])})
+
+        return counts
+
+
+    def set_training(self, flags):
+        """
+        Sets the training flag (e.g., 1 for training, 0 for validation, None
+        for neither) of patients in the catalog, given as {pt_id: flag}
+        """
+        with self.db:
+            self.db.executemany('UPDATE patients SET training = ? WHERE pt_id = ?',
+                                [(flag, str(pt_id)) for pt_id, flag in flags.items()])
+
+
+    def patients(self, training=None, having=()):
+        """
+        Returns the IDs of patients in the catalog, sorted
+
+
+        Parameters
+        ----------
+        training : int, list of int or None, optional
+            only return patients with this training flag (or one of these
+            flags). The default is None, which does not filter on it.
+        having : list of str, optional
+            only return patients that have all of these artifact types. The
+            default is (), which does not filter on artifacts.
+
+        Returns
+        -------
+        list of str
+
+        """
+        query = 'SELECT pt_id FROM patients WHERE 1'
+        params = []
+        if training is not None:
+            flags = [training] if isinstance(training, int) else list(training)
+            query += f' AND training IN ({", ".join("?" * len(flags))})'
+            params += flags
+        having = list(having)
+        if having:
+            query += (f' AND pt_id IN (SELECT pt_id FROM artifacts WHERE kind IN ({", ".join("?" * len(having))})'
+                      ' GROUP BY pt_id HAVING COUNT(*) = ?)')
+            params += having + [len(having)]
+        query += ' ORDER BY pt_id'
+        return [row['pt_id'] for row in self.db.execute(query, params)]
+
+
+    def path(self, pt_id, kind):
+        """
+        Returns the path of one artifact of a patient, or None if it is not
+        in the catalog
+        """
+        row = self.db.execute('SELECT path FROM artifacts WHERE pt_id = ? AND kind = ?', (pt_id, kind)).fetchone()
+        return None if row is None else row['path']
+
+
+    def paths(self, kind, pt_ids=None):
+        """
+        Returns {pt_id: path} for one artifact type, for the given patients
+        (or all patients) that have it
+        """
+        rows = self.db.execute('SELECT pt_id, path FROM artifacts WHERE kind = ?', (kind,))
+        paths = {row['pt_id']: row['path'] for row in rows}
+        if pt_ids is not None:
+            paths = {pt_id: paths[pt_id] for pt_id in pt_ids if pt_id in paths}
+        return paths
+
+
+    def artifacts(self, pt_id):
+        """
+        Returns {kind: dict of path, size, mtime_ns and sha256} for a patient
+        """
+        rows = self.db.execute('SELECT * FROM artifacts WHERE pt_id = ?', (pt_id,))
+        return {row['kind']: {k: row[k] for k in ('path', 'size', 'mtime_ns', 'sha256')} for row in rows}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Cohort catalog of patients and their artifacts')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    sync_parser = commands.add_parser('sync', help='bring the catalog up to date with a pt_data folder')
+    sync_parser.add_argument('db', help='the catalog file')
+    sync_parser.add_argument('master_folder', help='folder with one subfolder per patient')
+    sync_parser.add_argument('--training-csv', help='csv with patient IDs and training flags')
+    sync_parser.add_argument('--pt-id-col', default='id')
+    sync_parser.add_argument('--training-col', default='training')
+    sync_parser.add_argument('--no-hash', action='store_true', help='do not hash new or changed files')
+    sync_parser.add_argument('--workers', type=int, default=8, help='number of files hashed at once')
+
+    query_parser = commands.add_parser('query', help='list patients (or the paths of one artifact type)')
+    query_parser.add_argument('db', help='the catalog file')
+    query_parser.add_argument('--training', type=int, nargs='+', help='only patients with these training flags')
+    query_parser.add_argument('--having', nargs='+', default=[], choices=sorted(ARTIFACTS),
+                              help='only patients with all of these artifacts')
+    query_parser.add_argument('--kind', choices=sorted(ARTIFACTS), help='print the paths of this artifact type')
+
+    args = parser.parse_args(argv)
+
+    with Catalog(args.db) as cat:
+        if args.command == 'sync':
+            counts = cat.sync(args.master_folder, args.training_csv, args.pt_id_col, args.training_col,
+                              hash_files=not args.no_hash, n_workers=args.workers)
+            for key, val in counts.items():
+                print(f'{key}: {val}')
+        else:
+            pts = cat.patients(args.training, args.having)
+            if args.kind:
+                for pt_id, path in cat.paths(args.kind, pts).items():
+                    print(f'{pt_id}\t{path}')
+            else:
+                print('\n'.join(pts))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
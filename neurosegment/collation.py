@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Collates files into a second folder tree (e.g., a review or training set)
+without duplicating data where possible
+
+Each file is cloned (a copy-on-write reflink, on filesystems that support
+it, e.g., APFS, Btrfs and XFS), hard linked if it cannot be cloned and the
+source and target share a filesystem, or copied otherwise. Copies run in
+parallel and are verified with SHA-256. Targets that are already up to date
+(the same file, or the same size and modification time) are skipped, so
+rerunning a collation only transfers what changed.
+
+Targets that are edited after they are collated (e.g., masks corrected by a
+reviewer) can be protected from being replaced on a rerun: collate can keep
+a record of the size and modification time of every target it wrote, and
+with overwrite=False only replaces targets that still match their record
+"""
+
+import os
+import sys
+import json
+import errno
+import shutil
+import hashlib
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import tracing
+
+
+METHODS = ('reflink', 'hardlink', 'copy')
+
+FICLONE = 0x40049409 # Linux ioctl that clones a whole file
+
+
+def nifti_extension(path):
+    """
+    Returns the extension of a file, treating .nii.gz as one extension
+    """
+    if path.endswith('.nii.gz'):
+        return '.nii.gz'
+    return os.path.splitext(path)[1]
+
+
+def is_unchanged(src, dst, allow_hardlink=True):
+    """
+    Returns whether dst is already an up to date collation of src: the same
+    file (a hard link, if allow_hardlink), or a separate file with the same
+    size and modification time. If hard links are not allowed, a dst that is
+    a hard link to src is stale, so that it gets replaced by a separate file
+    """
+    try:
+        dst_stat = os.stat(dst)
+    except FileNotFoundError:
+        return False
+    src_stat = os.stat(src)
+    if (src_stat.st_dev, src_stat.st_ino) == (dst_stat.st_dev, dst_stat.st_ino):
+        return allow_hardlink
+    return src_stat.st_size == dst_stat.st_size and src_stat.st_mtime_ns == dst_stat.st_mtime_ns
+
+
+def load_record(record_file):
+    """
+    Reads a collation record: a dict of each target's absolute path to the
+    [size, modification time in ns] it had when it was collated. A missing
+    record is empty
+    """
+    try:
+        with open(record_file) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_record(record, record_file):
+    """
+    Writes a collation record (see load_record), replacing the old one only
+    once the new one is written whole
+    """
+    part = f'{record_file}.part'
+    with open(part, 'w') as f:
+        json.dump(record, f, indent=1, sort_keys=True)
+    os.replace(part, record_file)
+
+
+def is_modified(dst, collated):
+    """
+    Returns whether dst exists and is not a file that collation left as it is:
+    it has no record (collated is None) or its size or modification time has
+    changed since collated, the [size, mtime_ns] it was collated with
+    """
+    try:
+        dst_stat = os.stat(dst)
+    except FileNotFoundError:
+        return False
+    return collated is None or [dst_stat.st_size, dst_stat.st_mtime_ns] != list(collated)
+
+
+def reflink(src, dst):
+    """
+    Clones src to dst with copy-on-write, so no data is duplicated until one
+    of them is modified. Raises OSError if the platform or filesystem does not
+    support it
+    """
+    if sys.platform.startswith('linux'):
+        import fcntl
+
+        with open(src, 'rb') as f_src, open(dst, 'wb') as f_dst:
+            try:
+                fcntl.ioctl(f_dst.fileno(), FICLONE, f_src.fileno())
+            except OSError:
+                f_dst.close()
+                os.remove(dst)
+                raise
+    elif sys.platform == 'darwin':
+        import ctypes
+
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.clonefile(os.fsencode(src), os.fsencode(dst), 0) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), dst)
+    else:
+        raise OSError(errno.ENOTSUP, 'reflinks are not supported on this platform', dst)
+    shutil.copystat(src, dst)
+
+
+def verified_copy(src, dst, chunk_size=1024**2):
+    """
+    Copies src to dst, hashing the data as it is read and then hashing the
+    written file again. Raises an Exception if they differ
+    """
+    h_src = hashlib.sha256()
+    with open(src, 'rb') as f_src, open(dst, 'wb') as f_dst:
+        for chunk in iter(lambda: f_src.read(chunk_size), b''):
+            h_src.update(chunk)
+            f_dst.write(chunk)
+
+    h_dst = hashlib.sha256()
+    with open(dst, 'rb') as f_dst:
+        for chunk in iter(lambda: f_dst.read(chunk_size), b''):
+            h_dst.update(chunk)
+    if h_src.digest() != h_dst.digest():
+        os.remove(dst)
+        raise Exception(f'Checksum mismatch copying {src} to {dst}')
+
+    shutil.copystat(src, dst)
+
+
+def collate_file(src, dst, methods=METHODS, overwrite=True, collated=None):
+    """
+    Collates one file, trying each method in turn
+
+
+    Parameters
+    ----------
+    src : pathlike
+        the file to collate.
+    dst : pathlike
+        where to put it. Its folder must exist. An outdated dst is replaced.
+    methods : tuple of str, optional
+        the methods to try, in order: 'reflink', 'hardlink' and/or 'copy'.
+        Note that a hard link is the same file as the source, so changes made
+        to it change the source too. Leave out 'hardlink' for files that will
+        be edited, and an existing hard link is replaced with a separate file.
+        The default is METHODS.
+    overwrite : bool, optional
+        if False, an outdated dst is only replaced if it is unmodified since
+        it was collated (see is_modified), and is kept otherwise. A dst that
+        is a hard link to src is always replaced if hard links are not
+        allowed. The default is True.
+    collated : list or None, optional
+        the [size, mtime_ns] dst had when it was collated (see load_record),
+        or None if it has no record. The default is None.
+
+    Returns
+    -------
+    str, the method used, 'unchanged' or 'kept'
+
+    """
+    if is_unchanged(src, dst, allow_hardlink='hardlink' in methods):
+        return 'unchanged'
+    if not overwrite and is_modified(dst, collated) and not os.path.samefile(src, dst):
+        return 'kept'
+
+    part = f'{dst}.part'
+    if os.path.lexists(part):
+        os.remove(part)
+
+    for method in methods:
+        try:
+            with tracing.stage(f'collate_{method}', file=os.path.basename(dst)):
+                if method == 'reflink':
+                    reflink(src, part)
+                elif method == 'hardlink':
+                    os.link(src, part)
+                elif method == 'copy':
+                    verified_copy(src, part)
+                else:
+                    raise Exception(f'Unknown collation method {method}')
+        except OSError:
+            if method == methods[-1]:
+                raise
+            continue
+        os.replace(part, dst)
+        return method
+
+    raise Exception(f'No collation method succeeded for {src}')
+
+
+def collate(pairs, n_workers=8, methods=METHODS, overwrite=True, record_file=None):
+    """
+    Collates several files concurrently with collate_file
+
+
+    Parameters
+    ----------
+    pairs : list of (src, dst) tuples
+        the files to collate.
+    n_workers : int, optional
+        number of files collated at once. The default is 8.
+    methods : tuple of str, optional
+        see collate_file. The default is METHODS.
+    overwrite : bool, optional
+        see collate_file. The default is True.
+    record_file : pathlike or None, optional
+        a JSON file recording every target that was collated or found up to
+        date (see load_record), which overwrite=False needs to tell targets
+        edited since they were collated from stale ones. It is updated even
+        if a file fails. The default is None, which keeps no record.
+
+    Returns
+    -------
+    A collections.Counter of the methods used, 'unchanged' and 'kept'
+
+    """
+    record = load_record(record_file) if record_file else {}
+    with ThreadPoolExecutor(max_workers=max(1, min(n_workers, len(pairs)))) as pool:
+        futures = [(dst, pool.submit(collate_file, src, dst, methods, overwrite, record.get(os.path.abspath(dst))))
+                   for src, dst in pairs]
+
+    # every file is finished here, so the targets that were written are recorded before any failure is raised
+    for dst, future in futures:
+        if future.exception() is None and future.result() != 'kept':
+            dst_stat = os.stat(dst)
+            record[os.path.abspath(dst)] = [dst_stat.st_size, dst_stat.st_mtime_ns]
+    if record_file:
+        save_record(record, record_file)
+    return Counter(future.result() for dst, future in futures)
@@ -7,14 +7,17 @@ geometry based sieving
 """
 
 import os
+import sys
+import copy
 import pickle
 
-from skimage import measure
-import pandas as pd
 import numpy as np
 import nibabel as nib
-from skimage import measure
-from sklearn import neighbors
+
+import tracing
+
+# scikit-image, scikit-learn and pandas are slow to import, so they are imported by the
+# functions that need them the first time they are called
 
 
 # PROPERTIES = ['area', 'extent', 'filled_area', 'inertia_tensor', 'major_axis_length', 'minor_axis_length'] # 3d compatible
@@ -42,33 +45,108 @@ def read_nifti(img_path):
     return img
 
 
-def label_2d(im):
-    labeled = im.copy()
-    vals_seen = []
+def slice_boxes(im):
+    """
+    Finds the slices of a 3d image that have nonzero voxels and the bounding
+    box of the nonzero pixels in each, so that work on sparse masks can skip
+    the empty parts of the volume
+    
+
+    Parameters
+    ----------
+    im : 3d np array
+        the image. Slices are taken along the last axis.
+
+    Returns
+    -------
+    list of (z, rows, cols) tuples, where im[rows, cols, z] is the cropped slice
+
+    """
+    boxes = []
+    for z in np.flatnonzero(np.any(im, axis=(0, 1))):
+        sli = im[:, :, z]
+        rows = np.flatnonzero(np.any(sli, axis=1))
+        cols = np.flatnonzero(np.any(sli, axis=0))
+        boxes.append((z, slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1)))
+    return boxes
+
+
+def _label_2d_with_boxes(im):
+    # label_2d, also returning the slice_boxes so callers don't search for them again
+    from skimage import measure
+    
+    labeled = np.zeros(im.shape, int)
+    boxes = slice_boxes(im)
     adder = 0
-    for i in range(labeled.shape[2]):
-        sli = im[:,:,i]
-        labeled_slice = measure.label(sli)
-        labeled_slice = labeled_slice + (adder * (~np.isclose(labeled_slice, 0)))# we are labeling every slice individually, but we don't want to reuse labels between slices
-        labeled[:,:,i] = labeled_slice
-        the_max = labeled_slice.max()
-        if the_max > 0:
-            adder = the_max
-        
-        vals_seen.extend(np.unique(labeled_slice))
-        vals_seen.remove(0)
-        '''        
-        print(f'Vals_seen: {vals_seen}')
-        print(f'Adder: {adder}')
-        print(f'Unique in this slice: {np.unique(labeled_slice)}')
-        print('\n')
-        '''
-        if len(vals_seen) > len(np.unique(vals_seen)):
-            raise Exception(f'Labels are not unique after slice {i}')
-        
-    return labeled.astype(int)
+    for z, rows, cols in boxes:
+        labeled_slice = measure.label(im[rows, cols, z])
+        # we are labeling every slice individually, but we don't want to reuse labels between slices
+        n_labels = labeled_slice.max()
+        labeled_slice[labeled_slice > 0] += adder
+        labeled[rows, cols, z] = labeled_slice
+        adder += n_labels
+        
+    return labeled, boxes
+
+
+@tracing.traced()
+def label_2d(im):
+    """
+    Labels the connected shapes of each axial slice of an image. Labels are
+    unique across the whole volume. Only the bounding box of the nonzero
+    pixels of each slice is labeled, so the time taken scales with the extent
+    of the lesions rather than the size of the scan
+    
+
+    Parameters
+    ----------
+    im : 3d np array
+        the binary (or labeled) image.
+
+    Returns
+    -------
+    3d int np array of labels, 0 being background
+
+    """
+    return _label_2d_with_boxes(im)[0]
+
+
+# regionprops_table columns that hold coordinates, which are shifted from crop coordinates back to slice coordinates
+_COORDINATE_PROPERTIES = ('bbox', 'centroid', 'centroid_weighted', 'weighted_centroid')
+
+
+def _slice_property_columns(labeled, boxes, props):
+    # regionprops_table of every cropped slice, as one array per column, and the number of shapes in each slice
+    from skimage import measure
+    
+    tables = []
+    for z, rows, cols in boxes:
+        table = measure.regionprops_table(labeled[rows, cols, z], properties=props)
+        for col in table:
+            base, _, axis = col.rpartition('-')
+            if base in _COORDINATE_PROPERTIES and axis.isdigit():
+                table[col] = table[col] + (rows.start, cols.start)[int(axis) % 2]
+        tables.append(table)
+    
+    if not tables:
+        return {}, np.zeros(0, int)
+    columns = {col: np.concatenate([t[col] for t in tables]) for col in tables[0]}
+    counts = np.array([len(t[next(iter(t))]) for t in tables])
+    return columns, counts
+
+
+def _slice_properties(labeled, boxes, props):
+    # regionprops_table of every cropped slice, as one DataFrame indexed within each slice
+    import pandas as pd
+    
+    columns, counts = _slice_property_columns(labeled, boxes, props)
+    if not columns:
+        return pd.DataFrame()
+    index = np.concatenate([np.arange(n) for n in counts])
+    return pd.DataFrame(columns, index=index)
 
 
+@tracing.traced()
 def generate_properties(im, props=PROPERTIES):
     """
     Generates geometric properties for shapes in the binary input image
@@ -87,29 +165,43 @@ def generate_properties(im, props=PROPERTIES):
         DESCRIPTION.
 
     """
-    X_train = pd.DataFrame()
-    
-    labeled = label_2d(im)
-    for i in range(labeled.shape[2]):
-        sli = labeled[:,:,i]
-        try:
-            X_train = X_train.append(pd.DataFrame(measure.regionprops_table(sli, properties=props)))
-        except IndexError:
-            pass # happens when the slice has no regions in it
+    labeled, boxes = _label_2d_with_boxes(im)
+    X_train = _slice_properties(labeled, boxes, props)
         
     return X_train
 
 
 def standardize_data(data, params):
+    """
+    Standardizes each column of the data with the means and stddevs in params
     
-    standard_data = data.copy()
+
+    Parameters
+    ----------
+    data : pandas DataFrame or 2d np array
+        one row per observation, with the columns in the order of params.
+        It is not modified.
+    params : tuple of lists
+        the means and stddevs of each column (see train_and_save).
+
+    Returns
+    -------
+    the standardized data, of the same type as data
+
+    """
+    pd = sys.modules.get('pandas') # a DataFrame can only exist if pandas is already imported
+    if pd is not None and isinstance(data, pd.DataFrame):
+        return pd.DataFrame(standardize_data(data.to_numpy(dtype=float), params),
+                            index=data.index, columns=data.columns)
     
-    for col, mean, stddev in zip(data.columns, params[0], params[1]):
-        standard_data[col] = (standard_data[col] - mean) / stddev
+    standard_data = np.array(data, dtype=float)
+    standard_data -= np.asarray(params[0], dtype=float)
+    standard_data /= np.asarray(params[1], dtype=float)
         
     return standard_data
 
 
+@tracing.traced()
 def train_and_save(training_data, outloc):
     """
     Trains a LOF algorithm for the purposes of novelty detection and pickles it
@@ -135,7 +227,7 @@ def train_and_save(training_data, outloc):
         of the stddevs used to transform the data
 
     """
-    standard_data = training_data.copy()
+    from sklearn import neighbors
     
     means = []
     stddevs = []
@@ -158,48 +250,215 @@ def train_and_save(training_data, outloc):
     return out_obj
     
 
-def load_default_model():
+def default_model_path():
     script_folder = os.path.dirname(os.path.realpath(__file__))
     repo_folder = os.path.dirname(script_folder)
     model_loc = os.path.join(repo_folder, 'bin', 'gbs_models', 'gbs_default.pkl')
     
+    return model_loc
+
+
+def load_default_model():
+    model_loc = default_model_path()
+    
     lof, params = pickle.load(open(model_loc, 'rb'))
     
     return lof, params
 
 
-def sieve_image(im, model_and_params=None, props=None):
+class Sieve:
+    """
+    A GBS model ready to sieve lesion masks. The model, standardization
+    parameters and feature list are fixed when the Sieve is made, and each
+    call works on its own labels and feature table, so one Sieve can be used
+    by many threads at once
     
-    if model_and_params is None:
-        model_and_params = load_default_model()
-    if props is None:
-        props=PROPERTIES
+
+    Parameters
+    ----------
+    model : fitted sklearn estimator
+        the novelty detector (see train_and_save).
+    params : tuple of lists
+        the means and stddevs used to standardize each feature.
+    props : list of str, optional
+        the regionprops the model was trained on. The default is PROPERTIES.
+
+    """
+    
+    def __init__(self, model, params, props=PROPERTIES):
+        self.model = model
+        self.params = (tuple(params[0]), tuple(params[1]))
+        self.props = tuple(p for p in props if p != 'label')
+        
+        self._means = np.asarray(self.params[0], dtype=float)
+        self._stddevs = np.asarray(self.params[1], dtype=float)
+        
+        # features are passed to the model as an array, so the feature names a model
+        # fitted on a DataFrame remembers are checked here once instead of warned about
+        # on every prediction. The copy shares the fitted arrays
+        self._feature_names = getattr(model, 'feature_names_in_', None)
+        self._predictor = model
+        if self._feature_names is not None:
+            self._predictor = copy.copy(model)
+            del self._predictor.feature_names_in_
+        self._columns = None if self._feature_names is None else tuple(self._feature_names)
+    
+    
+    @classmethod
+    def from_file(cls, model_loc, props=PROPERTIES):
+        """
+        Makes a Sieve from a model pickled by train_and_save
+        """
+        with open(model_loc, 'rb') as f:
+            model, params = pickle.load(f)
+        return cls(model, params, props)
     
-    model = model_and_params[0]
-    params = model_and_params[1]
     
-    labeled = label_2d(im)
-    #observations = pd.DataFrame(measure.regionprops_table(labeled, properties=props))
+    @classmethod
+    def default(cls, props=PROPERTIES):
+        """
+        Makes a Sieve from the default model
+        """
+        return cls.from_file(default_model_path(), props)
     
-    props_with_label = props
-    props_with_label.append('label')
     
-    observations = generate_properties(labeled, props=props_with_label)
-    labels_only = pd.DataFrame(observations['label'])
-    observations_drop = observations.drop(columns='label')
+    def feature_columns(self):
+        """
+        Returns the names of the feature columns, with multi-valued regionprops
+        expanded (e.g., inertia_tensor-0-0), as they appear in classify's table
+        """
+        if self._columns is None:
+            # regionprops names the expanded columns, so measure a small square once
+            square = np.zeros((5, 5), int)
+            square[1:4, 1:4] = 1
+            columns, counts = _slice_property_columns(square[:, :, np.newaxis], [(0, slice(0, 5), slice(0, 5))], list(self.props))
+            self._columns = tuple(columns)
+        return self._columns
     
-    standard_observations = standardize_data(observations_drop, params)
     
-    predictions = model.predict(standard_observations)
-    labels_only['prediction'] = predictions
+    def _predict(self, im):
+        # labels the mask and predicts every shape, keeping the features in one array
+        labeled, boxes = _label_2d_with_boxes(im)
+        columns, counts = _slice_property_columns(labeled, boxes, list(self.props) + ['label'])
+        if not columns:
+            return labeled, boxes, columns, counts, np.zeros(0, int)
+        
+        labels = columns.pop('label')
+        if self._feature_names is not None and list(columns) != list(self._feature_names):
+            raise ValueError(f'The features {list(columns)} do not match the features the model was fitted on, '
+                             f'{list(self._feature_names)}')
+        
+        features = np.empty((len(labels), len(columns)))
+        for i, values in enumerate(columns.values()):
+            features[:, i] = values
+        features -= self._means
+        features /= self._stddevs
+        
+        predictions = self._predictor.predict(features)
+        columns['label'] = labels
+        return labeled, boxes, columns, counts, predictions
+    
+    
+    def classify(self, im):
+        """
+        Labels the shapes in a binary mask and classifies each one
+        
+
+        Parameters
+        ----------
+        im : 3d np array
+            the binary mask. It is not modified.
+
+        Returns
+        -------
+        A tuple of the labeled mask, its slice_boxes and a DataFrame with one
+        row per shape giving its label, slice, features and prediction (1 to
+        keep, -1 to remove)
+
+        """
+        import pandas as pd
+        
+        labeled, boxes, columns, counts, predictions = self._predict(im)
+        if not columns:
+            return labeled, boxes, pd.DataFrame(columns=['label', 'slice', *self.feature_columns(), 'prediction'])
+        
+        lesions = pd.DataFrame({'label': columns.pop('label'),
+                                'slice': np.repeat([z for z, rows, cols in boxes], counts),
+                                **columns,
+                                'prediction': predictions})
+        
+        return labeled, boxes, lesions
+    
     
-    to_zero = [row['label'] for i, row in labels_only.iterrows() if row['prediction'] == -1]
+    @tracing.traced()
+    def sieve(self, im, return_lesions=False):
+        """
+        Removes the shapes in a binary mask that the model finds to be outliers
+        
+
+        Parameters
+        ----------
+        im : 3d np array
+            the binary mask. It is not modified.
+        return_lesions : bool, optional
+            if True, the per-shape table from classify is returned too. The
+            default is False.
+
+        Returns
+        -------
+        3d int np array, the sieved mask (and the table if return_lesions)
+
+        """
+        if return_lesions:
+            labeled, boxes, lesions = self.classify(im)
+            to_zero = lesions['label'][lesions['prediction'] == -1].to_numpy()
+        else:
+            labeled, boxes, columns, counts, predictions = self._predict(im)
+            to_zero = columns['label'][predictions == -1] if columns else None
+        
+        new_im = im.astype(int)
+        if boxes:
+            
+            # lookup table of rejected labels, applied to the occupied crops only
+            rejected = np.zeros(labeled.max() + 1, bool)
+            rejected[to_zero] = True
+            for z, rows, cols in boxes:
+                new_im[rows, cols, z][rejected[labeled[rows, cols, z]]] = 0
+        
+        if return_lesions:
+            return new_im, lesions
+        return new_im
     
-    mask = np.isin(labeled, to_zero)
     
-    new_im = im.copy()
-    new_im[mask] = 0
+    __call__ = sieve
+
+
+@tracing.traced()
+def sieve_image(im, model_and_params=None, props=None):
+    """
+    Removes the shapes in a binary mask that a GBS model finds to be outliers.
+    To sieve many masks with one model, make a Sieve once and call it instead
     
-    return new_im.astype(int)
+
+    Parameters
+    ----------
+    im : 3d np array
+        the binary mask. It is not modified.
+    model_and_params : tuple, optional
+        the (model, params) returned by train_and_save or load_default_model.
+        The default is None, which loads the default model.
+    props : list of str, optional
+        the regionprops the model was trained on. The default is None, which
+        uses PROPERTIES.
+
+    Returns
+    -------
+    3d int np array, the sieved mask
+
+    """
+    if model_and_params is None:
+        model_and_params = load_default_model()
+    if props is None:
+        props = PROPERTIES
     
-    
\ No newline at end of file
+    return Sieve(model_and_params[0], model_and_params[1], props).sieve(im)
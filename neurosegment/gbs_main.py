@@ -13,6 +13,7 @@ import pandas as pd
 import scipy
 
 import gbs
+import catalog
 
 
 # for generating a default model
@@ -23,27 +24,32 @@ pt_id_col = 'id'
 master_folder = '/Users/manusdonahue/Documents/Sky/segmentations_sci/pt_data/'
 out_model = 'gbs_default.pkl'
 
+catalog_file = None # if set, training patients and their masks come from this cohort catalog (see catalog.py) instead of master_csv and master_folder
+
 ##########
 
 script_folder = os.path.dirname(os.path.realpath(__file__))
 repo_folder = os.path.dirname(script_folder)
 out_model = os.path.join(repo_folder, 'bin', 'gbs_models', out_model)
 
-df = pd.read_csv(master_csv)
+if catalog_file:
+    with catalog.Catalog(catalog_file) as cat:
+        lesion_files = cat.paths('mask', cat.patients(training=1, having=['mask']))
+else:
+    df = pd.read_csv(master_csv)
+    lesion_files = {pt: os.path.join(master_folder, pt, 'processed', 'axFLAIR_mask.nii.gz')
+                    for pt, do_train in zip(df[pt_id_col], df[to_train_col]) if do_train == 1}
 
-training_data = pd.DataFrame()
-for pt, do_train in zip(df[pt_id_col], df[to_train_col]):
-    if do_train != 1:
-        continue
+lesion_infos = []
+for pt, lesion_file in lesion_files.items():
     print(f'Pulling data for {pt}')
     
-    folder = os.path.join(master_folder, pt, 'processed')
-    lesion_file = os.path.join(folder, 'axFLAIR_mask.nii.gz')
     lesion_im = gbs.read_nifti(lesion_file)
     
     lesion_info = gbs.generate_properties(lesion_im)
-    training_data = training_data.append(lesion_info)
+    lesion_infos.append(lesion_info)
     
+training_data = pd.concat(lesion_infos)
 
 print('Saving model')
 lof, params = gbs.train_and_save(training_data, out_model)
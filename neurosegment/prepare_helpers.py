@@ -0,0 +1,560 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Helpers shared by the move_and_prepare scripts in bin/
+"""
+
+import os
+import re
+import json
+import gzip
+import fnmatch
+import shutil
+import threading
+from datetime import datetime
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import numpy as np
+import nibabel as nib
+
+import tracing
+
+
+def same_filesystem(path, folder):
+    """
+    Returns whether a file and a folder are on the same filesystem (device)
+    """
+    return os.stat(path).st_dev == os.stat(folder).st_dev
+
+
+def list_parrecs(folder):
+    """
+    Lists the PAR/RECs in a folder with a single directory read. Hidden
+    files are skipped, as glob skips them
+
+
+    Parameters
+    ----------
+    folder : pathlike
+        the folder to list. A folder that does not exist has no PAR/RECs.
+
+    Returns
+    -------
+    A dict mapping each stem (the filename without .PAR/.REC) to a dict with
+    the 'PAR' and/or 'REC' path, whichever were found
+
+    """
+    parrecs = {}
+    try:
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'): # hidden files, e.g., macOS AppleDouble ._<scan>.PAR files on external drives, as glob skips them
+                    continue
+                stem, ext = os.path.splitext(entry.name)
+                if ext in ('.PAR', '.REC') and entry.is_file():
+                    parrecs.setdefault(stem, {})[ext[1:]] = entry.path
+    except FileNotFoundError:
+        pass
+    return parrecs
+
+
+class SignatureMatcher:
+    """
+    Identifies PAR/RECs by signature, as described by the
+    signature_relationships dicts of the move_and_prepare scripts: a file
+    matches a signature if its name matches any of the signature's
+    sub-signatures (glob-style, so 'MIP*MRA_COW' works) and its path contains
+    none of the 'excl' strings. The sub-signatures and the exclusions of each
+    signature are compiled into one regex each, and the folder is listed once
+    for all signatures
+
+
+    Parameters
+    ----------
+    signature_relationships : dict
+        maps tuples of sub-signatures to dicts with an 'excl' list.
+
+    """
+
+    def __init__(self, signature_relationships):
+        self.patterns = {}
+        for signature, subdict in signature_relationships.items():
+            include = re.compile('|'.join(f'(?:{fnmatch.translate(f"*{subsig}*")})' for subsig in signature))
+            exclude = re.compile('|'.join(re.escape(e) for e in subdict['excl'])) if subdict['excl'] else None
+            self.patterns[signature] = (include, exclude)
+
+
+    def matches(self, signature, path):
+        """
+        Returns whether a PAR or REC path matches a signature
+        """
+        include, exclude = self.patterns[signature]
+        stem = os.path.splitext(os.path.basename(path))[0]
+        return bool(include.match(stem)) and not (exclude is not None and exclude.search(path))
+
+
+    def match(self, folder):
+        """
+        Finds the PAR/RECs of every signature in a folder
+
+
+        Parameters
+        ----------
+        folder : pathlike
+            the folder to search (e.g., a patient's Acquired folder).
+
+        Returns
+        -------
+        A dict mapping each signature to a dict with the matching 'pars' and
+        'recs' and the 'pairs' of (PAR, REC) paths that share a stem, each
+        sorted by filename
+
+        """
+        parrecs = list_parrecs(folder)
+        found = {}
+        for signature in self.patterns:
+            pars, recs, pairs = [], [], []
+            for stem in sorted(parrecs):
+                files = parrecs[stem]
+                par = files.get('PAR')
+                rec = files.get('REC')
+                par = par if par is not None and self.matches(signature, par) else None
+                rec = rec if rec is not None and self.matches(signature, rec) else None
+                if par is not None:
+                    pars.append(par)
+                if rec is not None:
+                    recs.append(rec)
+                if par is not None and rec is not None:
+                    pairs.append((par, rec))
+            found[signature] = {'pars': pars, 'recs': recs, 'pairs': pairs}
+        return found
+
+
+def convert_parrec(par_path, out_path, scaling='dv', dtype=None):
+    """
+    Converts a Philips PAR/REC to NIfTI with nibabel, in place of dcm2nii.
+    Only the NIfTI is written, so the scan is not compressed and decompressed
+    again when the output is uncompressed
+
+
+    Parameters
+    ----------
+    par_path : pathlike
+        the .PAR file. The .REC must be next to it.
+    out_path : pathlike
+        the NIfTI to write. Use a .nii extension to skip compression (e.g.,
+        for intermediates that FSL reads next) or .nii.gz to compress.
+    scaling : str, optional
+        'dv' for the display values the scanner console shows or 'fp' for
+        floating point values. The default is 'dv'.
+    dtype : np dtype or None, optional
+        data type of the written image. The default is None, which keeps the
+        16-bit integer type the REC stores, with scl_slope and
+        scl_inter chosen by nibabel to fit the scaled values, as dcm2nii
+        writes them. np.float32 keeps the values exactly, but doubles the
+        size of int16 scans.
+
+    Returns
+    -------
+    out_path
+
+    """
+    img = nib.load(par_path, scaling=scaling)
+    if dtype is None:
+        dtype = img.get_data_dtype()
+
+    header = nib.Nifti1Header.from_header(img.header)
+    header.set_data_dtype(dtype)
+    nifti = nib.Nifti1Image(img.get_fdata(dtype=np.float32), img.affine, header)
+    nifti.set_qform(img.affine, code=1)
+    nifti.set_sform(img.affine, code=1)
+
+    nib.save(nifti, out_path)
+
+    return out_path
+
+
+def convert_parrecs(pairs, n_workers=None, use_processes=False, **kwargs):
+    """
+    Converts several PAR/RECs concurrently with convert_parrec
+
+
+    Parameters
+    ----------
+    pairs : list of (par_path, out_path) tuples
+        the conversions to run.
+    n_workers : int or None, optional
+        number of conversions run at once. The default is None, which uses the
+        number of CPUs.
+    use_processes : bool, optional
+        if True, conversions run in a process pool rather than a thread pool.
+        Only do this from scripts with an if __name__ == '__main__' guard, as
+        the pool may re-import the calling script. The default is False.
+    kwargs
+        passed to convert_parrec.
+
+    Returns
+    -------
+    list of the written paths
+
+    """
+    n_workers = n_workers or os.cpu_count() or 1
+    executor = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    with executor(max_workers=min(n_workers, max(len(pairs), 1))) as pool:
+        futures = [pool.submit(convert_parrec, par, out, **kwargs) for par, out in pairs]
+        return [f.result() for f in futures]
+
+
+def finalize_nifti(src, dst, compresslevel=6):
+    """
+    Moves an intermediate NIfTI to its final path. An uncompressed .nii going
+    to a .nii.gz is compressed on the way, so every output is gzipped exactly
+    once. Otherwise the file is moved, which is a rename on the same filesystem
+
+
+    Parameters
+    ----------
+    src : pathlike
+        the intermediate (.nii or .nii.gz). It is gone afterwards.
+    dst : pathlike
+        the final path (.nii or .nii.gz).
+    compresslevel : int, optional
+        gzip compression level, 1 (fastest) to 9 (smallest). The default is 6.
+
+    Returns
+    -------
+    dst
+
+    """
+    src_gz = src.endswith('.gz')
+    dst_gz = dst.endswith('.gz')
+    if src_gz and not dst_gz:
+        raise Exception(f'{src} is compressed but {dst} is not')
+
+    with tracing.stage('finalize_nifti', file=os.path.basename(dst), compressed=dst_gz and not src_gz):
+        if dst_gz and not src_gz:
+            part = f'{dst}.part'
+            with open(src, 'rb') as f_in, gzip.open(part, 'wb', compresslevel=compresslevel) as f_out:
+                shutil.copyfileobj(f_in, f_out, 1024**2)
+            os.replace(part, dst)
+            os.remove(src)
+        else:
+            shutil.move(src, dst)
+
+    return dst
+
+
+def finalize_niftis(pairs, n_workers=None, compresslevel=6):
+    """
+    Finalizes several NIfTIs concurrently with finalize_nifti. zlib releases
+    the GIL, so the compression runs in parallel in threads
+
+
+    Parameters
+    ----------
+    pairs : list of (src, dst) tuples
+        the files to finalize.
+    n_workers : int or None, optional
+        number of files finalized at once. The default is None, which uses the
+        number of CPUs.
+    compresslevel : int, optional
+        see finalize_nifti. The default is 6.
+
+    Returns
+    -------
+    list of the final paths
+
+    """
+    n_workers = n_workers or os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=min(n_workers, max(len(pairs), 1))) as pool:
+        futures = [pool.submit(finalize_nifti, src, dst, compresslevel) for src, dst in pairs]
+        return [f.result() for f in futures]
+
+
+class SourceStager:
+    """
+    Prefetches the source files of upcoming patients into a local staging
+    folder while the current patient is being processed, so copying from
+    slow (e.g., network) storage overlaps with conversion and registration.
+
+    Patients are submitted in processing order. Their files are copied in the
+    background, with at most max_in_flight copies running at once, at most
+    lookahead patients staged ahead of the one being processed and at most
+    max_bytes of staged data waiting to be claimed (a patient larger than the
+    budget is still staged, but only once nothing else is). Files that are
+    already on the same filesystem as the staging folder are not copied; they
+    are used where they are.
+
+
+    Parameters
+    ----------
+    staging_folder : pathlike
+        folder the copies are made in. It is created if needed and removed by
+        close(). Put it on the same filesystem as the output folders so that
+        claimed files are moved by renaming.
+    max_in_flight : int, optional
+        maximum number of concurrent copies. The default is 2.
+    max_bytes : int, optional
+        maximum bytes of staged, unclaimed files. The default is 8 GB.
+    lookahead : int, optional
+        maximum number of patients staged but not yet claimed. The default is 2.
+
+    """
+
+    def __init__(self, staging_folder, max_in_flight=2, max_bytes=8*1024**3, lookahead=2):
+        self.staging_folder = staging_folder
+        self.max_bytes = max_bytes
+        self.lookahead = lookahead
+
+        os.makedirs(staging_folder, exist_ok=True)
+
+        self.jobs = OrderedDict() # key -> job dict, in submission order
+        self.pending = [] # keys not yet started
+        self.bytes_staged = 0
+        self.n_staged = 0
+        self.closed = False
+        self.wanted = set() # keys being waited on, which start regardless of the limits
+        self.condition = threading.Condition()
+        self.pool = ThreadPoolExecutor(max_workers=max_in_flight)
+        self.dispatcher = threading.Thread(target=self.dispatch, daemon=True)
+        self.dispatcher.start()
+
+
+    def submit(self, key, files):
+        """
+        Queues the files of one patient (or any other unit of work) for staging
+        """
+        job = {'files': list(dict.fromkeys(files)), 'staged': {}, 'to_copy': [], 'bytes': 0,
+               'size': None, 'remaining': 0, 'error': None, 'started': False,
+               'done': threading.Event()}
+        with self.condition:
+            if key in self.jobs:
+                raise Exception(f'{key} has already been submitted for staging')
+            self.jobs[key] = job
+            self.pending.append(key)
+            self.condition.notify_all()
+
+
+    def dispatch(self):
+        while True:
+            with self.condition:
+                while not self.closed and not self.can_start():
+                    self.condition.wait()
+                if self.closed:
+                    return
+                key = self.pending.pop(0)
+                job = self.jobs[key]
+                job['started'] = True
+                self.n_staged += 1
+
+            try:
+                self.plan(key, job)
+            except Exception as e:
+                job['error'] = e
+
+            with self.condition:
+                self.bytes_staged += job['bytes']
+                if job['error'] is not None or not job['to_copy']:
+                    job['done'].set()
+                    continue
+                job['remaining'] = len(job['to_copy'])
+            for src, dst in job['to_copy']:
+                self.pool.submit(self.copy, key, job, src, dst)
+
+
+    def can_start(self):
+        # called with the condition held
+        if not self.pending:
+            return False
+        key = self.pending[0]
+        if key in self.wanted or self.n_staged == 0:
+            return True
+        if self.n_staged >= self.lookahead:
+            return False
+        job = self.jobs[key]
+        if job['size'] is None:
+            job['size'] = sum(os.path.getsize(f) for f in job['files'] if os.path.exists(f))
+        return self.bytes_staged + job['size'] <= self.max_bytes
+
+
+    def plan(self, key, job):
+        # decides which files need copying. Local files are used in place
+        folder = os.path.join(self.staging_folder, str(key))
+        for src in job['files']:
+            if same_filesystem(src, self.staging_folder):
+                job['staged'][src] = src
+                continue
+            os.makedirs(folder, exist_ok=True)
+            dst = os.path.join(folder, os.path.basename(src))
+            job['to_copy'].append((src, dst))
+            job['bytes'] += os.path.getsize(src)
+
+
+    def copy(self, key, job, src, dst):
+        try:
+            with tracing.stage('prefetch_copy', patient=str(key), file=os.path.basename(src)):
+                part = f'{dst}.part'
+                shutil.copyfile(src, part)
+                os.replace(part, dst)
+            with self.condition:
+                job['staged'][src] = dst
+        except Exception as e:
+            with self.condition:
+                job['error'] = e
+        with self.condition:
+            job['remaining'] -= 1
+            if job['remaining'] == 0:
+                job['done'].set()
+
+
+    def claim(self, key, folder=None):
+        """
+        Waits for a patient's files to be staged and hands them over
+
+
+        Parameters
+        ----------
+        key : hashable
+            the key the files were submitted with.
+        folder : pathlike or None, optional
+            if given, staged copies are moved into this folder. Files that
+            were used in place are not moved. The default is None, which
+            leaves staged copies in the staging folder until close().
+
+        Returns
+        -------
+        A dict mapping each submitted path to the path to read it from
+
+        """
+        with self.condition:
+            job = self.jobs[key]
+            if not job['started']:
+                # claimed before its turn, so start it next regardless of the limits
+                self.pending.remove(key)
+                self.pending.insert(0, key)
+                self.wanted.add(key)
+                self.condition.notify_all()
+
+        with tracing.stage('wait_for_sources'):
+            job['done'].wait()
+
+        try:
+            if job['error'] is not None:
+                raise job['error']
+
+            paths = {}
+            for src in job['files']:
+                staged = job['staged'][src]
+                if folder is not None and staged != src:
+                    moved = os.path.join(folder, os.path.basename(src))
+                    shutil.move(staged, moved)
+                    staged = moved
+                paths[src] = staged
+        finally:
+            self.release(key)
+
+        return paths
+
+
+    def release(self, key):
+        """
+        Frees the budget held by a claimed patient
+        """
+        with self.condition:
+            self.wanted.discard(key)
+            job = self.jobs.pop(key, None)
+            if job is None or not job['started']:
+                if key in self.pending:
+                    self.pending.remove(key)
+                return
+            self.n_staged -= 1
+            self.bytes_staged -= job['bytes']
+            self.condition.notify_all()
+
+
+    def discard(self, key):
+        """
+        Drops a patient that will not be claimed, deleting any staged copies
+        once they are finished
+        """
+        with self.condition:
+            job = self.jobs.get(key)
+            if job is None:
+                return
+            started = job['started']
+        if started:
+            job['done'].wait()
+            for src, dst in job['to_copy']:
+                if os.path.exists(dst):
+                    os.remove(dst)
+        self.release(key)
+
+
+    def close(self):
+        """
+        Stops staging and removes the staging folder
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.dispatcher.join()
+        self.pool.shutdown(wait=True)
+        shutil.rmtree(self.staging_folder, ignore_errors=True)
+
+
+class RunLedger:
+    """
+    Append-only JSON-lines log of the status of each patient in a run. A line
+    is written (and flushed) as soon as a patient is done, so the log survives
+    a crash and can be followed (e.g., with tail -f) while a long run is going.
+    Read it back with read_ledger
+
+
+    Parameters
+    ----------
+    path : pathlike
+        the ledger file. It is appended to if it exists.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, 'a', buffering=1)
+
+
+    def write(self, key, status):
+        """
+        Logs the status dict of one patient. Keys that are not strings (e.g.,
+        signature tuples) are written as str(key)
+        """
+        record = {'id': key, 'logged': datetime.now().isoformat(timespec='seconds')}
+        record.update({str(k): v for k, v in status.items()})
+        line = json.dumps(record, default=str)
+        with self.lock:
+            self.file.write(line + '\n')
+
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def read_ledger(path):
+    """
+    Reads a RunLedger file into a pandas DataFrame with one row per patient,
+    indexed by patient ID. If a patient was logged more than once, the last
+    record is used. Lists (tuples when they were logged) are turned back into tuples
+    """
+    import pandas as pd
+
+    records = {}
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            key = record.pop('id')
+            records[key] = {k: tuple(v) if isinstance(v, list) else v for k, v in record.items()}
+    return pd.DataFrame.from_dict(records, orient='index')
@@ -13,11 +13,18 @@ The procedure for extracting the midsagittal plane is based on the paper
 (https://ieeexplore.ieee.org/document/5872407)
 """
 
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
-import sympy as sp
 from scipy import ndimage
 import nibabel as nib
-from deepbrain import Extractor
+
+import tracing
+
+# sympy, scikit-image and deepbrain (TensorFlow) are slow to import, so they
+# are imported by the functions that need them the first time they are called
 
 
 def read_nifti(img_path):
@@ -40,7 +47,136 @@ def read_nifti(img_path):
     return img
     
 
-def skull_strip(img):
+_extractor = None # the deepbrain model, loaded once per process
+_extractor_lock = threading.Lock()
+
+
+def get_extractor():
+    """
+    Returns the process-wide deepbrain Extractor, building its TensorFlow
+    graph and loading its weights on the first call only
+    """
+    global _extractor
+    with _extractor_lock:
+        if _extractor is None:
+            from deepbrain import Extractor
+            _extractor = Extractor()
+    return _extractor
+
+
+class SkullStripper:
+    """
+    Skull strips scans with deepbrain, reusing one loaded model for every scan
+    and running scans through the network in batches.
+    
+    Each scan is resized to the network's input size and normalized as in
+    deepbrain's Extractor.run, and the predicted probabilities are resized
+    back. Resizing is done on a thread pool while the network runs
+    
+
+    Parameters
+    ----------
+    batch_size : int, optional
+        number of scans per network call. The default is 4.
+    n_threads : int or None, optional
+        number of threads for resizing. The default is None, which uses the
+        number of CPUs.
+    threshold : float, optional
+        brain probability above which a voxel is kept. The default is 0.5.
+
+    """
+    
+    def __init__(self, batch_size=4, n_threads=None, threshold=0.5):
+        self.batch_size = batch_size
+        self.n_threads = n_threads or os.cpu_count() or 1
+        self.threshold = threshold
+        
+        
+    def to_network(self, img):
+        size = get_extractor().SIZE
+        from skimage.transform import resize
+        small = resize(img, (size, size, size), mode='constant', anti_aliasing=True)
+        small = small / np.max(small)
+        return small.astype(np.float32)[..., np.newaxis]
+    
+    
+    def from_network(self, prob, shape):
+        from skimage.transform import resize
+        prob = resize(prob, shape, mode='constant', anti_aliasing=True)
+        return prob > self.threshold
+    
+    
+    def run_network(self, batch):
+        ext = get_extractor()
+        try:
+            prob = ext.sess.run(ext.prob, feed_dict={ext.training: False, ext.img: np.stack(batch)})
+            return list(np.reshape(prob, (len(batch),) + batch[0].shape[:3]))
+        except Exception:
+            # the graph may only accept a single scan at a time
+            return [ext.sess.run(ext.prob, feed_dict={ext.training: False, ext.img: b[np.newaxis]}).squeeze()
+                    for b in batch]
+        
+        
+    def masks(self, imgs):
+        """
+        Finds the brain mask of each scan
+        
+
+        Parameters
+        ----------
+        imgs : list of numpy arrays
+            3d np arrays representing the scans.
+
+        Returns
+        -------
+        list of 3d bool np arrays
+
+        """
+        
+        masks = []
+        with ThreadPoolExecutor(max_workers=self.n_threads) as pool:
+            for i in range(0, len(imgs), self.batch_size):
+                chunk = imgs[i:i+self.batch_size]
+                batch = list(pool.map(self.to_network, chunk))
+                probs = self.run_network(batch)
+                masks.extend(pool.map(self.from_network, probs, [im.shape for im in chunk]))
+                
+        return masks
+    
+    
+    @tracing.traced()
+    def strip(self, imgs, in_place=False):
+        """
+        Skull strips each scan
+        
+
+        Parameters
+        ----------
+        imgs : list of numpy arrays
+            3d np arrays representing the scans.
+        in_place : bool, optional
+            if True, non-brain voxels are zeroed in the input arrays rather than
+            in copies. The default is False.
+
+        Returns
+        -------
+        A list of tuples containing each skull-stripped image followed by its mask
+
+        """
+        
+        out = []
+        for img, mask in zip(imgs, self.masks(imgs)):
+            if in_place:
+                img[~mask] = 0
+                stripped_img = img
+            else:
+                stripped_img = np.where(mask, img, 0)
+            out.append((stripped_img, mask))
+            
+        return out
+    
+
+def skull_strip(img, in_place=False):
     """
     Removes non-brain voxels from a scan
     
@@ -49,46 +185,112 @@ def skull_strip(img):
     ----------
     img : numpy array
         3d np array representing the scan
+    in_place : bool, optional
+        if True, non-brain voxels are zeroed in img itself rather than in a
+        copy. The default is False.
 
     Returns
     -------
     A tuple containing the skull-stripped image followed by the binary mask
-    used to strip the original image
+    (as a bool array) used to strip the original image
 
     """
-    ext = Extractor()
-
-    # `prob` will be a 3d numpy image containing probability 
-    # of being brain tissue for each of the voxels in `img`
-    prob = ext.run(img) 
-    # mask can be obtained as:
-    mask = prob > 0.5
     
-    stripped_img = img*mask
+    return SkullStripper(batch_size=1).strip([img], in_place=in_place)[0]
+
+
+def sobelize(img, axes=(-1,), output=None):
+    """
+    Wrapper to apply a 3d Sobel operator to the img. With a single axis this
+    is the signed Sobel derivative along it; with several axes it is the
+    gradient magnitude over them (see gradient_magnitude)
+
+    Parameters
+    ----------
+    img : numpy array
+        3d np array representing the image.
+    axes : tuple of ints, optional
+        the axes to differentiate along. The default is (-1,), the z axis.
+    output : float32 numpy array or None, optional
+        array to write the result into, with the same shape as img. The
+        default is None, which allocates a new one.
+
+    Returns
+    -------
+    float32 numpy array of the image as processed by the Sobel operator.
+
+    """
+    if len(axes) == 1:
+        if output is None:
+            output = np.empty(img.shape, np.float32)
+        ndimage.sobel(img, axis=axes[0], output=output)
+        return output
     
-    return stripped_img, mask
+    return gradient_magnitude(img, axes=axes, output=output)
 
 
-def sobelize(img):
+@tracing.traced()
+def gradient_magnitude(img, axes=(0,1,2), output=None):
     """
-    Wrapper to apply a 3d Sobel operator to the img
+    Computes the Sobel gradient magnitude of an image over the given axes,
+    sqrt(sum of the squared Sobel derivatives), entirely in float32. Only one
+    float32 scratch volume is allocated besides the output
+    
 
     Parameters
     ----------
     img : numpy array
         3d np array representing the image.
+    axes : tuple of ints, optional
+        the axes to differentiate along. The default is (0,1,2). Use (0,1) for
+        in-plane edges of an axial scan.
+    output : float32 numpy array or None, optional
+        array to write the result into, with the same shape as img. The
+        default is None, which allocates a new one.
 
     Returns
     -------
-    numpy array of the image as processed by the Sobel operator.
+    float32 numpy array of the gradient magnitude (output if it was given).
+
+    """
+    if output is None:
+        output = np.empty(img.shape, np.float32)
+    elif output.shape != img.shape or output.dtype != np.float32:
+        raise Exception(f'output must be a float32 array of shape {img.shape}')
+    
+    if img.dtype != np.float32:
+        img = img.astype(np.float32)
+    
+    output[...] = 0
+    derivative = np.empty(img.shape, np.float32)
+    for axis in axes:
+        ndimage.sobel(img, axis=axis, output=derivative)
+        np.multiply(derivative, derivative, out=derivative)
+        output += derivative
+    np.sqrt(output, out=output)
+    
+    return output
+
 
+def percentile_value(values, percentile):
+    """
+    Returns the given percentile of a 1d array, interpolated the same way as
+    np.percentile, but found with np.partition on the array itself (which is
+    reordered) rather than on a sorted copy
     """
-    sobeled = ndimage.sobel(img, axis=-1)
+    n = len(values)
+    if n == 0:
+        raise Exception('Cannot take the percentile of an empty array')
     
-    return sobeled
+    position = percentile / 100 * (n - 1)
+    lo = int(np.floor(position))
+    hi = min(lo + 1, n - 1)
+    values.partition([lo, hi])
+    
+    return float(values[lo] + (values[hi] - values[lo]) * (position - lo))
 
 
-def binary_by_percentile_threshold(img, threshold=95, invert=False):
+def binary_by_percentile_threshold(img, threshold=95, invert=False, mask=None):
     """
     Takes an array and sets pixels to 1 or 0 depending on if they exceed a
     threshold value as defined by the value at a given threshold percentile.
@@ -110,6 +312,10 @@ def binary_by_percentile_threshold(img, threshold=95, invert=False):
         By default, pixels above the threshold are set to 1 and those not
         exceeding the threshold are set to 0. If invert is True, this scheme is
         inverted. The default is False.
+    mask : bool numpy array or None, optional
+        if given, the percentile is taken over the voxels in the mask only and
+        voxels outside it are set to 0. The default is None, which uses the
+        whole image.
 
     Returns
     -------
@@ -118,14 +324,68 @@ def binary_by_percentile_threshold(img, threshold=95, invert=False):
 
     """
     
-    absolute_thresh = np.percentile(img, threshold)
+    filtered, absolute_thresh = threshold_by_percentile(img, threshold, invert, mask)
+    
+    return filtered.astype(int), absolute_thresh
+
+
+def threshold_by_percentile(img, threshold=95, invert=False, mask=None):
+    """
+    Same as binary_by_percentile_threshold, but returns the binary image as
+    a bool array
+    """
+    
+    values = img[mask] if mask is not None else img.ravel().copy()
+    absolute_thresh = percentile_value(values, threshold)
+    del values
     
     if invert:
-        filtered = img<= absolute_thresh
+        filtered = img <= absolute_thresh
     else:
         filtered = img >= absolute_thresh
     
-    return filtered.astype(int), absolute_thresh
+    if mask is not None:
+        filtered &= mask
+    
+    return filtered, absolute_thresh
+
+
+@tracing.traced()
+def edge_map(img, mask=None, threshold=95, invert=False, axes=(0,1,2), output=None):
+    """
+    Finds edges in a scan by thresholding its Sobel gradient magnitude at a
+    percentile, for use in scoring candidate midsagittal planes
+    
+
+    Parameters
+    ----------
+    img : numpy array
+        3d np array representing the (skull-stripped) scan.
+    mask : bool numpy array or None, optional
+        the brain mask. The percentile is taken over the voxels in it, so the
+        background does not dilute it, and no edges are reported outside it.
+        The default is None, which uses the whole image.
+    threshold : float, optional
+        the percentile of the gradient magnitude to threshold at. The default is 95.
+    invert : bool, optional
+        if True, voxels at or below the threshold are edges rather than those
+        at or above it. See binary_by_percentile_threshold. The default is False.
+    axes : tuple of ints, optional
+        the axes to take the gradient over. The default is (0,1,2).
+    output : float32 numpy array or None, optional
+        scratch array the gradient magnitude is written into, so repeated
+        calls on same-sized scans can reuse it. The default is None.
+
+    Returns
+    -------
+    A tuple of the edges as a bool array followed by the absolute value of
+    the threshold.
+
+    """
+    
+    magnitude = gradient_magnitude(img, axes=axes, output=output)
+    
+    return threshold_by_percentile(magnitude, threshold, invert, mask)
     
 
 '''  DEFUNCT: sympy has built in functionality to do this
@@ -188,6 +448,8 @@ def intersection_of_plane_with_slice(slice_index, plane):
 
     """
 
+    import sympy as sp
+    
     # set up the plane of the slice
     flat_plane = sp.Plane((1,0,slice_index),(-1,0,slice_index),(0,1,slice_index))
     
@@ -245,7 +507,8 @@ def calculate_projected_plane_coords(slice_index, plane, x_domain = (0,500)):
     Tuple of lists containing the x and y coords of the intersecting line.
 
     """
-
+    import sympy as sp
+    
     inter = intersection_of_plane_with_slice(slice_index, plane)
     intersection_2d = sp.Line(
         (inter.p1[0], inter.p1[1]),(inter.p2[0], inter.p2[1])
@@ -284,6 +547,7 @@ def is_partnered(coordinates, image, line):
     original_val = image[x,y]
     if original_val == 0:
         return 0
+    import sympy as sp
     original_coords= sp.Point(coordinates[0],coordinates[1])
     reflected_coords = original_coords.reflect(line)
     # not always going to be an int, need to coerce
@@ -302,6 +566,7 @@ def is_partnered(coordinates, image, line):
     return int(original_val == reflected_val)
 
 
+@tracing.traced()
 def score_midsagittal(image, plane, n_slices=None):
     """
     Scores the quality of an approximated midsagittal plane based on symmetry of
@@ -332,15 +597,16 @@ def score_midsagittal(image, plane, n_slices=None):
     
     for z in range(num_z_levels):
         sub_image = image[:,:,z]
-        n_edges += sum(sum(sub_image))
+        n_slice_edges = np.count_nonzero(sub_image)
+        n_edges += n_slice_edges
         reflecting_line = intersection_of_plane_with_slice(z, plane)
-        print(f'On level --{z}-- ({sum(sum(sub_image))} pixels to check)')
+        print(f'On level --{z}-- ({n_slice_edges} pixels to check)')
         
         scoreboard = np.zeros((image.shape[0], image.shape[1]))
         for x in range( image.shape[0]):
             for y in range(image.shape[1]):
                 scoreboard[x,y] = is_partnered((x,y), sub_image, reflecting_line)
-        n_paired += sum(sum(scoreboard))
+        n_paired += scoreboard.sum()
         
     return n_paired / n_edges
         
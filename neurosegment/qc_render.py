@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Renders QC thumbnails of scans in parallel and indexes them in an HTML
+contact sheet
+
+Only the displayed slice of each scan is read (nibabel's array proxy reads
+a slice without loading the volume), figures are drawn with the Agg canvas
+outside of pyplot so nothing accumulates between patients, and patients are
+rendered in a process pool. Call render_cohort from under an
+if __name__ == '__main__' guard, as the pool may re-import the calling script
+"""
+
+import os
+import html
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+import nibabel as nib
+
+import tracing
+
+
+def middle_slice(path, axis=2):
+    """
+    Reads the middle slice of a scan without loading the whole volume
+
+
+    Parameters
+    ----------
+    path : pathlike
+        the NIfTI.
+    axis : int, optional
+        the axis to slice across. The default is 2 (axial).
+
+    Returns
+    -------
+    2d float32 np array
+
+    """
+    img = nib.load(path)
+    index = [slice(None)] * len(img.shape)
+    index[axis] = img.shape[axis] // 2
+    for extra in range(3, len(img.shape)): # first volume of 4d scans
+        index[extra] = 0
+    return np.asarray(img.dataobj[tuple(index)], dtype=np.float32)
+
+
+@tracing.traced()
+def render_patient(mr_id, scans, fig_name, dpi=100):
+    """
+    Renders the middle slice of each of a patient's scans side by side
+
+
+    Parameters
+    ----------
+    mr_id : str
+        the patient, used as the figure title.
+    scans : list of (path, title) tuples
+        the scans to show. Missing scans get an empty panel.
+    fig_name : pathlike
+        the image to write.
+    dpi : int, optional
+        resolution of the image. The default is 100.
+
+    Returns
+    -------
+    A dict with the mr_id, the fig_name and a list of the missing scans
+
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure(figsize=(4*len(scans), 4.4))
+    FigureCanvasAgg(fig)
+    fig.suptitle(mr_id)
+    axes = fig.subplots(1, len(scans), squeeze=False)[0]
+
+    missing = []
+    for (path, title), ax in zip(scans, axes):
+        ax.set_title(title)
+        ax.axis('off')
+        try:
+            sli = np.rot90(middle_slice(path).T, 2)
+        except FileNotFoundError:
+            missing.append(path)
+            continue
+        ax.imshow(sli, cmap='gray')
+
+    fig.tight_layout()
+    fig.savefig(fig_name, dpi=dpi)
+    fig.clear()
+
+    return {'mr_id': mr_id, 'fig_name': fig_name, 'missing': missing}
+
+
+def _render_job(job):
+    return render_patient(*job)
+
+
+def render_cohort(jobs, n_workers=None, use_processes=True):
+    """
+    Renders many patients concurrently with render_patient
+
+
+    Parameters
+    ----------
+    jobs : list of (mr_id, scans, fig_name) tuples
+        arguments for render_patient.
+    n_workers : int or None, optional
+        number of patients rendered at once. The default is None, which uses
+        the number of CPUs.
+    use_processes : bool, optional
+        if True, patients are rendered in a process pool, otherwise in a
+        thread pool. The default is True.
+
+    Returns
+    -------
+    list of the render_patient results, in the order of jobs
+
+    """
+    n_workers = n_workers or os.cpu_count() or 1
+    executor = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    with executor(max_workers=max(1, min(n_workers, len(jobs)))) as pool:
+        chunksize = max(1, len(jobs) // (4*n_workers)) if use_processes else 1
+        return list(pool.map(_render_job, jobs, chunksize=chunksize))
+
+
+def write_contact_sheet(results, html_name, title='QC', thumb_width=360):
+    """
+    Writes an HTML page that shows every rendered image in a grid
+
+
+    Parameters
+    ----------
+    results : list of dicts
+        render_patient results.
+    html_name : pathlike
+        the page to write. Images are linked relative to it.
+    title : str, optional
+        page title. The default is 'QC'.
+    thumb_width : int, optional
+        width of each thumbnail in pixels. The default is 360.
+
+    Returns
+    -------
+    html_name
+
+    """
+    folder = os.path.dirname(os.path.abspath(html_name))
+    cells = []
+    for r in results:
+        src = html.escape(os.path.relpath(os.path.abspath(r['fig_name']), folder))
+        note = ''
+        if r['missing']:
+            note = f'<br><span class="missing">missing: {html.escape(", ".join(os.path.basename(m) for m in r["missing"]))}</span>'
+        cells.append(f'<figure><a href="{src}"><img src="{src}" width="{thumb_width}" loading="lazy"></a>'
+                     f'<figcaption>{html.escape(r["mr_id"])}{note}</figcaption></figure>')
+
+    page = f"""<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{html.escape(title)}</title>
+<style>
+body {{ font-family: sans-serif; }}
+figure {{ display: inline-block; margin: 6px; text-align: center; }}
+.missing {{ color: #b00; }}
+</style>
+</head>
+<body>
+<h1>{html.escape(title)} ({len(results)} patients)</h1>
+{chr(10).join(cells)}
+</body>
+</html>
+"""
+    with open(html_name, 'w') as f:
+        f.write(page)
+    return html_name
@@ -1,5 +1,5 @@
 #!/usr/bin/env python3
-# -*- coding: utraining_folder-8 -*-
+# -*- coding: utf-8 -*-
 """
 Generates BIANCA models and validates with repeated leave-one-out validation
 """
@@ -9,6 +9,7 @@ import time
 import pandas as pd
 
 import bianca_helpers as bh
+import tracing
 
 training_folder = '/Users/manusdonahue/Documents/Sky/segmentations_sci/pt_data/'
 master_file_path = '/Users/manusdonahue/Documents/Sky/segmentations_sci/bianca/big_validation_with_spatial_master.txt'
@@ -25,11 +26,19 @@ transmat_col = 4 # which index has the transformation matrix from scan to MNI sp
 thresh = 0.7
 
 validation_folder = '/Users/manusdonahue/Documents/Sky/segmentations_sci/bianca/big_validation_with_spatial/' # should not exist
+
+trace_stages = False # if True, write per-model timings to a JSON-lines trace (and a summary csv) in validation_folder (or set NEUROSEGMENT_TRACE to the path of a trace file)
+
+catalog_file = None # if set, training patients and their files come from this cohort catalog (see catalog.py) instead of input_csv and training_folder
+training_kinds = ['flair', 't1', 'mask', 'omat'] # the catalog artifact types, in the order of training_stems
 ####
 
 
-col_n = bh.generate_master(training_folder, master_file_path, training_subfolder,
-                           training_stems, input_csv, training_boolean_column_header, pt_id_col_header)
+if catalog_file:
+    col_n = bh.generate_master_from_catalog(catalog_file, master_file_path, training_kinds)
+else:
+    col_n = bh.generate_master(training_folder, master_file_path, training_subfolder,
+                               training_stems, input_csv, training_boolean_column_header, pt_id_col_header)
 
 master_file = open(master_file_path, 'r')
 content = master_file.read()
@@ -40,11 +49,16 @@ report_name = os.path.join(validation_folder, 'BIANCA_report.csv')
 labels = ['SI', 'FDR', 'FNR', 'FDR_clus', 'FNR_clus', 'MTA', 'DER', 'OER', 'BIANCA_vol', 'manual_vol']
 report = pd.DataFrame(columns=labels)
 
+trace_file_name = os.path.join(validation_folder, 'BIANCA_trace.jsonl')
+if trace_stages and not tracing.is_enabled():
+    tracing.enable(trace_file_name)
+
 start = time.time()
 
 for i, row in enumerate(content_list):
     
     excl = i+1 # the row that will be left out
+    tracing.set_patient(f'leave_out_{excl}')
     
     elap = time.time() - start
     print(f'Generating BIANCA model (leave-one-out: {excl}). Elapsed time: {round(elap/60, 2)} minutes')
@@ -99,5 +113,9 @@ report.to_csv(report_name)
 
 total_time = time.time() - start
 print(f'Finished. Total running time: {round(total_time/60, 2)} minutes')
+
+if trace_stages and os.path.exists(trace_file_name): # not written if NEUROSEGMENT_TRACE already chose a trace file
+    tracing.disable()
+    tracing.summarize(trace_file_name, os.path.join(validation_folder, 'BIANCA_trace_summary.csv'))
     
     
\ No newline at end of file
@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Long-lived local segmentation service. Keeps the BIANCA classifier data and
+the GBS model loaded so that each job only pays for its own compute
+
+Start it with
+    python segmentation_service.py [port]
+
+Jobs are sent over a localhost socket as dicts, authenticated with a random
+key that the service generates on first start and keeps in a file only its
+user can read (see key_path), so only that user's processes can submit jobs:
+    {'job': 'bianca', 'flair': path, 't1': path, 'trans': path or None,
+     'model': path, 'outname': optional path to write the map to}
+    {'job': 'sieve', 'mask': path, array or shared memory description,
+     'outname': optional path to write the sieved mask to}
+Arrays can be passed by shared memory ({'shm': name, 'shape': shape,
+'dtype': dtype}, see share_array) to avoid pickling large volumes.
+
+Jobs are queued and taken in batches: BIANCA jobs that use the same model
+have their features stacked into a single KD-tree query, and the sieve jobs
+of a batch run concurrently in a thread pool sharing one gbs.Sieve. Both
+models are reloaded automatically when their files change on disk.
+
+UGLI uses the service through get_client(), which returns None when no
+service is running (or its key cannot be read) so UGLI falls back to working
+in-process. The batch scripts do not use it: batch_sieve.py runs its own
+process pool with a model loaded in each worker and writes per-lesion tables
+the service does not produce, and run_bianca.py drives the bianca executable
+"""
+
+import os
+import sys
+import stat
+import queue
+import secrets
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory, AuthenticationError
+from multiprocessing.connection import Listener, Client
+
+import numpy as np
+import nibabel as nib
+
+import bianca_classifier as bc
+
+
+DEFAULT_PORT = 6174
+KEY_ENV = 'NEUROSEGMENT_SERVICE_KEY' # overrides the path of the key file
+MAX_BATCH = 8 # maximum number of queued jobs handled together
+SIEVE_WORKERS = 4 # number of sieve jobs run at once
+
+
+def key_path():
+    """
+    Returns the path of the file holding the service's key,
+    ~/.neurosegment/service.key unless NEUROSEGMENT_SERVICE_KEY is set
+    """
+    return os.environ.get(KEY_ENV) or os.path.join(os.path.expanduser('~'), '.neurosegment', 'service.key')
+
+
+def load_authkey(create=False):
+    """
+    Reads the service's key, refusing a key file that other users could read
+    or that belongs to someone else
+
+
+    Parameters
+    ----------
+    create : bool, optional
+        if True and there is no key file, a random key is generated and
+        written to a new file readable only by the current user. The default
+        is False.
+
+    Returns
+    -------
+    bytes, the key, or None if there is no key file and create is False
+
+    """
+    path = key_path()
+    if create and not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError: # made by another service starting at the same time
+            pass
+        else:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(secrets.token_hex(32).encode())
+
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        return None
+    with os.fdopen(fd, 'rb') as f:
+        info = os.fstat(f.fileno())
+        if hasattr(os, 'getuid') and info.st_uid != os.getuid():
+            raise PermissionError(f'The service key {path} belongs to another user')
+        if info.st_mode & (stat.S_IRWXG | stat.S_IRWXO):
+            raise PermissionError(f'The service key {path} can be read by other users. Run chmod 600 on it')
+        key = f.read().strip()
+    if not key:
+        raise PermissionError(f'The service key {path} is empty')
+    return key
+
+
+def share_array(arr):
+    """
+    Copies an array into a new shared memory block
+
+
+    Parameters
+    ----------
+    arr : np array
+        the array to share.
+
+    Returns
+    -------
+    A tuple of the SharedMemory object (which the caller must close and
+    unlink when done) and the dict that describes it in a job
+
+    """
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    shared = np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)
+    shared[...] = arr
+    description = {'shm': shm.name, 'shape': arr.shape, 'dtype': arr.dtype.str}
+    return shm, description
+
+
+def resolve_array(spec):
+    """
+    Returns the array a job refers to, whether it was given as an array, a
+    path to a NIfTI or a shared memory description. Shared memory is copied
+    so the client can release it as soon as the reply arrives
+    """
+    if isinstance(spec, np.ndarray):
+        return spec
+    if isinstance(spec, dict):
+        shm = shared_memory.SharedMemory(name=spec['shm'])
+        try:
+            arr = np.ndarray(spec['shape'], dtype=np.dtype(spec['dtype']), buffer=shm.buf).copy()
+        finally:
+            shm.close()
+        return arr
+    return nib.load(spec).get_fdata()
+
+
+class SegmentationService:
+    """
+    Server side of the service
+
+
+    Parameters
+    ----------
+    port : int, optional
+        localhost port to listen on. The default is DEFAULT_PORT.
+    authkey : bytes or None, optional
+        key clients must present. The default is None, which reads the key
+        file (see load_authkey), generating it if needed.
+    max_batch : int, optional
+        maximum number of jobs handled together. The default is MAX_BATCH.
+    sieve_workers : int, optional
+        number of sieve jobs run at once. The default is SIEVE_WORKERS.
+
+    """
+
+    def __init__(self, port=DEFAULT_PORT, authkey=None, max_batch=MAX_BATCH, sieve_workers=SIEVE_WORKERS):
+        self.address = ('localhost', port)
+        self.authkey = authkey if authkey is not None else load_authkey(create=True)
+        self.max_batch = max_batch
+        self.jobs = queue.Queue()
+        self.gbs_sieve = None
+        self.gbs_mtime = None
+        self.sieve_pool = ThreadPoolExecutor(max_workers=sieve_workers)
+
+
+    def get_gbs_sieve(self):
+        import gbs
+        
+        # reload the GBS model if it has been retrained since it was loaded
+        mtime = os.path.getmtime(gbs.default_model_path())
+        if self.gbs_sieve is None or mtime != self.gbs_mtime:
+            self.gbs_sieve = gbs.Sieve.default()
+            self.gbs_mtime = mtime
+        return self.gbs_sieve
+
+
+    def serve_forever(self):
+        worker = threading.Thread(target=self.work, daemon=True)
+        worker.start()
+
+        with Listener(self.address, authkey=self.authkey) as listener:
+            print(f'Segmentation service listening on {self.address[0]}:{self.address[1]}')
+            while True:
+                try:
+                    conn = listener.accept()
+                except Exception as e:
+                    print(f'Rejected connection: {e}')
+                    continue
+                threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+
+    def handle(self, conn):
+        # each connection sends jobs one at a time and waits for the reply
+        with conn:
+            while True:
+                try:
+                    request = conn.recv()
+                except (EOFError, OSError):
+                    return
+                if request.get('job') == 'ping':
+                    conn.send({'ok': True, 'result': 'pong'})
+                    continue
+                reply = queue.Queue(maxsize=1)
+                self.jobs.put((request, reply))
+                conn.send(reply.get())
+
+
+    def work(self):
+        while True:
+            batch = [self.jobs.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.jobs.get_nowait())
+                except queue.Empty:
+                    break
+
+            bianca_jobs = [(r, q) for r, q in batch if r.get('job') == 'bianca']
+            other_jobs = [(r, q) for r, q in batch if r.get('job') != 'bianca']
+
+            by_model = {}
+            for r, q in bianca_jobs:
+                by_model.setdefault(r.get('model'), []).append((r, q))
+            for model, jobs in by_model.items():
+                self.run_bianca_batch(model, jobs)
+
+            sieve_jobs = [(r, q) for r, q in other_jobs if r.get('job') == 'sieve']
+            if sieve_jobs:
+                self.run_sieve_batch(sieve_jobs)
+
+            for r, q in other_jobs:
+                if r.get('job') != 'sieve':
+                    q.put({'ok': False, 'error': f'Unknown job {r.get("job")}'})
+
+
+    def run_bianca_batch(self, model, jobs):
+        try:
+            classifier = bc.get_classifier(model)
+        except Exception as e:
+            for r, q in jobs:
+                q.put({'ok': False, 'error': repr(e)})
+            return
+
+        # build every subject's features, then classify them with one stacked query
+        subjects = []
+        for r, q in jobs:
+            try:
+                images, mask, img, mat = bc.load_subject(r['flair'], r['t1'], r.get('trans'))
+                features = classifier.build_features(images, mask, img, mat)
+                subjects.append((r, q, mask, img, features))
+            except Exception as e:
+                q.put({'ok': False, 'error': repr(e)})
+
+        if not subjects:
+            return
+
+        try:
+            probs = classifier.predict_features(np.vstack([s[4] for s in subjects]))
+        except Exception as e:
+            for r, q, mask, img, features in subjects:
+                q.put({'ok': False, 'error': repr(e)})
+            return
+
+        start = 0
+        for r, q, mask, img, features in subjects:
+            prob = np.zeros(mask.shape, np.float32)
+            prob[mask] = probs[start:start+len(features)]
+            start += len(features)
+            try:
+                q.put({'ok': True, 'result': self.finish(r, prob, img)})
+            except Exception as e:
+                q.put({'ok': False, 'error': repr(e)})
+
+
+    def run_sieve_batch(self, jobs):
+        try:
+            sieve = self.get_gbs_sieve()
+        except Exception as e:
+            for r, q in jobs:
+                q.put({'ok': False, 'error': repr(e)})
+            return
+
+        # a Sieve holds no per-call state, so the jobs share it
+        futures = [(q, self.sieve_pool.submit(self.run_sieve, r, sieve)) for r, q in jobs]
+        for q, future in futures:
+            try:
+                q.put({'ok': True, 'result': future.result()})
+            except Exception as e:
+                q.put({'ok': False, 'error': repr(e)})
+
+
+    def run_sieve(self, request, sieve):
+        im = resolve_array(request['mask'])
+        sieved = sieve(im)
+        template = nib.load(request['mask']) if isinstance(request['mask'], str) else None
+        return self.finish(request, sieved, template)
+
+
+    def finish(self, request, result, template=None):
+        # results are either written to disk (returning the path) or sent back
+        outname = request.get('outname')
+        if outname is None:
+            return result
+        if template is None:
+            raise Exception('outname requires the input to be given as a path')
+        nib.save(nib.Nifti1Image(result, template.affine, template.header), outname)
+        return outname
+
+
+class SegmentationClient:
+    """
+    Client side of the service. Each method sends one job and blocks until it
+    is done, raising an Exception if the service reports an error. The key
+    defaults to the one in the key file (see load_authkey). Use it as a
+    context manager so the connection is closed even if a job fails
+    """
+
+    def __init__(self, port=DEFAULT_PORT, authkey=None):
+        if authkey is None:
+            authkey = load_authkey()
+            if authkey is None:
+                raise FileNotFoundError(f'There is no service key at {key_path()}. Is the service running?')
+        self.conn = Client(('localhost', port), authkey=authkey)
+
+
+    def request(self, job):
+        self.conn.send(job)
+        reply = self.conn.recv()
+        if not reply['ok']:
+            raise Exception(f'Segmentation service error: {reply["error"]}')
+        return reply['result']
+
+
+    def bianca(self, flair, t1, trans, model, outname=None):
+        return self.request({'job': 'bianca', 'flair': flair, 't1': t1, 'trans': trans,
+                             'model': model, 'outname': outname})
+
+
+    def sieve(self, mask, outname=None):
+        if isinstance(mask, np.ndarray):
+            shm, description = share_array(mask)
+            try:
+                return self.request({'job': 'sieve', 'mask': description, 'outname': outname})
+            finally:
+                shm.close()
+                shm.unlink()
+        return self.request({'job': 'sieve', 'mask': mask, 'outname': outname})
+
+
+    def close(self):
+        self.conn.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def get_client(port=DEFAULT_PORT, authkey=None):
+    """
+    Returns a connected SegmentationClient, or None if no service is running
+    or its key cannot be read
+    """
+    try:
+        client = SegmentationClient(port, authkey)
+        client.request({'job': 'ping'})
+    except PermissionError as e: # an unsafe key file is worth knowing about
+        print(f'Not using the segmentation service: {e}')
+        return None
+    except (OSError, EOFError, AuthenticationError):
+        return None
+    return client
+
+
+def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_PORT
+    SegmentationService(port=port).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
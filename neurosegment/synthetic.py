@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Synthetic brain-like scans and lesion masks for benchmarks and parity checks
+that have to run offline, without FSL or patient data
+
+A case is an ellipsoidal "brain" on an axial voxel grid with spherical
+lesions that are bright on FLAIR and dark on T1, plus Gaussian noise. Every
+function takes a seed so cases are reproducible
+"""
+
+import os
+
+import numpy as np
+import nibabel as nib
+
+
+def synthetic_brain(shape, fill=0.84):
+    """
+    Makes an ellipsoidal brain mask centred in the volume
+
+
+    Parameters
+    ----------
+    shape : tuple of 3 ints
+        shape of the volume.
+    fill : float, optional
+        diameter of the ellipsoid along each axis as a fraction of the volume.
+        The default is 0.84.
+
+    Returns
+    -------
+    3d bool np array
+
+    """
+    center = (np.array(shape) - 1) / 2
+    radii = np.array(shape) * fill / 2
+    x, y, z = np.ogrid[:shape[0], :shape[1], :shape[2]]
+    dist = ((x - center[0]) / radii[0])**2 + ((y - center[1]) / radii[1])**2 + ((z - center[2]) / radii[2])**2
+    return dist <= 1
+
+
+def synthetic_lesions(brain, n_lesions, radius_range=(1.5, 4), seed=0):
+    """
+    Scatters spherical lesions at random locations inside a brain mask
+
+
+    Parameters
+    ----------
+    brain : 3d bool np array
+        the brain mask. Lesions are clipped to it.
+    n_lesions : int
+        number of lesions (overlapping lesions merge).
+    radius_range : tuple of floats, optional
+        lesion radii in voxels are drawn uniformly from this range. The default is (1.5, 4).
+    seed : int, optional
+        random seed. The default is 0.
+
+    Returns
+    -------
+    3d bool np array
+
+    """
+    rng = np.random.default_rng(seed)
+    lesions = np.zeros(brain.shape, bool)
+
+    brain_vox = np.argwhere(brain)
+    if n_lesions == 0 or len(brain_vox) == 0:
+        return lesions
+    centers = brain_vox[rng.choice(len(brain_vox), min(n_lesions, len(brain_vox)), replace=False)]
+
+    for c in centers:
+        r = rng.uniform(*radius_range)
+        # only draw within the lesion's bounding box
+        lo = np.maximum(np.floor(c - r).astype(int), 0)
+        hi = np.minimum(np.ceil(c + r).astype(int) + 1, brain.shape)
+        x, y, z = np.ogrid[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]]
+        ball = (x - c[0])**2 + (y - c[1])**2 + (z - c[2])**2 <= r**2
+        lesions[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]] |= ball
+
+    lesions &= brain
+    return lesions
+
+
+def synthetic_case(shape=(96, 112, 40), n_lesions=12, seed=0):
+    """
+    Makes a complete synthetic case
+
+
+    Parameters
+    ----------
+    shape : tuple of 3 ints, optional
+        shape of the volume. The default is (96, 112, 40).
+    n_lesions : int, optional
+        number of lesions. The default is 12.
+    seed : int, optional
+        random seed. The default is 0.
+
+    Returns
+    -------
+    A dict with the float32 'flair' and 't1' scans (zero outside the brain)
+    and the bool 'brain' and 'lesions' masks
+
+    """
+    rng = np.random.default_rng(seed)
+
+    brain = synthetic_brain(shape)
+    lesions = synthetic_lesions(brain, n_lesions, seed=seed)
+
+    flair = np.zeros(shape, np.float32)
+    flair[brain] = rng.normal(100, 10, brain.sum())
+    flair[lesions] = rng.normal(160, 10, lesions.sum())
+    t1 = np.zeros(shape, np.float32)
+    t1[brain] = rng.normal(80, 8, brain.sum())
+    t1[lesions] = rng.normal(50, 8, lesions.sum())
+
+    return {'flair': flair, 't1': t1, 'brain': brain, 'lesions': lesions}
+
+
+def write_synthetic_case(folder, shape=(96, 112, 40), n_lesions=12, seed=0, affine=None):
+    """
+    Writes a synthetic case to a folder as the files the BIANCA pipeline
+    expects: axFLAIR.nii.gz, axT1.nii.gz, axFLAIR_mask.nii.gz (the lesions)
+    and an identity FLIRT matrix, master2mni.mat
+
+
+    Parameters
+    ----------
+    folder : pathlike
+        the folder to write to. It must exist.
+    shape, n_lesions, seed
+        see synthetic_case.
+    affine : 4x4 np array or None, optional
+        affine of the scans. The default is None, which uses 1x1x3 mm voxels in
+        radiological orientation.
+
+    Returns
+    -------
+    A tuple of the FLAIR, T1, lesion mask and matrix paths
+
+    """
+    if affine is None:
+        affine = np.diag([-1.0, 1.0, 3.0, 1.0])
+
+    case = synthetic_case(shape, n_lesions, seed)
+
+    flair_path = os.path.join(folder, 'axFLAIR.nii.gz')
+    t1_path = os.path.join(folder, 'axT1.nii.gz')
+    mask_path = os.path.join(folder, 'axFLAIR_mask.nii.gz')
+    trans_path = os.path.join(folder, 'master2mni.mat')
+
+    nib.save(nib.Nifti1Image(case['flair'], affine), flair_path)
+    nib.save(nib.Nifti1Image(case['t1'], affine), t1_path)
+    nib.save(nib.Nifti1Image(case['lesions'].astype(np.uint8), affine), mask_path)
+    np.savetxt(trans_path, np.eye(4))
+
+    return flair_path, t1_path, mask_path, trans_path
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Lightweight instrumentation for finding slow stages of a run
+
+Wrap a stage in a context manager or decorate a function:
+
+    import tracing
+
+    with tracing.patient(pt_id):
+        with tracing.stage('convert', scan='axFLAIR'):
+            ...
+
+    @tracing.traced()
+    def label_2d(im):
+        ...
+
+When tracing is enabled, every stage appends one JSON line to the trace file
+with the stage name, patient, parent stage, wall time, CPU time (of the
+process and of the child processes it waited on, such as FSL commands), bytes
+read and written by the process during the stage and the peak RSS of the
+process so far (ru_maxrss). Enable it with the NEUROSEGMENT_TRACE environment variable
+(set to the path of the trace file) or by calling enable(path). When it is
+disabled, stage() returns a shared no-op context manager and traced
+functions are called directly, so the instrumentation costs one check
+
+Summarize a trace with
+    python tracing.py trace.jsonl [summary.csv]
+"""
+
+import os
+import sys
+import json
+import time
+import threading
+import functools
+import contextvars
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
+
+
+TRACE_ENV = 'NEUROSEGMENT_TRACE'
+
+_trace_file = None
+_lock = threading.Lock()
+_patient = contextvars.ContextVar('patient', default=None)
+_parent = contextvars.ContextVar('parent', default=None)
+
+
+class _NullStage:
+    # returned by stage() when tracing is disabled
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+def enable(path):
+    """
+    Starts appending stage records to the JSON-lines file at path
+    """
+    global _trace_file
+    disable()
+    folder = os.path.dirname(os.path.abspath(path))
+    os.makedirs(folder, exist_ok=True)
+    _trace_file = open(path, 'a', buffering=1)
+
+
+def disable():
+    """
+    Stops tracing and closes the trace file
+    """
+    global _trace_file
+    with _lock:
+        if _trace_file is not None:
+            _trace_file.close()
+        _trace_file = None
+
+
+def is_enabled():
+    return _trace_file is not None
+
+
+def io_counters():
+    """
+    Returns the bytes read and written by this process so far, or (None, None)
+    if the platform does not report them (only Linux's /proc/self/io is read)
+    """
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+    except OSError:
+        return None, None
+    return int(counters['rchar']), int(counters['wchar'])
+
+
+def child_cpu_time():
+    """
+    Returns the CPU time used so far by finished child processes (e.g., FSL
+    commands started with os.system), or 0 if it is not available
+    """
+    if resource is None:
+        return 0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def peak_rss_mb():
+    """
+    Returns the peak resident set size of this process in MB, or None if it
+    is not available
+    """
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return maxrss / 1024**2 if sys.platform == 'darwin' else maxrss / 1024
+
+
+def write_record(record):
+    line = json.dumps(record, default=str)
+    with _lock:
+        if _trace_file is not None:
+            _trace_file.write(line + '\n')
+
+
+@contextmanager
+def _traced_stage(name, fields):
+    parent = _parent.get()
+    token = _parent.set(name)
+
+    read0, written0 = io_counters()
+    cpu0 = time.process_time()
+    child0 = child_cpu_time()
+    wall0 = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = repr(e)
+        raise
+    finally:
+        wall = time.perf_counter() - wall0
+        cpu = time.process_time() - cpu0
+        child_cpu = child_cpu_time() - child0
+        read1, written1 = io_counters()
+        _parent.reset(token)
+
+        record = {'stage': name,
+                  'patient': _patient.get(),
+                  'parent': parent,
+                  'start': time.time() - wall,
+                  'wall_s': wall,
+                  'cpu_s': cpu,
+                  'child_cpu_s': child_cpu,
+                  'read_bytes': None if read0 is None else read1 - read0,
+                  'written_bytes': None if written0 is None else written1 - written0,
+                  'peak_rss_mb': peak_rss_mb(),
+                  'pid': os.getpid(),
+                  'error': error}
+        record.update(fields)
+        write_record(record)
+
+
+def stage(name, **fields):
+    """
+    Context manager that records one stage of work. Extra keyword arguments
+    are added to the record (e.g., the scan being processed)
+    """
+    if _trace_file is None:
+        return _NULL_STAGE
+    return _traced_stage(name, fields)
+
+
+def set_patient(pt_id):
+    """
+    Tags the stages that follow with a patient ID, for loops where wrapping
+    each iteration in patient() is awkward
+    """
+    _patient.set(None if pt_id is None else str(pt_id))
+
+
+@contextmanager
+def patient(pt_id):
+    """
+    Context manager that tags the stages run inside it with a patient ID
+    """
+    token = _patient.set(None if pt_id is None else str(pt_id))
+    try:
+        yield
+    finally:
+        _patient.reset(token)
+
+
+def traced(name=None):
+    """
+    Decorator that records each call of a function as a stage. The stage is
+    named module.function unless a name is given
+    """
+    def decorator(func):
+        stage_name = name or f'{func.__module__}.{func.__qualname__}'
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _trace_file is None:
+                return func(*args, **kwargs)
+            with _traced_stage(stage_name, {}):
+                return func(*args, **kwargs)
+
+        return wrapper
+    return decorator
+
+
+def read_trace(path):
+    """
+    Reads a trace file into a pandas DataFrame with one row per stage record
+    """
+    import pandas as pd
+
+    with open(path) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    return pd.DataFrame.from_records(records)
+
+
+def summarize(path, out_csv=None, by='stage'):
+    """
+    Summarizes a trace by stage
+
+
+    Parameters
+    ----------
+    path : pathlike
+        the trace file.
+    out_csv : pathlike or None, optional
+        if given, the summary is also written to this csv. The default is None.
+    by : str or list of str, optional
+        the columns to group records by. Use ['patient', 'stage'] for a
+        per-patient breakdown. The default is 'stage'.
+
+    Returns
+    -------
+    A pandas DataFrame with one row per group giving the number of calls and
+    patients, total/mean/max wall time, total CPU time (of this process and
+    of child processes), total MB read and written, the highest peak RSS seen and the number of failed calls, sorted
+    by total wall time
+
+    """
+    trace = read_trace(path)
+    trace['failed'] = trace['error'].notna()
+    for col in ('read_bytes', 'written_bytes'):
+        trace[col] = trace[col].astype(float) / 1024**2
+
+    summary = trace.groupby(by, dropna=False).agg(calls=('wall_s', 'size'),
+                                                  patients=('patient', 'nunique'),
+                                                  wall_total_s=('wall_s', 'sum'),
+                                                  wall_mean_s=('wall_s', 'mean'),
+                                                  wall_max_s=('wall_s', 'max'),
+                                                  cpu_total_s=('cpu_s', 'sum'),
+                                                  child_cpu_total_s=('child_cpu_s', 'sum'),
+                                                  read_mb=('read_bytes', 'sum'),
+                                                  written_mb=('written_bytes', 'sum'),
+                                                  peak_rss_mb=('peak_rss_mb', 'max'),
+                                                  failed=('failed', 'sum'))
+    summary = summary.sort_values('wall_total_s', ascending=False)
+
+    if out_csv is not None:
+        summary.to_csv(out_csv)
+
+    return summary
+
+
+if TRACE_ENV in os.environ and os.environ[TRACE_ENV]:
+    enable(os.environ[TRACE_ENV])
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('Usage: python tracing.py trace.jsonl [summary.csv]')
+        sys.exit(1)
+    import pandas as pd
+    with pd.option_context('display.width', 200, 'display.max_columns', None):
+        print(summarize(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None).round(3))
@@ -13,7 +13,6 @@ import tkinter as tk
 from tkinter.ttk import Frame, Label, Entry, Radiobutton
 from tkinter.filedialog import askopenfilename, askdirectory
 
-import matplotlib.pyplot as plt
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 
 from matplotlib.backends.backend_tkagg import (
@@ -22,15 +21,26 @@ from matplotlib.backends.backend_tkagg import (
 from matplotlib.backend_bases import key_press_handler
 from matplotlib.figure import Figure
 import matplotlib
+import matplotlib.widgets
 import numpy as np
-import pandas as pd
 import scipy.ndimage.morphology as mor
 import nibabel as nib
 
 import ugli_helpers as ugh
-import gbs
+import bianca_classifier as bc
+import segmentation_service as ss
 
 
+UNDO_MEMORY_CAP = 64*1024**2 # bytes of mask deltas kept for undo/redo
+UNDO_MAX_STEPS = None # None to only limit the undo history by memory
+
+LAZY_VOLUME_BYTES = 512*1024**2 # scans larger than this (as float64) are read slice by slice from an uncompressed cache
+LAZY_CACHED_SLICES = 8 # number of decoded slices kept per lazily loaded scan
+
+MASK_COMPRESSION_LEVEL = 1 # gzip level for saved masks. 1 is fast, 9 is smallest
+
+# operations that the global morphology buttons run as a single 3d call
+VOLUME_OPERATIONS = (mor.binary_erosion, mor.binary_dilation, mor.binary_opening, mor.binary_closing)
 
 
 class MainApp(Frame):
@@ -95,6 +105,11 @@ class MainApp(Frame):
         self.run_bianca_button = tk.Button(frame2p125, text="RUN BIANCA", width=40, command=self.run_bianca)
         self.run_bianca_button.pack(side=None, padx=5, pady=5)
         
+        self.native_bianca = tk.BooleanVar()
+        
+        self.native_bianca_checkbox = tk.Checkbutton(frame2p125, text="In-process classifier (unvalidated)", variable=self.native_bianca)
+        self.native_bianca_checkbox.pack(side=None, padx=5, pady=0)
+        
         
         
         frame2p25 = Frame(self)
@@ -151,7 +166,7 @@ class MainApp(Frame):
         
         
         # adding the subplot 
-        self.fig = plt.Figure(figsize = (6, 6), dpi = 100) 
+        self.fig = Figure(figsize = (6, 6), dpi = 100) 
         self.plot1 = self.fig.add_subplot(111) 
         self.plot1.axis('off')
         
@@ -171,6 +186,9 @@ class MainApp(Frame):
         self.display_label = tk.Label(frame4, text="Step 0: initialization", width=30)
         self.display_label.pack(side=tk.BOTTOM, padx=5, pady=5)
         
+        self.save_status_label = tk.Label(frame4, text="", width=40)
+        self.save_status_label.pack(side=tk.BOTTOM, padx=5, pady=0)
+        
         
         
         frame5 = Frame(self)
@@ -196,6 +214,11 @@ class MainApp(Frame):
         
         self.zero_button = tk.Button(frame5, text="ZERO", width=10, command=lambda: self.alter_all_slices(self.set_slice_zero))
         self.zero_button.pack(padx=2, pady=1, side=tk.LEFT)
+        
+        self.morph_3d = tk.BooleanVar()
+        
+        self.morph_3d_checkbox = tk.Checkbutton(frame5, text="3D", variable=self.morph_3d)
+        self.morph_3d_checkbox.pack(padx=2, pady=1, side=tk.LEFT)
 
         top_buffer = tk.Label(frame5, text="|", width=5)
         top_buffer.pack(padx=2, pady=0, side=tk.LEFT)        
@@ -241,6 +264,9 @@ class MainApp(Frame):
         self.return_to_binarization_button = tk.Button(frame6, text="Back to binarization", width=12, command=self.return_to_binarization_cmd)
         self.return_to_binarization_button.pack(padx=6, pady=1, side=tk.RIGHT)
         
+        self.redo_morph_button = tk.Button(frame6, text="Redo", width=12, command=self.redo_morph)
+        self.redo_morph_button.pack(padx=6, pady=1, side=tk.RIGHT)
+        
         self.undo_morph_button = tk.Button(frame6, text="Undo", width=12, command=self.undo_morph)
         self.undo_morph_button.pack(padx=6, pady=1, side=tk.RIGHT)
         
@@ -282,6 +308,12 @@ class MainApp(Frame):
         
         self.n_writes = 0
         self.stage = 0
+        
+        self.history = ugh.MaskHistory(max_bytes=UNDO_MEMORY_CAP, max_steps=UNDO_MAX_STEPS)
+        self.morph_buffer = None
+        
+        self.mask_writer = ugh.MaskWriter(compresslevel=MASK_COMPRESSION_LEVEL)
+        self.poll_save_status()
 
 
         
@@ -320,23 +352,27 @@ class MainApp(Frame):
         
         print('Writing binarized mask')
         
-        the_data = self.current_overlay.copy()
         the_name = os.path.join(self.output_folder, f'binarized_map_v{self.n_writes}.nii.gz')
         companion_name = os.path.join(self.output_folder, f'binarized_map_v{self.n_writes}_stats.csv')
         
         # need to rotate and flip back to original nibabel orientation
         # the_data = np.fliplr(the_data) # uncomment for neurological view, along with the reading function in ugly_helpers
-        the_data = np.rot90(the_data, k=3)
-        
-        out = nib.Nifti1Image(the_data, self.mirage, self.template_header)
-        nib.save(out, the_name)
+        the_data = np.rot90(self.current_overlay, k=3)
         
+        # the stats only need the lesion voxel count, the brain volume is cached when the scans are loaded
         the_dict = self.calculate_stats()
         
-        the_series = pd.Series(the_dict)
-        the_series.to_csv(companion_name)
+        # the writer takes a uint8 copy, so editing can continue while it compresses and writes
+        self.mask_writer.submit(the_data, self.mirage, self.template_header, the_name, the_dict, companion_name)
+        self.save_status_label.config(text=self.mask_writer.status())
         
         self.n_writes += 1
+        
+        
+    def poll_save_status(self):
+        # tkinter widgets can only be touched from the main thread, so the writer's status is polled
+        self.save_status_label.config(text=self.mask_writer.status())
+        self.after(250, self.poll_save_status)
     
     
     def calculate_stats(self):
@@ -417,6 +453,7 @@ class MainApp(Frame):
             self.open_button['state'] = tk.DISABLED
             self.close_button['state'] = tk.DISABLED
             self.zero_button['state'] = tk.DISABLED
+            self.morph_3d_checkbox['state'] = tk.DISABLED
             
             self.local_erode_button['state'] = tk.DISABLED
             self.local_dilate_button['state'] = tk.DISABLED
@@ -434,6 +471,7 @@ class MainApp(Frame):
             self.calculate_stats_button['state'] = tk.DISABLED
             self.return_to_binarization_button['state'] = tk.DISABLED
             self.undo_morph_button['state'] = tk.DISABLED
+            self.redo_morph_button['state'] = tk.DISABLED
             
             self.gbs_sci_button['state'] = tk.DISABLED
             
@@ -467,6 +505,7 @@ class MainApp(Frame):
             self.open_button['state'] = tk.DISABLED
             self.close_button['state'] = tk.DISABLED
             self.zero_button['state'] = tk.DISABLED
+            self.morph_3d_checkbox['state'] = tk.DISABLED
             
             self.local_erode_button['state'] = tk.DISABLED
             self.local_dilate_button['state'] = tk.DISABLED
@@ -484,6 +523,7 @@ class MainApp(Frame):
             self.calculate_stats_button['state'] = tk.DISABLED
             self.return_to_binarization_button['state'] = tk.DISABLED
             self.undo_morph_button['state'] = tk.DISABLED
+            self.redo_morph_button['state'] = tk.DISABLED
             
             self.gbs_sci_button['state'] = tk.DISABLED
             
@@ -517,6 +557,7 @@ class MainApp(Frame):
             self.open_button['state'] = tk.NORMAL
             self.close_button['state'] = tk.NORMAL
             self.zero_button['state'] = tk.NORMAL
+            self.morph_3d_checkbox['state'] = tk.NORMAL
             
             self.local_erode_button['state'] = tk.NORMAL
             self.local_dilate_button['state'] = tk.NORMAL
@@ -534,6 +575,7 @@ class MainApp(Frame):
             self.calculate_stats_button['state'] = tk.NORMAL
             self.return_to_binarization_button['state'] = tk.NORMAL
             self.undo_morph_button['state'] = tk.NORMAL
+            self.redo_morph_button['state'] = tk.NORMAL
             
             self.gbs_sci_button['state'] = tk.NORMAL
             
@@ -604,21 +646,46 @@ class MainApp(Frame):
         self.flair_file = self.flair_entry.get()
         self.t1_file = self.t1_entry.get()
         
-        bianca_master_file = ugh.generate_bianca_master(self.output_folder, self.flair_entry.get(), self.t1_entry.get(), self.trans_entry.get())
-        
         self.binarize_slider.set(50)
         
         self.alpha_entry.delete(0, 'end')
         self.alpha_entry.insert(0,0.5)
         
-        self.probability_map_file = os.path.join(self.output_folder, 'probability_map.nii.gz')
-        ugh.execute_bianca(master=bianca_master_file, model=self.bianca_entry.get(), outname=self.probability_map_file)
+        if self.native_bianca.get():
+            # the classifier data stays loaded between cases (in the segmentation service if one is running) and the map never touches the disk
+            client = ss.get_client()
+            if client is not None:
+                with client:
+                    prob = client.bianca(self.flair_file, self.t1_file, self.trans_entry.get() or None, self.bianca_entry.get())
+            else:
+                classifier = bc.get_classifier(self.bianca_entry.get())
+                prob = classifier.predict(self.flair_file, self.t1_file, self.trans_entry.get() or None)
+            self.probability_map = np.rot90(prob, k=1) # same orientation as ugh.read_nifti_radiological
+        else:
+            bianca_master_file = ugh.generate_bianca_master(self.output_folder, self.flair_entry.get(), self.t1_entry.get(), self.trans_entry.get())
+            self.probability_map_file = os.path.join(self.output_folder, 'probability_map.nii.gz')
+            ugh.execute_bianca(master=bianca_master_file, model=self.bianca_entry.get(), outname=self.probability_map_file)
+            self.probability_map = self.load_scan(self.probability_map_file, 'probability_map')
         
         self.mask_on_checkbox.select()
         
-        self.probability_map = ugh.read_nifti_radiological(self.probability_map_file)
-        self.flair = ugh.read_nifti_radiological(self.flair_entry.get())
-        self.t1 = ugh.read_nifti_radiological(self.t1_entry.get())
+        self.t1 = self.load_scan(self.t1_file, 't1')
+        
+        # the FLAIR's header, brain volume and intensity range are cached per user, so reopening a case
+        # reads them from the cache and the FLAIR is displayed lazily instead of decompressed
+        self.metadata_file = ugh.user_cache_path(self.flair_file, 'metadata.npz')
+        self.flair_metadata = ugh.load_case_metadata(self.metadata_file, self.flair_file)
+        if self.flair_metadata is not None:
+            self.flair = self.load_scan(self.flair_file, 'flair', lazy=True)
+        elif ugh.nifti_nbytes(self.flair_file) > LAZY_VOLUME_BYTES:
+            self.flair = self.load_scan(self.flair_file, 'flair')
+            self.flair_metadata = ugh.get_case_metadata(self.flair_file, self.metadata_file, img=self.flair.img, data=self.flair)
+        else:
+            template = nib.load(self.flair_file)
+            flair_data = template.get_fdata()
+            self.flair = np.rot90(flair_data, k=1) # same orientation as ugh.read_nifti_radiological
+            self.flair_metadata = ugh.get_case_metadata(self.flair_file, self.metadata_file, img=template, data=flair_data)
+            del flair_data
         
         self.sh = self.flair.shape
         self.nx = self.sh[0]
@@ -636,35 +703,51 @@ class MainApp(Frame):
         self.flair_max.delete(0, 'end')
         self.t1_max.delete(0, 'end')
         
-        self.flair_max.insert(0, round(self.flair.max()))
+        self.flair_max.insert(0, round(self.flair_metadata['max']))
         self.t1_max.insert(0, round(self.t1.max()))
         
         self.current_overlay = self.probability_map
 
-        template = nib.load(self.flair_file)
-        self.template_header = template.header
-        self.voxel_dims = self.template_header['pixdim'][1:4]
-        self.mirage = template.affine
+        self.template_header = self.flair_metadata['header']
+        self.voxel_dims = self.flair_metadata['voxel_dims']
+        self.mirage = self.flair_metadata['affine']
         
         self.voxel_vol = np.product(self.voxel_dims)
         
-        brain = template.get_fdata()
-        self.brain_voxels = (brain > 0).sum()
+        self.brain_voxels = self.flair_metadata['brain_voxels']
         self.brain_vol = self.brain_voxels * self.voxel_vol
         
-
         
-    
+    def load_scan(self, img_path, name, lazy=None):
+        """
+        Reads a scan in radiological orientation. Scans too large to comfortably
+        hold in memory (or any scan, if lazy is True) are returned as a
+        ugh.LazyVolume that reads slices on demand. Its uncompressed copy is
+        kept in the per-user cache, so it is reused when the case is reopened
+        """
+        
+        if lazy is None:
+            lazy = ugh.nifti_nbytes(img_path) > LAZY_VOLUME_BYTES
+        if lazy:
+            cache_path = ugh.user_cache_path(img_path, f'{name}.nii')
+            return ugh.LazyVolume(img_path, cache_path, n_cached=LAZY_CACHED_SLICES)
+        
+        return ugh.read_nifti_radiological(img_path)
+        
+
     def binarize_probability_mask(self):
         
         self.stage = 3
         self.setup_stage(3)
         
-        self.binary_mask = self.probability_map.copy()
-        self.binary_mask = self.binary_mask >= self.binarize_slider.get()/100
-        self.binary_mask = self.binary_mask.astype(int)
+        # thresholded slice by slice so a lazily loaded probability map is never fully read into memory
+        thresh = self.binarize_slider.get()/100
+        self.binary_mask = np.empty(self.probability_map.shape, np.uint8)
+        for i in range(self.binary_mask.shape[2]):
+            self.binary_mask[:,:,i] = self.probability_map[:,:,i] >= thresh
         
         self.current_overlay = self.binary_mask
+        self.history.clear()
         
         self.display_scan(self.bg_scan.get(), self.slice_slider.get())
     
@@ -755,10 +838,6 @@ class MainApp(Frame):
             self.overlaydisplay = self.plot1.imshow(ax_slice, cmap=cmap, vmin=0, vmax=1, alpha=al)
           
             
-    def take_snapshot(self):
-        self.snapshot = self.current_overlay.copy()
-        
-            
     def set_slice_zero(self, sli):
         a = sli.copy()
         a[:] = 0
@@ -789,7 +868,10 @@ class MainApp(Frame):
     
     def binary_operation_all(self, operation, mat):
         """
-        Applies a binary operation to every z slice of a 3d image
+        Applies a binary operation to every z slice of a 3d image. The scipy
+        morphological operations are applied in a single call with an in-plane
+        structuring element (or a 3d one if the 3D box is checked) and written
+        to a reusable buffer. mat is not modified
         
 
         Parameters
@@ -805,46 +887,51 @@ class MainApp(Frame):
 
         """
         
-        n_slices = mat.shape[2]
-        a = mat[:]
-        for i in range(n_slices):
-            a[:,:,i] = self.binary_operation(operation, a[:,:,i])
-            
-        return a
+        if operation not in VOLUME_OPERATIONS:
+            n_slices = mat.shape[2]
+            a = mat.copy()
+            for i in range(n_slices):
+                a[:,:,i] = self.binary_operation(operation, a[:,:,i])
+            return a
+        
+        if self.morph_buffer is None or self.morph_buffer.shape != mat.shape:
+            self.morph_buffer = np.empty(mat.shape, bool)
+        
+        return ugh.binary_operation_volume(operation, mat, connectivity_3d=self.morph_3d.get(), output=self.morph_buffer)
     
     def undo_morph(self):
-        self.current_overlay = self.snapshot.copy()
+        self.history.undo(self.current_overlay)
         self.display_scan(self.bg_scan.get(), self.slice_slider.get())
-    
-    def alter_current_slice(self, operation):
-        self.take_snapshot()
         
+    def redo_morph(self):
+        self.history.redo(self.current_overlay)
+        self.display_scan(self.bg_scan.get(), self.slice_slider.get())
+        
+    def alter_current_slice(self, operation):
         i = self.slice_slider.get()
+        before = self.current_overlay[:,:,i].copy()
+        
         self.current_overlay[:,:,i] = self.binary_operation(operation, self.current_overlay[:,:,i])
+        self.history.record(before, self.current_overlay[:,:,i], z=i)
         self.display_scan(self.bg_scan.get(), self.slice_slider.get())
         
         
     def alter_all_slices(self, operation):
-        self.take_snapshot()
+        result = self.binary_operation_all(operation, self.current_overlay)
         
-        self.current_overlay = self.binary_operation_all(operation, self.current_overlay)
+        self.history.record(self.current_overlay, result)
+        np.copyto(self.current_overlay, result)
         self.display_scan(self.bg_scan.get(), self.slice_slider.get())
         
 
     def onselect(self, verts):
-        p = matplotlib.path.Path(verts)
-        current_im = self.current_overlay[:,:,self.slice_slider.get()]
-        sh = current_im.shape
-        px, py = np.arange(sh[1]), np.arange(sh[1])
-        
-        xv, yv = np.meshgrid(px, py)
-        pix = np.vstack((xv.flatten(), yv.flatten())).T
+        # only the polygon's bounding box is rasterized. copy so that lasso_truth_blank is never modified
+        r0, c0, patch = ugh.rasterize_polygon(verts, self.lasso_truth.shape)
         
-        ind = p.contains_points(pix, radius=0)
+        truthy = self.lasso_truth.copy()
+        truthy[r0:r0+patch.shape[0], c0:c0+patch.shape[1]] |= patch
         
-        truthy = np.reshape(ind, (sh[0], sh[1]))
-        
-        self.lasso_truth = np.logical_or(self.lasso_truth, truthy)
+        self.lasso_truth = truthy
     
         
     def lasso_region(self):
@@ -881,23 +968,29 @@ class MainApp(Frame):
         
     
     def fill_lassoed_areas(self):
-        self.take_snapshot()
+        i = self.slice_slider.get()
+        before = self.current_overlay[:,:,i].copy()
         # 1 everything inside the lasso
-        self.current_overlay[:,:,self.slice_slider.get()][self.lasso_truth] = 1
+        self.current_overlay[:,:,i][self.lasso_truth] = 1
+        self.history.record(before, self.current_overlay[:,:,i], z=i)
         self.display_scan(self.bg_scan.get(), self.slice_slider.get(), end_lasso=True)
     
     
     def keep_lassoed_areas(self):
-        self.take_snapshot()
+        i = self.slice_slider.get()
+        before = self.current_overlay[:,:,i].copy()
         # zero everything outside the lasso
-        self.current_overlay[:,:,self.slice_slider.get()][~self.lasso_truth] = 0
+        self.current_overlay[:,:,i][~self.lasso_truth] = 0
+        self.history.record(before, self.current_overlay[:,:,i], z=i)
         self.display_scan(self.bg_scan.get(), self.slice_slider.get(), end_lasso=True)        
     
     
     def delete_lassoed_areas(self):
-        self.take_snapshot()
+        i = self.slice_slider.get()
+        before = self.current_overlay[:,:,i].copy()
         # 0 everything inside the lasso
-        self.current_overlay[:,:,self.slice_slider.get()][self.lasso_truth] = 0
+        self.current_overlay[:,:,i][self.lasso_truth] = 0
+        self.history.record(before, self.current_overlay[:,:,i], z=i)
         self.display_scan(self.bg_scan.get(), self.slice_slider.get(), end_lasso=True)
     
 
@@ -913,9 +1006,16 @@ class MainApp(Frame):
         
         
     def gbs_sci(self):
-        self.take_snapshot()
+        before = self.current_overlay
         
-        self.current_overlay = gbs.sieve_image(self.current_overlay)
+        client = ss.get_client()
+        if client is not None:
+            with client:
+                self.current_overlay = client.sieve(self.current_overlay)
+        else:
+            import gbs # pulls in scikit-image and scikit-learn, so only loaded when first needed
+            self.current_overlay = gbs.sieve_image(self.current_overlay)
+        self.history.record(before, self.current_overlay)
         
         self.display_scan(self.bg_scan.get(), self.slice_slider.get(), end_lasso=True)
         
@@ -926,6 +1026,8 @@ def main():
     root.geometry("1300x1100+400+200")
     app = MainApp(root)
     root.mainloop()
+    # let any queued saves finish before exiting
+    app.mask_writer.close()
 
 
 if __name__ == '__main__':
@@ -8,11 +8,20 @@ Created on Wed Aug 12 14:10:56 2020
 
 import os
 import glob
+import gzip
+import queue
+import hashlib
+import shutil
+import threading
+from collections import OrderedDict
 
 import nibabel as nib
 import numpy as np
 from scipy import ndimage
 
+import tracing
+
+@tracing.traced()
 def read_nifti_radiological(img_path):
     """
     Wrapper for nibabel to read in NIfTI scans.
@@ -37,6 +46,408 @@ def read_nifti_radiological(img_path):
     return img
 
 
+def nifti_nbytes(img_path, dtype=np.float64):
+    """
+    Returns the number of bytes a scan would take in memory once loaded as
+    dtype, reading only its header
+    """
+    shape = nib.load(img_path).shape
+    return int(np.prod(shape)) * np.dtype(dtype).itemsize
+
+
+CACHE_ENV = 'NEUROSEGMENT_CACHE'
+
+
+def user_cache_folder():
+    """
+    Returns the per-user cache folder, creating it if needed: the
+    NEUROSEGMENT_CACHE environment variable if it is set, and otherwise
+    neurosegment/ under XDG_CACHE_HOME or ~/.cache
+    """
+    folder = os.environ.get(CACHE_ENV)
+    if not folder:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+        folder = os.path.join(base, 'neurosegment')
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+
+def user_cache_path(img_path, kind):
+    """
+    Returns where to cache data derived from a scan (e.g., its metadata or
+    an uncompressed copy) in user_cache_folder, so that it is reused between
+    sessions. Entries are named for the scan's absolute path, and whoever
+    reads them checks them against the scan's size and modification time
+    
+
+    Parameters
+    ----------
+    img_path : pathlike
+        path to the scan.
+    kind : str
+        what is cached, used as the end of the file name (e.g., 'metadata.npz').
+
+    Returns
+    -------
+    the path
+
+    """
+    folder = user_cache_folder()
+    
+    real_path = os.path.realpath(img_path)
+    key = hashlib.sha1(os.fsencode(real_path)).hexdigest()[:16]
+    name = os.path.basename(real_path).split('.')[0]
+    return os.path.join(folder, f'{name}_{key}_{kind}')
+
+
+@tracing.traced()
+def decompress_nifti(img_path, out_path):
+    """
+    Writes an uncompressed copy of a .nii.gz scan by streaming the gzip
+    stream to disk, without decoding the image. The copy is reused if it is
+    newer than the scan
+    
+
+    Parameters
+    ----------
+    img_path : pathlike
+        path to the .nii.gz scan.
+    out_path : pathlike
+        path of the uncompressed .nii to write.
+
+    Returns
+    -------
+    out_path
+
+    """
+    
+    if os.path.exists(out_path) and os.path.getmtime(out_path) >= os.path.getmtime(img_path):
+        return out_path
+    
+    temp_name = f'{out_path}.part'
+    with gzip.open(img_path, 'rb') as src, open(temp_name, 'wb') as dst:
+        shutil.copyfileobj(src, dst, length=16*1024**2)
+    os.replace(temp_name, out_path)
+    
+    return out_path
+
+
+class LazyVolume:
+    """
+    Read-only, radiologically oriented view of a scan that reads axial slices
+    from disk on demand instead of loading the whole volume.
+    
+    Compressed scans are converted once to an uncompressed .nii cache, which
+    nibabel memory-maps so that reading a slice only touches that slice's
+    bytes. The most recently used slices are kept decoded. Indexing with
+    [:, :, z] (or any 2d slicing of a single z) returns the same array as
+    read_nifti_radiological(img_path)[:, :, z]. Any other indexing, or
+    np.asarray, loads the full volume
+    
+
+    Parameters
+    ----------
+    img_path : pathlike
+        path to the scan.
+    cache_path : pathlike or None, optional
+        where to write the uncompressed copy if img_path is compressed. The
+        default is None, which puts it next to img_path.
+    n_cached : int, optional
+        number of decoded slices to keep. The default is 8.
+
+    """
+    
+    def __init__(self, img_path, cache_path=None, n_cached=8):
+        if img_path.endswith('.gz'):
+            if cache_path is None:
+                cache_path = img_path[:-3]
+            img_path = decompress_nifti(img_path, cache_path)
+        
+        self.img = nib.load(img_path, mmap=True)
+        self.proxy = self.img.dataobj
+        nx, ny, nz = self.img.shape[:3]
+        self.shape = (ny, nx, nz) # rot90 swaps the first two axes
+        self.ndim = 3
+        self.n_cached = n_cached
+        self.slices = OrderedDict()
+        
+        
+    def get_slice(self, z):
+        z = int(z)
+        try:
+            self.slices.move_to_end(z)
+            return self.slices[z]
+        except KeyError:
+            pass
+        
+        sli = np.rot90(np.asarray(self.proxy[:,:,z], dtype=np.float64), k=1)
+        self.slices[z] = sli
+        if len(self.slices) > self.n_cached:
+            self.slices.popitem(last=False)
+            
+        return sli
+    
+    
+    def __getitem__(self, key):
+        if (isinstance(key, tuple) and len(key) == 3 and isinstance(key[0], slice)
+            and isinstance(key[1], slice) and np.ndim(key[2]) == 0 and not isinstance(key[2], slice)):
+            return self.get_slice(key[2])[key[0], key[1]]
+        return np.asarray(self)[key]
+    
+    
+    def __array__(self, dtype=None, copy=None):
+        data = np.rot90(self.img.get_fdata(), k=1)
+        if dtype is not None:
+            data = data.astype(dtype)
+        return data
+    
+    
+    def max(self):
+        # streams through the slices rather than loading the volume
+        return max(np.asarray(self.proxy[:,:,z]).max() for z in range(self.shape[2]))
+
+
+def compute_case_metadata(img, data=None, percentiles=(1, 50, 99)):
+    """
+    Summarizes a scan in a single pass over its slices: voxel dimensions,
+    affine, header, the number of brain (nonzero) voxels, the maximum intensity
+    and percentiles of the brain intensities
+    
+
+    Parameters
+    ----------
+    img : nibabel image
+        the loaded scan. Only the header is read if data is given.
+    data : 3d np array or None, optional
+        the scan's voxel data in nibabel orientation, if it is already loaded.
+        The default is None.
+    percentiles : tuple of floats, optional
+        percentiles of the brain intensities to record. The default is (1, 50, 99).
+
+    Returns
+    -------
+    dict
+
+    """
+    
+    if data is None:
+        data = img.get_fdata()
+    
+    brain_voxels = 0
+    max_inten = -np.inf
+    brain_vals = []
+    for i in range(data.shape[2]):
+        sli = np.asarray(data[:,:,i])
+        max_inten = max(max_inten, sli.max())
+        vals = sli[sli > 0]
+        brain_voxels += vals.size
+        brain_vals.append(vals.astype(np.float32))
+    
+    brain_vals = np.concatenate(brain_vals)
+    if brain_vals.size:
+        perc_vals = np.percentile(brain_vals, percentiles)
+    else:
+        perc_vals = np.zeros(len(percentiles))
+    
+    metadata = {'voxel_dims': np.array(img.header['pixdim'][1:4]),
+                'affine': img.affine,
+                'header': img.header,
+                'shape': img.shape,
+                'brain_voxels': int(brain_voxels),
+                'max': float(max_inten),
+                'percentiles': {float(p): float(v) for p, v in zip(percentiles, perc_vals)}}
+    
+    return metadata
+
+
+def save_case_metadata(metadata, cache_path, source_path):
+    """
+    Writes the output of compute_case_metadata to an .npz file, along with the
+    size and modification time of the scan it describes
+    """
+    
+    source_stat = os.stat(source_path)
+    np.savez(cache_path,
+             voxel_dims=metadata['voxel_dims'],
+             affine=metadata['affine'],
+             header=np.frombuffer(metadata['header'].binaryblock, np.uint8),
+             shape=np.array(metadata['shape']),
+             brain_voxels=metadata['brain_voxels'],
+             max=metadata['max'],
+             percentile_keys=np.array(list(metadata['percentiles'].keys()), float),
+             percentile_vals=np.array(list(metadata['percentiles'].values()), float),
+             source_size=source_stat.st_size,
+             source_mtime=source_stat.st_mtime)
+    
+    
+def load_case_metadata(cache_path, source_path):
+    """
+    Reads metadata written by save_case_metadata. Returns None if the cache
+    does not exist or if the scan has changed since the cache was written
+    """
+    
+    if not os.path.exists(cache_path):
+        return None
+    
+    source_stat = os.stat(source_path)
+    with np.load(cache_path) as cached:
+        if cached['source_size'] != source_stat.st_size or cached['source_mtime'] != source_stat.st_mtime:
+            return None
+        
+        header = nib.Nifti1Header(cached['header'].tobytes())
+        metadata = {'voxel_dims': cached['voxel_dims'],
+                    'affine': cached['affine'],
+                    'header': header,
+                    'shape': tuple(cached['shape']),
+                    'brain_voxels': int(cached['brain_voxels']),
+                    'max': float(cached['max']),
+                    'percentiles': {float(p): float(v) for p, v in zip(cached['percentile_keys'], cached['percentile_vals'])}}
+        
+    return metadata
+
+
+@tracing.traced()
+def get_case_metadata(img_path, cache_path, img=None, data=None):
+    """
+    Returns the metadata for a scan, reading it from cache_path if it is up to
+    date and otherwise computing it with compute_case_metadata and writing the
+    cache
+    
+
+    Parameters
+    ----------
+    img_path : pathlike
+        path to the scan.
+    cache_path : pathlike
+        path to the .npz metadata cache.
+    img : nibabel image or None, optional
+        the scan, if already loaded. The default is None.
+    data : 3d np array or None, optional
+        the scan's voxel data in nibabel orientation, if already loaded. The default is None.
+
+    Returns
+    -------
+    dict
+
+    """
+    
+    metadata = load_case_metadata(cache_path, img_path)
+    if metadata is not None:
+        return metadata
+    
+    if img is None:
+        img = nib.load(img_path)
+    metadata = compute_case_metadata(img, data)
+    save_case_metadata(metadata, cache_path, img_path)
+    
+    return metadata
+
+
+def binary_operation_volume(operation, mat, connectivity_3d=False, output=None):
+    """
+    Applies a scipy binary morphological operation to a whole 3d image in a
+    single call.
+    
+    By default the structuring element only connects voxels within an axial
+    slice, which gives the same result as applying the operation to every z
+    slice separately. The input is not modified
+    
+
+    Parameters
+    ----------
+    operation : function
+        a scipy.ndimage binary operation that accepts structure and output
+        arguments (e.g., binary_erosion).
+    mat : 3d np array
+        array to apply operation to.
+    connectivity_3d : bool, optional
+        if True, voxels are also connected to their neighbors in the adjacent
+        slices. The default is False.
+    output : 3d bool np array or None, optional
+        preallocated array to write the result to. The default is None.
+
+    Returns
+    -------
+    3d bool np array
+
+    """
+    
+    if connectivity_3d:
+        structure = ndimage.generate_binary_structure(3, 1)
+    else:
+        structure = ndimage.generate_binary_structure(2, 1)[:,:,np.newaxis]
+        
+    if output is None:
+        output = np.empty(mat.shape, bool)
+    
+    operation(mat, structure=structure, output=output)
+    
+    return output
+
+
+def rasterize_polygon(verts, shape):
+    """
+    Finds the pixels of a 2d image that fall inside a polygon using an
+    even-odd scanline fill restricted to the polygon's bounding box. Pixel
+    (row, col) is treated as the point (x=col, y=row), matching the data
+    coordinates of an image drawn with imshow
+    
+
+    Parameters
+    ----------
+    verts : sequence of (x, y) pairs
+        vertices of the polygon. The polygon is closed automatically.
+    shape : tuple of ints
+        (n_rows, n_cols) of the image.
+
+    Returns
+    -------
+    A tuple (r0, c0, patch) where patch is a 2d bool array that is True inside
+    the polygon and whose upper left corner lies at (r0, c0) in the image.
+    patch is empty if the polygon does not cover any pixel centers
+
+    """
+    
+    verts = np.asarray(verts, dtype=float)
+    x0, y0 = verts[:,0], verts[:,1]
+    x1, y1 = np.roll(x0, -1), np.roll(y0, -1)
+    
+    r0 = max(int(np.ceil(y0.min())), 0)
+    r1 = min(int(np.floor(y0.max())), shape[0]-1)
+    c0 = max(int(np.ceil(x0.min())), 0)
+    c1 = min(int(np.floor(x0.max())), shape[1]-1)
+    
+    if r1 < r0 or c1 < c0:
+        return 0, 0, np.zeros((0,0), bool)
+    
+    n_rows = r1 - r0 + 1
+    n_cols = c1 - c0 + 1
+    
+    # x coordinate where every scanline crosses every edge. the half-open test
+    # counts a vertex shared by two edges only once
+    ys = np.arange(r0, r1+1, dtype=float)[:,np.newaxis]
+    crosses = ((y0 <= ys) & (ys < y1)) | ((y1 <= ys) & (ys < y0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        xs = x0 + (ys - y0) * (x1 - x0) / (y1 - y0)
+    xs = np.where(crosses, xs, np.inf)
+    xs.sort(axis=1)
+    if xs.shape[1] % 2:
+        xs = np.pad(xs, ((0,0),(0,1)), constant_values=np.inf)
+    
+    # pixels between each pair of crossings are inside
+    starts, stops = xs[:,0::2], xs[:,1::2]
+    row_idx, pair_idx = np.nonzero(np.isfinite(starts))
+    starts = np.clip(np.ceil(starts[row_idx, pair_idx]) - c0, 0, n_cols).astype(int)
+    stops = np.clip(np.ceil(stops[row_idx, pair_idx]) - c0, 0, n_cols).astype(int)
+    
+    edges = np.zeros((n_rows, n_cols+1), int)
+    np.add.at(edges, (row_idx, starts), 1)
+    np.add.at(edges, (row_idx, stops), -1)
+    patch = np.cumsum(edges[:,:-1], axis=1) > 0
+    
+    return r0, c0, patch
+
+
 def generate_bianca_master(parent_folder, flair, t1, trans):
     # returns the name of the output master file
     # flair, t1, transformation matrix
@@ -48,6 +459,7 @@ def generate_bianca_master(parent_folder, flair, t1, trans):
     return master_name
 
 
+@tracing.traced()
 def execute_bianca(master, model, outname):
     """
     Generates a BIANCA probability map given flair, t1, a transformation matrix
@@ -73,4 +485,254 @@ def execute_bianca(master, model, outname):
     
     cmd = f'bianca --singlefile={master} --querysubjectnum={1} --brainmaskfeaturenum=1 --matfeaturenum=3 --spatialweight=1 --loadclassifierdata={model} -o {outname}'
     print(f'BIANCA execution: {cmd}')
-    os.system(cmd)
\ No newline at end of file
+    os.system(cmd)
+
+class MaskHistory:
+    """
+    Multi-level undo/redo history for binary mask edits.
+    
+    Rather than copying the whole volume before every edit, each step stores
+    only the voxels that flipped: for every axial slice that changed, the
+    bounding box of the changed pixels is kept as a bit-packed XOR delta.
+    Because XOR is its own inverse, the same delta is used to undo and redo
+    a step. When the stored deltas exceed max_bytes the oldest steps are
+    discarded.
+    
+
+    Parameters
+    ----------
+    max_bytes : int, optional
+        memory cap for the stored deltas. The default is 64 MB.
+    max_steps : int or None, optional
+        maximum number of undoable steps. None means only the memory cap
+        applies. The default is None.
+
+    """
+    
+    def __init__(self, max_bytes=64*1024**2, max_steps=None):
+        self.max_bytes = max_bytes
+        self.max_steps = max_steps
+        self.clear()
+        
+        
+    def clear(self):
+        self.undo_stack = []
+        self.redo_stack = []
+        self.n_bytes = 0
+        
+        
+    def can_undo(self):
+        return len(self.undo_stack) > 0
+    
+    
+    def can_redo(self):
+        return len(self.redo_stack) > 0
+        
+        
+    def record(self, before, after, z=None):
+        """
+        Records the difference between two states of the mask as a new step.
+        Clears the redo stack
+        
+
+        Parameters
+        ----------
+        before : np array
+            the mask before the edit. 3d, or the 2d slice at z.
+        after : np array
+            the mask after the edit, with the same shape as before.
+        z : int or None, optional
+            if before and after are 2d slices, the z index of the slice. The default is None.
+
+        Returns
+        -------
+        int, the number of bytes used to store the step
+
+        """
+        
+        changed = (before != 0) != (after != 0)
+        if z is not None:
+            changed = changed[:,:,np.newaxis]
+            z_indices = [z]
+        else:
+            z_indices = range(changed.shape[2])
+        
+        step = []
+        step_bytes = 0
+        for i, sli in zip(z_indices, np.moveaxis(changed, 2, 0)):
+            rows = np.flatnonzero(sli.any(axis=1))
+            if len(rows) == 0:
+                continue
+            cols = np.flatnonzero(sli.any(axis=0))
+            r0, r1 = rows[0], rows[-1]+1
+            c0, c1 = cols[0], cols[-1]+1
+            box = sli[r0:r1, c0:c1]
+            packed = np.packbits(box)
+            step.append((i, r0, c0, box.shape, packed))
+            step_bytes += packed.nbytes
+        
+        if not step:
+            return 0
+        
+        self.redo_stack = []
+        self.undo_stack.append((step, step_bytes))
+        self.n_bytes = sum(b for s, b in self.undo_stack)
+        self.trim()
+        
+        return step_bytes
+    
+    
+    def trim(self):
+        # drops the oldest steps until the history fits the caps. the newest step is always kept
+        while len(self.undo_stack) > 1 and (self.n_bytes > self.max_bytes or
+                                            (self.max_steps is not None and len(self.undo_stack) > self.max_steps)):
+            step, step_bytes = self.undo_stack.pop(0)
+            self.n_bytes -= step_bytes
+    
+    
+    def apply(self, step, mat):
+        # flips the voxels recorded in the step, in place
+        for i, r0, c0, shape, packed in step:
+            flips = np.unpackbits(packed, count=shape[0]*shape[1]).reshape(shape).astype(bool)
+            region = mat[r0:r0+shape[0], c0:c0+shape[1], i]
+            region[flips] = ~region[flips].astype(bool)
+            
+    
+    def undo(self, mat):
+        """
+        Reverts the most recent step in place. Returns False if there was nothing to undo
+        """
+        if not self.can_undo():
+            return False
+        step, step_bytes = self.undo_stack.pop()
+        self.n_bytes -= step_bytes
+        self.apply(step, mat)
+        self.redo_stack.append((step, step_bytes))
+        return True
+    
+    
+    def redo(self, mat):
+        """
+        Reapplies the most recently undone step in place. Returns False if there was nothing to redo
+        """
+        if not self.can_redo():
+            return False
+        step, step_bytes = self.redo_stack.pop()
+        self.apply(step, mat)
+        self.undo_stack.append((step, step_bytes))
+        self.n_bytes += step_bytes
+        self.trim()
+        return True
+
+
+
+class MaskWriter:
+    """
+    Writes binary masks and their companion stats csv on a background thread
+    so that saving does not block the GUI.
+    
+    Masks are stored as uint8 and gzipped at the given compression level. Each
+    file is first written to a temporary name in the same folder and then
+    renamed, so a partially written mask never appears under its final name
+    
+
+    Parameters
+    ----------
+    compresslevel : int, optional
+        gzip compression level from 0 (none) to 9 (smallest). The default is 1.
+
+    """
+    
+    def __init__(self, compresslevel=1):
+        self.compresslevel = compresslevel
+        self.jobs = queue.Queue()
+        self.lock = threading.Lock()
+        self.n_pending = 0
+        self.message = 'No saves yet'
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        
+        
+    def submit(self, data, affine, header, out_name, stats=None, stats_name=None):
+        """
+        Queues a mask to be written. data is copied as uint8 before this returns,
+        so the caller is free to keep editing it
+        
+
+        Parameters
+        ----------
+        data : 3d np array
+            the binary mask, in the orientation it should be written in.
+        affine : 4x4 np array
+            affine of the output image.
+        header : nibabel header
+            template header of the output image.
+        out_name : pathlike
+            path of the output .nii.gz.
+        stats : dict or None, optional
+            values to write to the companion csv. The default is None.
+        stats_name : pathlike or None, optional
+            path of the companion csv. The default is None.
+
+        Returns
+        -------
+        None
+
+        """
+        data = np.asarray(data).astype(np.uint8)
+        with self.lock:
+            self.n_pending += 1
+        self.jobs.put((data, affine, header, out_name, stats, stats_name))
+        
+        
+    def status(self):
+        with self.lock:
+            if self.n_pending:
+                return f'Saving ({self.n_pending} pending)'
+            return self.message
+        
+        
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            
+            data, affine, header, out_name, stats, stats_name = job
+            try:
+                self.write(data, affine, header, out_name, stats, stats_name)
+                message = f'Saved {os.path.basename(out_name)}'
+            except Exception as e:
+                message = f'Save failed: {e}'
+                print(f'Could not write {out_name}: {e}')
+                
+            with self.lock:
+                self.n_pending -= 1
+                self.message = message
+                
+    
+    @tracing.traced()
+    def write(self, data, affine, header, out_name, stats=None, stats_name=None):
+        
+        header = header.copy()
+        header.set_data_dtype(np.uint8)
+        out = nib.Nifti1Image(data, affine, header)
+        
+        temp_name = f'{out_name}.part'
+        with gzip.open(temp_name, 'wb', compresslevel=self.compresslevel) as f:
+            f.write(out.to_bytes())
+        os.replace(temp_name, out_name)
+        
+        if stats is not None:
+            temp_name = f'{stats_name}.part'
+            import pandas as pd # only needed once a mask is saved
+            pd.Series(stats).to_csv(temp_name)
+            os.replace(temp_name, stats_name)
+            
+            
+    def close(self):
+        """
+        Waits for all queued saves to finish and stops the writer thread
+        """
+        self.jobs.put(None)
+        self.thread.join()